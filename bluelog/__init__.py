@@ -1,38 +1,56 @@
 import logging
 import os
+import subprocess
+import sys
+import time
 from logging.handlers import SMTPHandler, RotatingFileHandler
 
 import click
-from flask import Flask, render_template, request
+from flask import Flask, current_app, render_template, request
 from flask_login import current_user
-from flask_sqlalchemy import get_debug_queries
 from flask_wtf.csrf import CSRFError
 
-from bluelog.views.admin import admin_bp
-from bluelog.views.auth import auth_bp
-from bluelog.views.blog import blog_bp
-from bluelog.extensions import bootstrap, db, login_manager, csrf, ckeditor, mail, moment, toolbar, migrate
-from bluelog.models import Admin, Post, Category, Comment, Link
+from bluelog.assets import init_assets, build_assets
+from bluelog.database import configure_database
+from bluelog.feeds import invalidate_feeds
+from bluelog.compression import compress_response
+from bluelog.caching import get_site_context, invalidate_site_context, invalidate_admin, load_cached_page, \
+    store_cached_page, release_page_lock, init_cache
+from bluelog.metrics import init_profiler, init_timers, start_request_profile, finish_request_profile, \
+    StartupProfile, summarize_import_times
+from bluelog.ratelimit import init_rate_limiter, check_rate_limit
+from bluelog.search import rebuild_index
+from bluelog.spam import init_spam_filter
+from bluelog.templating import init_templates, compile_templates
+from bluelog.extensions import bootstrap, db, login_manager, csrf, ckeditor, moment, init_debug_toolbar, \
+    init_migrate
+from bluelog.models import Admin, Post, Category, Comment, OutboxMessage
 from bluelog.settings import config
 
 basedir = os.path.abspath(os.path.dirname(os.path.dirname(__file__)))
 
 
-def create_app(config_name=None):
+def create_app(config_name=None, overrides=None):
     if config_name is None:
         config_name = os.getenv('FLASK_CONFIG', 'development')  # 默认为开发版本
 
     app = Flask('bluelog')
     app.config.from_object(config[config_name])
-
-    register_logging(app)
-    register_extensions(app)
-    register_blueprints(app)
-    register_commands(app)
-    register_errors(app)
-    register_shell_context(app)
-    register_template_context(app)
-    register_request_handlers(app)
+    if overrides:
+        app.config.update(overrides)        # 在初始化扩展之前覆盖（如压测使用的独立数据库）
+    profile = app.extensions['bluelog_startup'] = StartupProfile(app.config['BLUELOG_STARTUP_PROFILE'])
+
+    with profile.step('setup', 'logging'):
+        register_logging(app)
+    register_extensions(app)        # 每个扩展分别计时
+    register_blueprints(app)        # 每个蓝本分别计时（含导入视图模块）
+    # after_request按注册的相反顺序执行：整页缓存先于压缩
+    for register in (register_commands, register_errors, register_shell_context, register_template_context,
+                     register_request_handlers, register_compression, register_rate_limiter, register_page_cache):
+        with profile.step('setup', register.__name__[len('register_'):]):
+            register(app)
+    if profile.enabled:
+        click.echo(profile.format(), err=True)
     return app
 
 
@@ -53,6 +71,9 @@ def register_logging(app):
 
     formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')   # 创立日志格式实例
 
+    if app.debug or app.testing:        # 测试不写入日志文件和发送错误邮件
+        return
+
     file_handler = RotatingFileHandler(os.path.join(basedir, 'logs/bluelog.log'),
                                        maxBytes=10 * 1024 * 1024, backupCount=10)       # 创立远程日志文件句柄
     file_handler.setFormatter(formatter)        # 远程日志文件句柄格式
@@ -67,30 +88,47 @@ def register_logging(app):
     mail_handler.setLevel(logging.ERROR)            # 远程邮件日志级别
     mail_handler.setFormatter(request_formatter)    # 远程邮件日志格式为自定义格式request_formatter
 
-    if not app.debug:
-        app.logger.addHandler(mail_handler)     # 添加句柄，下同
-        app.logger.addHandler(file_handler)
+    app.logger.addHandler(mail_handler)     # 添加句柄，下同
+    app.logger.addHandler(file_handler)
 
 
 def register_extensions(app):
-    """注册扩展模块"""
-    bootstrap.init_app(app)
-    db.init_app(app)
-    login_manager.init_app(app)
-    csrf.init_app(app)
-    ckeditor.init_app(app)
-    mail.init_app(app)
-    moment.init_app(app)
-    toolbar.init_app(app)
-    migrate.init_app(app, db)
+    """注册扩展模块。Flask-Mail在发送第一封邮件时才初始化（见extensions.get_mail）；
+    调试工具栏只在开发时启用；Flask-Migrate只在命令行中启用，Web工作进程不导入"""
+    extensions = [
+        ('bootstrap', bootstrap.init_app),
+        ('database', configure_database),       # 连接池、SQLite WAL和只读副本
+        ('sqlalchemy', db.init_app),
+        ('login', login_manager.init_app),
+        ('csrf', csrf.init_app),
+        ('ckeditor', ckeditor.init_app),
+        ('moment', moment.init_app),
+        ('cache', init_cache),                  # 多进程部署须使用共享缓存
+        ('spam', init_spam_filter),             # 读者评论的垃圾评论过滤
+    ]
+    if app.config['BLUELOG_DEBUG_TOOLBAR']:
+        extensions.append(('debugtoolbar', init_debug_toolbar))
+    if click.get_current_context(silent=True) is not None:     # 由flask命令创建
+        extensions.append(('migrate', init_migrate))
+    profile = app.extensions['bluelog_startup']
+    for name, init_app in extensions:
+        with profile.step('extension', name):
+            init_app(app)
 
 
 def register_blueprints(app):
-    """注册蓝本"""
-    app.register_blueprint(blog_bp)
-    app.register_blueprint(admin_bp, url_prefix='/admin')
-    # app.register_blueprint(admin_bp)
-    app.register_blueprint(auth_bp, url_prefix='/auth')
+    """注册蓝本，视图模块在此导入"""
+    profile = app.extensions['bluelog_startup']
+    with profile.step('blueprint', 'blog'):
+        from bluelog.views.blog import blog_bp
+        app.register_blueprint(blog_bp)
+    with profile.step('blueprint', 'admin'):
+        from bluelog.views.admin import admin_bp
+        app.register_blueprint(admin_bp, url_prefix='/admin')
+        # app.register_blueprint(admin_bp)
+    with profile.step('blueprint', 'auth'):
+        from bluelog.views.auth import auth_bp
+        app.register_blueprint(auth_bp, url_prefix='/auth')
 
 
 def register_shell_context(app):
@@ -98,24 +136,23 @@ def register_shell_context(app):
     @app.shell_context_processor
     def make_shell_context():
         """制造命令行上下文，返回词典"""
-        return dict(db=db, Admin=Admin, Post=Post, Category=Category, Comment=Comment)
+        return dict(db=db, Admin=Admin, Post=Post, Category=Category, Comment=Comment, OutboxMessage=OutboxMessage)
 
 
 def register_template_context(app):
     """注册模板上下文"""
+    init_assets(app)        # 模板函数asset_url返回静态文件带指纹的URL
+    init_templates(app)     # 模板字节码缓存和模板片段缓存
+
     @app.context_processor
     def make_template_context():
         """制造模板上下文，返回词典"""
-        admin = Admin.query.first()                                 # 当前管理员
-        categories = Category.query.order_by(Category.name).all()   # 博文标签集
-        links = Link.query.order_by(Link.name).all()                # 外部链接集
+        context = get_site_context()        # 当前管理员、博文标签集、外部链接集（可缓存）
         if current_user.is_authenticated:
-            unread_comments = Comment.query.filter_by(reviewed=False).count()       # 未审核评论数
+            unread_comments = current_user.unread_comment_count     # 未审核评论数（冗余计数，随管理员缓存）
         else:
             unread_comments = None
-        return dict(
-            admin=admin, categories=categories,
-            links=links, unread_comments=unread_comments)
+        return dict(context, unread_comments=unread_comments)
 
 
 def register_errors(app):
@@ -130,6 +167,12 @@ def register_errors(app):
         """网页未发现404"""
         return render_template('errors/404.html'), 404
 
+    @app.errorhandler(429)
+    def too_many_requests(e):
+        """请求过于频繁429，Retry-After告知客户端何时重试"""
+        headers = {'Retry-After': str(e.retry_after)} if getattr(e, 'retry_after', None) else {}
+        return render_template('errors/429.html'), 429, headers
+
     @app.errorhandler(500)
     def internal_server_error(e):
         """内部服务器端错误500"""
@@ -141,6 +184,19 @@ def register_errors(app):
         return render_template('errors/400.html', description=e.description), 400
 
 
+def create_tables():
+    """建立数据库表。空数据库建表后标记为最新的迁移版本，之后的模型变更用flask db upgrade升级；
+    已有表的数据库（旧版本建立的）不标记，须先flask db stamp 5e31132c23d6再flask db upgrade"""
+    from flask_migrate import stamp
+    from sqlalchemy import inspect
+    empty = set(inspect(db.engine).get_table_names()).isdisjoint(db.metadata.tables)
+    db.create_all()
+    if empty:
+        if 'migrate' not in current_app.extensions:     # 应用不是由flask命令创建的（如测试中的test_cli_runner）
+            init_migrate(current_app._get_current_object())
+        stamp()
+
+
 def register_commands(app):
     """注册命令行"""
     @app.cli.command()
@@ -151,7 +207,9 @@ def register_commands(app):
             click.confirm('This operation will delete the database, do you want to continue?将删除数据库，继续？', abort=True)
             db.drop_all()
             click.echo('Drop tables.删除表格')
-        db.create_all()
+        create_tables()
+        invalidate_admin()
+        rebuild_index()
         click.echo('Initialized database.数据库初始化完成。')
 
     @app.cli.command()
@@ -162,7 +220,7 @@ def register_commands(app):
         """创建博客"""
 
         click.echo('Initializing the database...初始化数据库')
-        db.create_all()
+        create_tables()
 
         admin = Admin.query.first()
         if admin is not None:
@@ -188,18 +246,34 @@ def register_commands(app):
             db.session.add(category)
 
         db.session.commit()
+        invalidate_site_context()
+        invalidate_admin()
         click.echo('Done.')
 
     @app.cli.command()
     @click.option('--category', default=10, help='Quantity of categories, default is 10.标签数量，默认10个')
     @click.option('--post', default=50, help='Quantity of posts, default is 50.博文数量，默认50篇')
     @click.option('--comment', default=500, help='Quantity of comments, default is 500.评论数量，莫问500篇')
-    def forge(category, post, comment):
-        """生成虚拟数据"""
-        from bluelog.fakes import fake_admin, fake_categories, fake_posts, fake_comments, fake_links
+    @click.option('--seed', type=int, help='Random seed for a reproducible dataset.随机种子，相同种子生成相同数据')
+    @click.option('--workers', default=1, type=click.IntRange(min=1),
+                  help='Processes generating text, default is 1.生成文本的进程数，默认1个')
+    @click.option('--chunk-size', default=1000, type=click.IntRange(min=1),
+                  help='Posts generated and inserted per commit, default is 1000.每批生成并提交的博文数，默认1000')
+    @click.option('--reviewed-ratio', default=0.9, type=click.FloatRange(0, 1),
+                  help='Ratio of reviewed comments, default is 0.9.已审核评论比例')
+    @click.option('--reply-ratio', default=0.3, type=click.FloatRange(0, 1), help='Ratio of replies, default is 0.3.回复比例')
+    def forge(category, post, comment, seed, workers, chunk_size, reviewed_ratio, reply_ratio):
+        """生成虚拟数据，分批生成和插入，不在内存中保留整个数据集"""
+        import random
+        from bluelog.fakes import seed_fakes, fake_admin, fake_categories, fake_posts, fake_links
+
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        click.echo('Using seed %d...（随机种子）' % seed)
+        seed_fakes(seed)
 
         db.drop_all()
-        db.create_all()
+        create_tables()
 
         click.echo('Generating the administrator...（生成系统管理员）')
         fake_admin()
@@ -207,26 +281,230 @@ def register_commands(app):
         click.echo('Generating %d categories...（生成博文标签）' % category)
         fake_categories(category)
 
-        click.echo('Generating %d posts...（生成博文）' % post)
-        fake_posts(post)
-
-        click.echo('Generating %d comments...（生成评论）' % comment)
-        fake_comments(comment)
+        click.echo('Generating %d posts and %d comments...（生成博文和评论）' % (post, comment))
+        with click.progressbar(length=post) as bar:
+            fake_posts(post, comment, seed=seed, workers=workers, chunk_size=chunk_size,
+                       reviewed_ratio=reviewed_ratio, reply_ratio=reply_ratio,
+                       progress=lambda posts, comments: bar.update(posts))
 
         click.echo('Generating links...（生成外部链接）')
         fake_links()
+        invalidate_site_context()
+        invalidate_admin()
+        invalidate_feeds()
+
+        click.echo('Building the search index...（建立搜索索引）')
+        rebuild_index()
 
         click.echo('Done.（生成虚拟数据完成。）')
 
+    @app.cli.command()
+    @click.option('--batch', default=500, help='Posts per commit, default is 500.每批提交的博文数，默认500')
+    def backfill(batch):
+        """回填博文摘要、字数、阅读时间和评论计数（含未审核评论数）"""
+        click.echo('Backfilling post excerpts...回填博文摘要')
+        last_id, count = 0, 0
+        while True:     # 按id分批读取，避免一次载入所有博文正文
+            posts = Post.query.filter(Post.id > last_id).order_by(Post.id).limit(batch).all()
+            if not posts:
+                break
+            for post in posts:
+                post.update_excerpt()
+            db.session.commit()
+            last_id = posts[-1].id
+            count += len(posts)
+            db.session.expunge_all()
+        Post.update_all_comment_counts()
+        Admin.update_unread_comment_count()
+        db.session.commit()
+        invalidate_site_context()
+        invalidate_admin()
+        click.echo('Done, %d posts updated.' % count)
+
+    @app.cli.command()
+    def reindex():
+        """重建搜索索引"""
+        click.echo('Rebuilding the search index...重建搜索索引')
+        backend = rebuild_index()
+        click.echo('Done (%s).' % backend)
+
+    @app.cli.command()
+    @click.option('--config', 'config_name', default='production', type=click.Choice(sorted(config)),
+                  help='Configuration to benchmark, default is production.被测配置，默认production')
+    @click.option('--database', help='Database URI, default is a temporary SQLite file.测试数据库，默认为临时SQLite文件')
+    @click.option('--reuse', is_flag=True, help='Reuse the data in --database instead of forging.使用已有数据，不重新生成')
+    @click.option('--category', default=10, help='Quantity of categories, default is 10.标签数量，默认10个')
+    @click.option('--post', default=200, help='Quantity of posts, default is 200.博文数量，默认200篇')
+    @click.option('--comment', default=2000, help='Quantity of comments, default is 2000.评论数量，默认2000条')
+    @click.option('--requests', 'request_count', default=1000, help='Timed requests, default is 1000.计时请求数，默认1000')
+    @click.option('--warmup', default=50, help='Untimed warmup requests, default is 50.预热请求数，默认50')
+    @click.option('--mix', default='mixed', type=click.Choice(sorted(app.config['BLUELOG_BENCH_MIXES'])),
+                  help='Request mix.请求组合，默认mixed')
+    @click.option('--seed', default=42, help='Random seed for the dataset and the requests.随机种子，默认42')
+    @click.option('--page-cache/--no-page-cache', default=True, help='Enable the page cache.是否启用整页缓存')
+    @click.option('--output', type=click.Path(dir_okay=False), help='Save the results as JSON.结果保存为JSON文件')
+    def bench(config_name, database, reuse, category, post, comment, request_count, warmup, mix, seed, page_cache,
+              output):
+        """生成测试数据并按请求组合压测博客和后台，报告吞吐量、延迟百分位和每请求查询数"""
+        from bluelog.bench import Benchmark, prepare_bench_app, build_report, format_report, save_report
+        with prepare_bench_app(config_name, database, reuse, category, post, comment, seed,
+                               BLUELOG_CACHE_PAGES=page_cache) as bench_app:
+            click.echo('Running %d requests (%s mix)...（压测）' % (request_count, mix))
+            with click.progressbar(length=warmup + request_count) as bar:
+                result = Benchmark(bench_app, mix, seed).run(request_count, warmup, progress=bar.update)
+        report = build_report(result, config=config_name, mix=mix, seed=seed, warmup=warmup,
+                              page_cache=page_cache, dataset=dict(categories=category, posts=post, comments=comment),
+                              database=database)
+        click.echo(format_report(report))
+        if output:
+            save_report(report, output)
+            click.echo('Saved results to %s.（保存结果）' % output)
+
+    @app.cli.command('bench-server')
+    @click.option('--config', 'config_name', default='production', type=click.Choice(sorted(config)),
+                  help='Configuration to benchmark, default is production.被测配置，默认production')
+    @click.option('--database', help='Database URI, default is a temporary SQLite file.测试数据库，默认为临时SQLite文件')
+    @click.option('--reuse', is_flag=True, help='Reuse the data in --database instead of forging.使用已有数据，不重新生成')
+    @click.option('--post', default=200, help='Quantity of posts, default is 200.博文数量，默认200篇')
+    @click.option('--comment', default=2000, help='Quantity of comments, default is 2000.评论数量，默认2000条')
+    @click.option('--requests', 'request_count', default=500, help='Requests per server, default is 500.每种模式的请求数，默认500')
+    @click.option('--clients', default=50, help='Concurrent clients, default is 50.并发客户端数，默认50')
+    @click.option('--threads', default=10, help='Threads running views, default is 10.执行视图的线程数，默认10')
+    @click.option('--client-delay', default=0.05, help='Seconds a client takes to receive a response, default is 0.05.'
+                                                       '客户端接收一个响应的秒数，默认0.05')
+    @click.option('--seed', default=42, help='Random seed for the dataset and the requests.随机种子，默认42')
+    @click.option('--page-cache/--no-page-cache', default=True, help='Enable the page cache.是否启用整页缓存')
+    def bench_server(config_name, database, reuse, post, comment, request_count, clients, threads, client_delay, seed,
+                     page_cache):
+        """在进程内模拟大量较慢客户端并发读取，比较同步WSGI工作进程和ASGI入口的吞吐量和延迟。
+        WSGI一侧是模型（线程在模拟的发送时间内保持占用），不是对gunicorn或uvicorn的实测"""
+        from bluelog.bench import ServerBenchmark, prepare_bench_app, format_server_report
+        with prepare_bench_app(config_name, database, reuse, 10, post, comment, seed,
+                               BLUELOG_CACHE_PAGES=page_cache) as bench_app:
+            benchmark = ServerBenchmark(bench_app, threads, clients, client_delay, seed)
+            results = []
+            for name, run in (('wsgi', benchmark.run_wsgi), ('asgi', benchmark.run_asgi)):
+                click.echo('Simulating %d requests with %d clients (%s)...（模拟压测）' % (request_count, clients, name))
+                results.append((name, run(request_count)))
+        click.echo(format_server_report(results))
+
+    @app.cli.command()
+    @click.option('--output', default=os.path.join(basedir, 'export'), type=click.Path(file_okay=False),
+                  help='Output directory, default is export/.导出目录，默认export/')
+    @click.option('--workers', default=1, help='Processes rendering pages, default is 1.渲染页面的进程数，默认1个')
+    @click.option('--full', is_flag=True, help='Export every page, e.g. after editing templates.全量导出（如修改模板后）')
+    def export(output, workers, full):
+        """将公开页面按每个主题导出为静态文件，由nginx直接提供，默认只导出上次导出后受影响的页面"""
+        from bluelog.export import export_site
+        click.echo('Exporting the blog to %s...导出静态页面' % output)
+        incremental, pages, removed = export_site(output, workers=workers, full=full)
+        click.echo('Done, %d pages %s, %d stale files removed.（完成）'
+                   % (pages, 'updated' if incremental else 'exported', removed))
+
+    @app.cli.group()
+    def assets():
+        """静态文件"""
+
+    @assets.command('build')
+    def build_static_assets():
+        """生成带内容指纹的静态文件和gzip/brotli预压缩版本"""
+        click.echo('Building static assets...生成静态文件')
+        manifest = build_assets(app.static_folder, app.config['BLUELOG_ASSETS_DIST'],
+                                app.config['BLUELOG_CKEDITOR_LANGUAGES'])
+        app.extensions['bluelog_assets'] = manifest
+        click.echo('Done, %d files.（完成）' % len(manifest))
+
+    @app.cli.group()
+    def templates():
+        """模板"""
+
+    @templates.command('compile')
+    def compile_all_templates():
+        """编译所有模板并写入字节码缓存，部署后运行，工作进程启动时不必解析模板"""
+        if not app.config['BLUELOG_TEMPLATE_CACHE_DIR']:
+            raise click.ClickException('BLUELOG_TEMPLATE_CACHE_DIR is not set.（未设置模板字节码缓存目录）')
+        click.echo('Compiling templates...编译模板')
+        start = time.perf_counter()
+        compiled, errors = compile_templates(app)
+        for name, error in errors:
+            click.echo('%s: %s' % (name, error), err=True)
+        click.echo('Done, %d templates in %.2fs.（完成）' % (compiled, time.perf_counter() - start))
+        if errors:
+            raise click.ClickException('%d templates failed to compile.（编译失败）' % len(errors))
+
+    @app.cli.command('profile-startup')
+    @click.option('--config', 'config_name', default='production', type=click.Choice(sorted(config)),
+                  help='Configuration to profile, default is production.被测配置，默认production')
+    @click.option('--top', default=15, help='Packages to list, default is 15.列出的软件包数，默认15个')
+    def profile_startup(config_name, top):
+        """在新进程中导入bluelog并创建应用，报告各软件包的导入耗时和各扩展、蓝本的初始化耗时"""
+        code = 'from bluelog import create_app; create_app(%r)' % config_name
+        env = dict(os.environ, BLUELOG_STARTUP_PROFILE='true')
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=basedir, env=env,
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        elapsed = time.perf_counter() - start
+        imports, output = summarize_import_times(result.stderr, top)
+        if result.returncode:
+            raise click.ClickException('\n'.join(output))
+        click.echo('%-35s %10s' % ('import', 'ms'))
+        for name, duration in imports:
+            click.echo('%-35s %10.1f' % (name, duration))
+        click.echo('')
+        click.echo('\n'.join(output))
+        click.echo('%-35s %10.1f' % ('process', elapsed * 1000))
+
+    @app.cli.command('mail-worker')
+    @click.option('--once', is_flag=True, help='Deliver due mail once and exit.发送一次到期邮件后退出')
+    def mail_worker(once):
+        """发送发件箱中的邮件"""
+        from bluelog.emails import run_mail_worker
+
+        click.echo('Delivering mail from the outbox...发送发件箱中的邮件')
+        run_mail_worker(once)
+
 
 def register_request_handlers(app):
     """注册请求句柄"""
+    init_profiler(app)      # 按端点聚合查询统计，慢查询日志也由它记录
+    init_timers(app)        # 按端点统计各请求阶段的耗时直方图
+
+    @app.before_request
+    def query_profiler():
+        start_request_profile()
+
+    @app.teardown_request
+    def collect_query_profile(exc):
+        finish_request_profile()
+
+
+def register_compression(app):
+    """注册响应压缩（BLUELOG_COMPRESSION开启时）。after_request按注册的相反顺序执行，
+    须在整页缓存之前注册，使整页缓存先写入未压缩的页面及其压缩版本"""
     @app.after_request
-    def query_profiler(response):
-        for q in get_debug_queries():
-            if q.duration >= app.config['BLUELOG_SLOW_QUERY_THRESHOLD']:
-                app.logger.warning(
-                    'Slow query: Duration: %fs\n Context: %s\nQuery: %s\n '
-                    % (q.duration, q.context, q.statement)
-                )
-        return response
+    def compress_body(response):
+        return compress_response(response)
+
+
+def register_rate_limiter(app):
+    """注册请求频率限制，在整页缓存之前检查"""
+    init_rate_limiter(app)
+
+    @app.before_request
+    def limit_request_rate():
+        check_rate_limit()
+
+
+def register_page_cache(app):
+    """注册整页缓存：匿名读者的GET请求命中缓存时直接返回响应，不渲染模板"""
+    @app.before_request
+    def serve_cached_page():
+        return load_cached_page()
+
+    @app.after_request
+    def cache_rendered_page(response):
+        return store_cached_page(response)
+
+    @app.teardown_request
+    def release_render_lock(exc):
+        release_page_lock()
@@ -0,0 +1,152 @@
+import asyncio
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+# ASGI入口：uvicorn --factory bluelog.asgi:create_asgi_app --host 0.0.0.0 --port 8000
+# 读取请求体和向客户端发送响应都在事件循环中进行，视图（与WSGI相同的同步代码）只在线程池中执行，
+# 读取较慢的客户端不再占用工作线程。线程数即同时执行的请求数，由BLUELOG_ASGI_THREADS设置
+
+BODY_MEMORY_SIZE = 1024 * 1024      # 请求体超过此大小时暂存到临时文件
+QUEUE_SIZE = 8                      # 每个响应最多排队的消息数，队列满时线程等待客户端接收，内存占用与响应大小无关
+
+
+class AsgiAdapter(object):
+    """把WSGI应用包装为ASGI应用。响应体在线程中生成后放入有界队列，由事件循环按客户端的速度发送"""
+
+    def __init__(self, wsgi_app, threads):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='bluelog-asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            raise ValueError('Unsupported ASGI scope type: %s' % scope['type'])
+        body = await self._read_body(receive)
+        if body is None:        # 客户端在发送完请求之前断开
+            return
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(QUEUE_SIZE)
+        disconnected = threading.Event()
+        future = loop.run_in_executor(self.executor, self._run, scope, body, loop, queue, disconnected)
+        try:
+            while True:
+                message = await queue.get()
+                if message is None:
+                    break
+                await send(message)
+        except BaseException:       # 发送失败或请求被取消（客户端断开）：通知线程停止，取走剩余消息使其不再等待
+            disconnected.set()
+            while await queue.get() is not None:
+                pass
+            raise
+        await future
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    async def _read_body(receive):
+        body = SpooledTemporaryFile(BODY_MEMORY_SIZE)
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                body.close()
+                return None
+            body.write(message.get('body', b''))
+            if not message.get('more_body'):
+                body.seek(0)
+                return body
+
+    @staticmethod
+    def _environ(scope, body):
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        script_name = scope.get('root_path', '')
+        path = scope['path']
+        if script_name and path.startswith(script_name):
+            path = path[len(script_name):]
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': script_name.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': 'HTTP/%s' % scope.get('http_version', '1.1'),
+            'REMOTE_ADDR': client[0],
+            'REMOTE_PORT': str(client[1]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope['headers']:
+            name = name.decode('latin-1')
+            if name == 'content-type':
+                key = 'CONTENT_TYPE'
+            elif name == 'content-length':
+                key = 'CONTENT_LENGTH'
+            else:
+                key = 'HTTP_' + name.upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if key in environ:      # 同名首部合并
+                value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+            environ[key] = value
+        return environ
+
+    def _run(self, scope, body, loop, queue, disconnected):
+        """在线程中执行WSGI应用，把响应首部和各段响应体转换为ASGI消息放入队列，结束时放入None。
+        队列已满时等待事件循环发送，客户端断开后不再生成剩余的响应体"""
+        def put(message):
+            asyncio.run_coroutine_threadsafe(queue.put(message), loop).result()
+
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['start'] = {'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                                 'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                             for name, value in headers]}
+
+        try:
+            result = self.wsgi_app(self._environ(scope, body), start_response)
+            try:
+                pending = None      # 保留一段，最后一段随结束标记一起发送
+                for chunk in result:
+                    if disconnected.is_set():
+                        return
+                    if not chunk:
+                        continue
+                    if pending is None:
+                        put(response['start'])
+                    else:
+                        put({'type': 'http.response.body', 'body': pending, 'more_body': True})
+                    pending = chunk
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            if pending is None:
+                put(response['start'])
+            put({'type': 'http.response.body', 'body': pending or b''})
+        finally:
+            body.close()
+            put(None)
+
+
+def create_asgi_app(config_name=None):
+    """创建应用并包装为ASGI应用"""
+    from bluelog import create_app
+    app = create_app(config_name)
+    return AsgiAdapter(app, app.config['BLUELOG_ASGI_THREADS'])
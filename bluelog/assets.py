@@ -0,0 +1,148 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from flask import current_app, request, send_from_directory, url_for
+
+try:
+    import brotli
+except ImportError:     # 未安装brotli时只生成gzip压缩版本
+    brotli = None
+
+MANIFEST = 'manifest.json'                  # 原路径 -> 带指纹路径（相对于构建目录）
+CKEDITOR_DIR = 'ckeditor'                   # CKEditor整体复制到以内容散列命名的目录，内部文件保持原名
+SKIPPED_SUFFIXES = ('.map', '.md')          # 不发布的文件
+SKIPPED_NAMES = ('build-config.js',)
+SKIPPED_DIRS = ('samples',)
+COMPRESSED_TYPES = ('.css', '.js', '.json', '.svg', '.txt', '.html', '.ico')    # 预压缩的文件类型
+MIN_COMPRESS_SIZE = 1024                    # 小于此大小的文件压缩意义不大
+IMMUTABLE = 'public, max-age=31536000, immutable'
+
+
+def _digest(data):
+    return hashlib.md5(data).hexdigest()[:10]
+
+
+def _fingerprinted(path, digest):
+    root, ext = os.path.splitext(path)
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def _skipped(path, languages):
+    """是否跳过：说明文档、示例、source map，以及未使用语言的CKEditor语言包"""
+    parts = path.split('/')
+    if any(part in SKIPPED_DIRS for part in parts) or parts[-1] in SKIPPED_NAMES:
+        return True
+    if path.endswith(SKIPPED_SUFFIXES):
+        return True
+    if len(parts) > 1 and parts[-2] == 'lang':
+        return os.path.splitext(parts[-1])[0] not in languages
+    return False
+
+
+def _walk(directory):
+    """按相对路径排序列出目录下的文件"""
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            paths.append(os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/'))
+    return sorted(paths)
+
+
+def _write(dist, path, data):
+    """写入文件及其预压缩版本（.gz、.br）"""
+    target = os.path.join(dist, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, 'wb') as f:
+        f.write(data)
+    if not path.endswith(COMPRESSED_TYPES) or len(data) < MIN_COMPRESS_SIZE:
+        return
+    with open(target + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, 9))
+    if brotli is not None:
+        with open(target + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def build_assets(static_folder, dist, languages):
+    """生成带内容指纹的静态文件及其预压缩版本和清单，返回清单。
+    CKEditor按相对路径加载自身的插件、皮肤和语言包，因此整体复制到ckeditor.<散列>/目录。
+    不删除以前构建的文件，已缓存的页面和未重启的进程引用的旧URL仍然有效"""
+    dist_path = os.path.join(static_folder, dist)
+    os.makedirs(dist_path, exist_ok=True)
+    manifest = {}
+    editor_files = []
+    for path in _walk(static_folder):
+        if path.startswith(dist + '/') or _skipped(path, languages):
+            continue
+        if path.startswith(CKEDITOR_DIR + '/'):
+            editor_files.append(path)
+            continue
+        with open(os.path.join(static_folder, path), 'rb') as f:
+            data = f.read()
+        manifest[path] = _fingerprinted(path, _digest(data))
+        _write(dist_path, manifest[path], data)
+
+    if editor_files:
+        digest = hashlib.md5()
+        contents = []
+        for path in editor_files:
+            with open(os.path.join(static_folder, path), 'rb') as f:
+                data = f.read()
+            digest.update(path.encode('utf-8') + b'\0' + data)
+            contents.append((path, data))
+        editor_dir = '%s.%s' % (CKEDITOR_DIR, digest.hexdigest()[:10])
+        for path, data in contents:
+            target = editor_dir + path[len(CKEDITOR_DIR):]
+            manifest[path] = target
+            _write(dist_path, target, data)
+
+    with open(os.path.join(dist_path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_manifest(app):
+    """读取构建清单，未构建或未启用时返回空清单（使用原始文件）"""
+    path = os.path.join(app.static_folder, app.config['BLUELOG_ASSETS_DIST'], MANIFEST)
+    if not app.config['BLUELOG_ASSETS_USE_MANIFEST'] or not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def asset_url(filename):
+    """模板中使用：返回静态文件带指纹的URL，未构建时返回原始URL"""
+    manifest = current_app.extensions['bluelog_assets']
+    if filename in manifest:
+        filename = '%s/%s' % (current_app.config['BLUELOG_ASSETS_DIST'], manifest[filename])
+    return url_for('static', filename=filename)
+
+
+def _send_static(filename):
+    """替换Flask的静态文件视图：构建目录中的文件按Accept-Encoding发送预压缩版本，并可永久缓存"""
+    app = current_app._get_current_object()
+    if not filename.startswith(app.config['BLUELOG_ASSETS_DIST'] + '/'):
+        return app.send_static_file(filename)
+    response = None
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.isfile(os.path.join(app.static_folder, filename + suffix)):
+            mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            response = send_from_directory(app.static_folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    if response is None:
+        response = app.send_static_file(filename)
+    if os.path.isfile(os.path.join(app.static_folder, filename + '.gz')):
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = IMMUTABLE     # 文件名含内容散列，内容变化即换URL
+    return response
+
+
+def init_assets(app):
+    """载入构建清单，注册asset_url模板函数和静态文件视图"""
+    app.extensions['bluelog_assets'] = load_manifest(app)
+    app.add_template_global(asset_url)
+    app.view_functions['static'] = _send_static
@@ -0,0 +1,329 @@
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import click
+from sqlalchemy import event
+from werkzeug.test import EnvironBuilder
+
+from bluelog.extensions import db
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def create_bench_app(config_name, database_uri, **overrides):
+    """创建使用独立数据库的应用，生成数据时不会删除开发或生产数据库。设置在初始化扩展之前覆盖：
+    不继承被测配置的连接池参数、只读副本和共享缓存，压测不会连接或清除生产环境的数据库和缓存。
+    关闭CSRF和后台发件线程，评论提交只入队邮件；所有请求来自同一IP，不限制请求和评论频率"""
+    from bluelog import create_app
+    settings = dict(SQLALCHEMY_DATABASE_URI=database_uri, SQLALCHEMY_ENGINE_OPTIONS={}, SQLALCHEMY_BINDS=None,
+                    BLUELOG_DATABASE_REPLICA_URL=None, CACHE_TYPE='SimpleCache',
+                    WTF_CSRF_ENABLED=False, BLUELOG_MAIL_BACKGROUND=False, BLUELOG_SPAM_MODEL_PATH=None,
+                    BLUELOG_RATE_LIMIT=False, BLUELOG_SPAM_CHECKS=('duplicate', 'links', 'keywords', 'bayes'))
+    settings.update(overrides)
+    return create_app(config_name, settings)
+
+
+@contextmanager
+def prepare_bench_app(config_name, database, reuse, categories, posts, comments, seed, **overrides):
+    """bench和bench-server共用：创建压测应用并生成测试数据（reuse时使用database中已有的数据），
+    未指定database时使用临时SQLite文件，结束后删除"""
+    temporary = None
+    if database is None:
+        fd, temporary = tempfile.mkstemp(prefix='bluelog-bench-', suffix='.db')
+        os.close(fd)
+        database = 'sqlite:///' + temporary
+    app = create_bench_app(config_name, database, **overrides)
+    try:
+        if not reuse:
+            click.echo('Forging %d posts and %d comments...（生成测试数据）' % (posts, comments))
+            with app.app_context():
+                forge_dataset(categories, posts, comments, seed)
+        yield app
+    finally:
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        if temporary is not None:
+            for path in (temporary, temporary + '-wal', temporary + '-shm'):    # WAL模式的附属文件
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def forge_dataset(categories, posts, comments, seed):
+    """用flask forge相同的方法在当前应用的数据库中生成测试数据"""
+    from bluelog.caching import invalidate_site_context, invalidate_admin
+    from bluelog.fakes import seed_fakes, fake_admin, fake_categories, fake_posts, fake_links
+    from bluelog.search import rebuild_index
+
+    seed_fakes(seed)
+    db.drop_all()
+    db.create_all()
+    fake_admin()
+    fake_categories(categories)
+    fake_posts(posts, comments, seed=seed)
+    fake_links()
+    invalidate_site_context()
+    invalidate_admin()
+    rebuild_index()
+
+
+def _percentile(values, p):
+    """最近秩法求百分位数，values须已排序"""
+    if not values:
+        return None
+    rank = max(int(round(p / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(samples, elapsed):
+    """汇总一组（耗时, 查询数, 是否出错）样本"""
+    latencies = sorted(sample[0] for sample in samples)
+    count = len(samples)
+    result = dict(requests=count, errors=sum(1 for sample in samples if sample[2]),
+                  throughput=count / elapsed if elapsed else None,
+                  latency_ms=dict(mean=sum(latencies) * 1000 / count if count else None,
+                                  max=latencies[-1] * 1000 if latencies else None),
+                  queries_per_request=sum(sample[1] for sample in samples) / float(count) if count else None)
+    for p in PERCENTILES:
+        value = _percentile(latencies, p)
+        result['latency_ms']['p%d' % p] = value * 1000 if value is not None else None
+    return result
+
+
+class Benchmark(object):
+    """用测试客户端按请求组合驱动应用，记录每个场景的耗时和查询数"""
+
+    def __init__(self, app, mix, seed):
+        self.app = app
+        self.mix = app.config['BLUELOG_BENCH_MIXES'][mix]
+        self.rng = random.Random(seed)
+        self.queries = 0
+        self.reader = app.test_client()
+        self.admin = app.test_client()
+        with app.app_context():
+            from bluelog.models import Category, Post
+            event.listen(db.engine, 'before_cursor_execute', self._count_query)
+            self.post_ids = [id for id, in db.session.query(Post.id)]
+            self.category_ids = [id for id, in db.session.query(Category.id)]
+        self.admin.post('/auth/login', data=dict(username='admin', password='helloflask'))
+
+    def _count_query(self, *args):
+        self.queries += 1
+
+    def _request(self, scenario):
+        """发出一个场景的请求，返回（响应, 期望的状态码），期望为None时任何非错误状态都算成功"""
+        post_url = '/post/%d' % self.rng.choice(self.post_ids)
+        if scenario == 'blog.index':
+            return self.reader.get('/'), None
+        if scenario == 'blog.show_post':
+            return self.reader.get(post_url), None
+        if scenario == 'blog.show_category':
+            return self.reader.get('/category/%d' % self.rng.choice(self.category_ids)), None
+        if scenario == 'blog.show_post:comment':
+            # 每次用新的客户端，避免闪现消息累积在会话中
+            data = dict(author='Bench', email='bench@example.com', site='', body='Benchmark comment %d'
+                        % self.rng.randint(0, 1 << 30))
+            return self.app.test_client().post(post_url, data=data), 302
+        if scenario == 'blog.show_post:admin':
+            return self.admin.get(post_url), None
+        if scenario.startswith('admin.'):
+            path = {'admin.manage_post': '/admin/post/manage', 'admin.manage_comment': '/admin/comment/manage',
+                    'admin.manage_category': '/admin/category/manage'}[scenario]
+            return self.admin.get(path), None
+        raise ValueError(scenario)
+
+    def run(self, requests, warmup=0, progress=None):
+        """执行warmup个预热请求（不计入结果）和requests个计时请求，返回报告词典"""
+        scenarios = [scenario for scenario, weight in self.mix]
+        weights = [weight for scenario, weight in self.mix]
+        samples = dict((scenario, []) for scenario in scenarios)
+        total = []
+        started = time.perf_counter()
+        for i in range(warmup + requests):
+            scenario = self.rng.choices(scenarios, weights)[0]
+            if i == warmup:
+                started = time.perf_counter()
+            self.queries = 0
+            start = time.perf_counter()
+            response, expected = self._request(scenario)
+            duration = time.perf_counter() - start
+            error = response.status_code != expected if expected else response.status_code >= 400
+            if i >= warmup:
+                sample = (duration, self.queries, error)
+                samples[scenario].append(sample)
+                total.append(sample)
+            if progress is not None:
+                progress(1)
+        elapsed = time.perf_counter() - started
+        return dict(total=summarize(total, elapsed),
+                    endpoints=dict((scenario, summarize(values, sum(value[0] for value in values)))
+                                   for scenario, values in samples.items() if values))
+
+
+class ServerBenchmark(object):
+    """在进程内模拟比较WSGI和ASGI（bluelog/asgi.py）在大量读取较慢的客户端并发访问时的吞吐量。
+    clients个客户端各自依次发出read组合中的请求，每个响应需要client_delay秒才能发送完；两种模式都用threads个线程执行视图。
+    WSGI模式是同步工作进程的模型：线程在模拟的发送时间内一直被占用；ASGI模式使用真实的AsgiAdapter，由事件循环发送。
+    没有网络连接和服务器进程，结果只反映两种模型的差别，不能代替对gunicorn和uvicorn的实测"""
+
+    def __init__(self, app, threads, clients, client_delay, seed):
+        self.app = app
+        self.threads = threads
+        self.clients = clients
+        self.client_delay = client_delay
+        self.rng = random.Random(seed)
+        with app.app_context():
+            from bluelog.models import Category, Post
+            self.post_ids = [id for id, in db.session.query(Post.id)]
+            self.category_ids = [id for id, in db.session.query(Category.id)]
+
+    def _paths(self, requests):
+        """按read组合生成各客户端的请求路径"""
+        mix = self.app.config['BLUELOG_BENCH_MIXES']['read']
+        scenarios = [scenario for scenario, weight in mix]
+        weights = [weight for scenario, weight in mix]
+        paths = [[] for _ in range(self.clients)]
+        for i in range(requests):
+            scenario = self.rng.choices(scenarios, weights)[0]
+            if scenario == 'blog.index':
+                path = '/'
+            elif scenario == 'blog.show_post':
+                path = '/post/%d' % self.rng.choice(self.post_ids)
+            else:
+                path = '/category/%d' % self.rng.choice(self.category_ids)
+            paths[i % self.clients].append(path)
+        return paths
+
+    def run_wsgi(self, requests):
+        executor = ThreadPoolExecutor(self.threads)
+        samples, lock = [], threading.Lock()
+
+        def handle(path):
+            status = []
+
+            def start_response(code, headers, exc_info=None):
+                status.append(code)
+
+            result = self.app(EnvironBuilder(path=path).get_environ(), start_response)
+            try:
+                b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            time.sleep(self.client_delay)       # 向客户端发送响应
+            return int(status[0].split(' ', 1)[0])
+
+        def client(paths):
+            for path in paths:
+                start = time.perf_counter()
+                code = executor.submit(handle, path).result()
+                with lock:
+                    samples.append((time.perf_counter() - start, 0, code >= 400))
+
+        clients = [threading.Thread(target=client, args=(paths,)) for paths in self._paths(requests)]
+        started = time.perf_counter()
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        executor.shutdown()
+        return summarize(samples, elapsed)
+
+    def run_asgi(self, requests):
+        from bluelog.asgi import AsgiAdapter
+        adapter = AsgiAdapter(self.app, self.threads)
+        samples = []
+
+        async def handle(path):
+            parts = urlsplit(path)
+            scope = {'type': 'http', 'method': 'GET', 'path': parts.path, 'query_string': parts.query.encode(),
+                     'headers': [(b'host', b'localhost')], 'server': ('localhost', 80), 'client': ('127.0.0.1', 0),
+                     'http_version': '1.1', 'scheme': 'http', 'root_path': ''}
+            status = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': b''}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+                elif not message.get('more_body'):
+                    await asyncio.sleep(self.client_delay)      # 向客户端发送响应
+
+            await adapter(scope, receive, send)
+            return status[0]
+
+        async def client(paths):
+            for path in paths:
+                start = time.perf_counter()
+                code = await handle(path)
+                samples.append((time.perf_counter() - start, 0, code >= 400))
+
+        async def main():
+            await asyncio.gather(*[client(paths) for paths in self._paths(requests)])
+
+        started = time.perf_counter()
+        asyncio.run(main())
+        elapsed = time.perf_counter() - started
+        adapter.executor.shutdown()
+        return summarize(samples, elapsed)
+
+
+def format_server_report(results):
+    """以文本表格输出WSGI和ASGI的模拟比较结果"""
+    header = '%-16s %8s %8s %9s %9s %9s %9s %6s' % ('model', 'requests', 'req/s', 'mean ms', 'p50 ms', 'p95 ms',
+                                                 'p99 ms', 'errors')
+    lines = ['In-process simulation, not a gunicorn/uvicorn measurement.（进程内模拟，不是服务器实测）',
+             header, '-' * len(header)]
+    for name, stats in results:
+        latency = stats['latency_ms']
+        lines.append('%-16s %8d %8.1f %9.2f %9.2f %9.2f %9.2f %6d' % (
+            '%s (simulated)' % name, stats['requests'], stats['throughput'], latency['mean'], latency['p50'],
+            latency['p95'], latency['p99'], stats['errors']))
+    return '\n'.join(lines)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(__file__)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_report(result, **meta):
+    """附加运行环境信息，便于比较不同提交的结果"""
+    meta.update(timestamp=datetime.utcnow().isoformat() + 'Z', revision=_git_revision(),
+                python=platform.python_version())
+    return dict(result, meta=meta)
+
+
+def format_report(report):
+    """以文本表格输出报告"""
+    header = '%-26s %8s %8s %9s %9s %9s %9s %8s %6s' % ('endpoint', 'requests', 'req/s', 'mean ms', 'p50 ms',
+                                                     'p95 ms', 'p99 ms', 'queries', 'errors')
+    lines = [header, '-' * len(header)]
+    rows = sorted(report['endpoints'].items()) + [('TOTAL', report['total'])]
+    for name, stats in rows:
+        latency = stats['latency_ms']
+        lines.append('%-26s %8d %8.1f %9.2f %9.2f %9.2f %9.2f %8.1f %6d' % (
+            name, stats['requests'], stats['throughput'], latency['mean'], latency['p50'], latency['p95'],
+            latency['p99'], stats['queries_per_request'], stats['errors']))
+    return '\n'.join(lines)
+
+
+def save_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
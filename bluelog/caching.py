@@ -0,0 +1,273 @@
+import hashlib
+import threading
+import time
+import uuid
+
+from flask import current_app, request, session, g
+from flask_login import current_user
+from flask_wtf.csrf import generate_csrf
+from sqlalchemy import func
+from werkzeug.urls import url_encode
+
+from bluelog.compression import available_encodings, compress, compressible, deflate_segments, join_gzip, \
+    negotiate, set_encoded_body
+from bluelog.extensions import db, cache
+from bluelog.models import Admin, Category, Post, Link
+
+SITE_CONTEXT_KEY = 'bluelog:site-context'       # 站点级模板上下文缓存键
+FEED_VERSION_KEY = 'bluelog:feed-version'       # 订阅源和站点地图的当前版本，删除即重新生成（见feeds.py）
+ADMIN_KEY = 'bluelog:admin'                     # 管理员身份缓存键
+PAGE_KEY_PREFIX = 'bluelog:page:'               # 整页缓存键前缀
+PAGE_VERSION_PREFIX = 'bluelog:page-version:'   # 整页缓存版本键前缀，删除版本键即淘汰该标记下的所有页面
+SITE_TAG = 'site'                               # 所有页面共享的标记（侧边栏、标题等站点级内容）
+CSRF_PLACEHOLDER = b'__bluelog_csrf_token__'    # 缓存页面中CSRF令牌的占位符
+CACHED_HEADERS = ('ETag', 'Cache-Control', 'Vary')     # 随页面缓存的响应首部
+PROCESS_LOCAL_CACHES = ('SimpleCache', 'simple', 'NullCache', 'null')     # 不在工作进程之间共享的缓存后端
+
+
+def init_cache(app):
+    """初始化缓存。进程内缓存无法把失效通知到其他工作进程，非调试、非测试环境使用时记录警告"""
+    cache.init_app(app)
+    if app.config['CACHE_TYPE'] in PROCESS_LOCAL_CACHES and not (app.debug or app.testing):
+        app.logger.warning('CACHE_TYPE=%s is local to each worker process; with more than one worker, '
+                           'cache invalidation does not reach the other workers. Use RedisCache or '
+                           'MemcachedCache for multi-worker deployments.', app.config['CACHE_TYPE'])
+
+
+def _load_site_context():
+    """从数据库读取站点级模板上下文，转换为可序列化的词典以便在共享缓存中存放"""
+    admin = Admin.query.first()
+    post_counts = dict(db.session.query(Post.category_id, func.count(Post.id)).group_by(Post.category_id).all())
+    categories = [dict(id=category.id, name=category.name, post_count=post_counts.get(category.id, 0))
+                  for category in Category.query.order_by(Category.name).all()]
+    links = [dict(id=link.id, name=link.name, url=link.url)
+             for link in Link.query.order_by(Link.name).all()]
+    if admin is not None:
+        admin = dict(id=admin.id, username=admin.username, blog_title=admin.blog_title,
+                     blog_sub_title=admin.blog_sub_title, name=admin.name, about=admin.about)
+    context = dict(admin=admin, categories=categories, links=links)
+    context['site_version'] = hashlib.md5(repr(context).encode('utf-8')).hexdigest()[:8]    # 用于生成页面ETag
+    return context
+
+
+def get_site_context():
+    """返回站点级模板上下文（管理员、博文标签、外部链接），缓存命中时不查询数据库"""
+    if not current_app.config['BLUELOG_CACHE_SITE_CONTEXT']:
+        return _load_site_context()
+    context = cache.get(SITE_CONTEXT_KEY)
+    if context is None:
+        context = _load_site_context()
+        cache.set(SITE_CONTEXT_KEY, context, timeout=current_app.config['BLUELOG_SITE_CONTEXT_TIMEOUT'])
+    return context
+
+
+def invalidate_site_context():
+    """管理员设置、博文标签、外部链接或博文归属变化后清除站点级上下文缓存"""
+    cache.delete_many(SITE_CONTEXT_KEY, FEED_VERSION_KEY)      # 订阅源含博客标题和标签名，一并重新生成
+    evict_pages(SITE_TAG)       # 每个页面都包含侧边栏和博客标题，整页缓存随之失效
+
+
+def csrf_etag(etag):
+    """含表单的页面的ETag：加入会话中的CSRF令牌和时间段。浏览器缓存的页面中的令牌在签发后
+    WTF_CSRF_TIME_LIMIT秒过期，只在签发后的前一半时间内返回304，之后重新渲染页面、签发新令牌"""
+    generate_csrf()         # 确保会话中已有令牌，渲染前后计算的ETag相同
+    time_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    bucket = int(time.time() // (time_limit / 2.0)) if time_limit else 0
+    token = session.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    return hashlib.md5(('%s|%s|%d' % (etag, token, bucket)).encode('utf-8')).hexdigest()
+
+
+def load_admin(user_id):
+    """flask-login的user_loader：缓存命中时不查询数据库。返回的管理员不在数据库会话中（不含密码散列值），
+    修改管理员信息时须重新查询"""
+    if not current_app.config['BLUELOG_CACHE_ADMIN']:
+        return Admin.query.get(user_id)
+    data = cache.get(ADMIN_KEY)
+    if data is None or data['id'] != user_id:
+        admin = Admin.query.get(user_id)
+        if admin is None:
+            return None
+        data = dict((column.key, getattr(admin, column.key)) for column in Admin.__table__.columns
+                    if column.key != 'password_hash')
+        cache.set(ADMIN_KEY, data, timeout=current_app.config['BLUELOG_ADMIN_CACHE_TIMEOUT'])
+    return Admin(**data)
+
+
+def invalidate_admin():
+    """管理员设置或未审核评论数变化后（提交之后）清除管理员缓存"""
+    cache.delete(ADMIN_KEY)
+
+
+class _RenderLocks(object):
+    """按缓存键分配的进程内锁，同一键的并发未命中只渲染一次"""
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._locks = {}        # 键 -> [锁, 引用计数]
+
+    def acquire(self, key, timeout):
+        with self._mutex:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        if entry[0].acquire(timeout=timeout):
+            return True
+        self._unref(key)
+        return False
+
+    def release(self, key):
+        self._locks[key][0].release()
+        self._unref(key)
+
+    def _unref(self, key):
+        with self._mutex:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+
+_render_locks = _RenderLocks()
+
+
+def page_tags(endpoint, view_args):
+    """返回页面所属的缓存标记，不可缓存的端点返回None"""
+    if endpoint == 'blog.index':
+        return [SITE_TAG, 'index']
+    if endpoint == 'blog.about':
+        return [SITE_TAG, 'about']
+    if endpoint == 'blog.show_post':
+        return [SITE_TAG, 'post:%d' % view_args['post_id']]
+    if endpoint == 'blog.show_category':
+        return [SITE_TAG, 'category:%d' % view_args['category_id']]
+    return None
+
+
+def _page_versions(tags):
+    """读取各标记的当前版本，不存在时生成新版本"""
+    keys = [PAGE_VERSION_PREFIX + tag for tag in tags]
+    versions = cache.get_many(*keys)
+    for i, version in enumerate(versions):
+        if version is None:
+            versions[i] = uuid.uuid4().hex[:8]
+            cache.set(keys[i], versions[i], timeout=0)
+    return versions
+
+
+def evict_pages(*tags):
+    """淘汰指定标记下的所有缓存页面"""
+    for tag in tags:        # 不用delete_many：部分后端遇到不存在的键会提前停止
+        cache.delete(PAGE_VERSION_PREFIX + tag)
+
+
+def evict_post_pages(post, *category_ids):
+    """博文或其已审核评论变化后，淘汰博文页、所属（及原属）标签页和首页"""
+    category_ids = set(category_ids)
+    category_ids.add(post.category_id)
+    evict_pages('index', 'post:%d' % post.id, *['category:%d' % id for id in category_ids if id is not None])
+
+
+def _page_cache_key():
+    """按URL、查询参数和主题Cookie生成整页缓存键"""
+    tags = page_tags(request.endpoint, request.view_args)
+    if tags is None:
+        return None
+    variant = '%s?%s|%s' % (request.path, url_encode(sorted(request.args.items(multi=True))),
+                            request.cookies.get('theme', 'perfect_blue'))
+    return '%s%s:%s' % (PAGE_KEY_PREFIX, ':'.join(_page_versions(tags)),
+                        hashlib.md5(variant.encode('utf-8')).hexdigest())
+
+
+def _page_cacheable():
+    """只缓存匿名读者的GET请求，待显示的闪现消息会写入页面，也不缓存"""
+    return (current_app.config['BLUELOG_CACHE_PAGES'] and request.method == 'GET'
+            and '_flashes' not in session and not current_user.is_authenticated)
+
+
+def _compress_page(body):
+    """生成缓存页面的压缩版本。gzip按CSRF占位符分段压缩，发送时插入令牌后拼接；
+    brotli无法拼接，只为不含令牌的页面生成"""
+    segments = body.split(CSRF_PLACEHOLDER)
+    compressed = dict(gzip=deflate_segments(segments))
+    if 'br' in available_encodings() and len(segments) == 1:
+        compressed['br'] = compress(body, 'br')
+    return compressed
+
+
+def _send_compressed(response, cached, token):
+    """按Accept-Encoding使用缓存的压缩版本，不必每次命中都重新压缩"""
+    compressed = cached.get('compressed')
+    if not compressed or not current_app.config['BLUELOG_COMPRESSION']:
+        return
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate([encoding for encoding in available_encodings() if encoding in compressed])
+    if encoding == 'br':
+        set_encoded_body(response, compressed['br'], encoding)
+    elif encoding == 'gzip':
+        data = join_gzip(cached['body'].split(CSRF_PLACEHOLDER), compressed['gzip'], token or b'')
+        set_encoded_body(response, data, encoding)
+
+
+def _build_cached_response(cached):
+    body = cached['body']
+    token = None
+    if CSRF_PLACEHOLDER in body:
+        token = generate_csrf().encode('utf-8')
+        body = body.replace(CSRF_PLACEHOLDER, token)
+    response = current_app.response_class(body, status=cached['status'], mimetype=cached['mimetype'],
+                                          headers=cached['headers'])
+    if token is not None and cached.get('etag'):        # 含表单的页面按本会话的令牌重新计算ETag
+        response.set_etag(csrf_etag(cached['etag']), weak=True)
+    _send_compressed(response, cached, token)
+    return response.make_conditional(request)      # 缓存命中时同样响应条件请求
+
+
+def load_cached_page():
+    """在before_request中调用：命中时返回缓存的响应；未命中时持有渲染锁，等待after_request写入缓存"""
+    if page_tags(request.endpoint, request.view_args) is None:     # 先排除静态文件等，不访问会话（避免Vary: Cookie）
+        return None
+    if not _page_cacheable():
+        return None
+    key = _page_cache_key()
+    if key is None:
+        return None
+    cached = cache.get(key)
+    if cached is None:
+        locked = _render_locks.acquire(key, current_app.config['BLUELOG_PAGE_CACHE_LOCK_TIMEOUT'])
+        cached = cache.get(key)         # 等待期间其他线程可能已渲染完成
+        if cached is not None:
+            if locked:
+                _render_locks.release(key)
+            return _build_cached_response(cached)
+        g.page_cache_key = key
+        g.page_cache_locked = locked
+        return None
+    return _build_cached_response(cached)
+
+
+def store_cached_page(response):
+    """在after_request中调用：将未命中时渲染的页面写入缓存，CSRF令牌替换为占位符。
+    启用压缩时一并缓存压缩版本，本次响应也直接使用它（须在compress_response之前调用）"""
+    key = g.get('page_cache_key')
+    if key is None or response.status_code != 200 or response.direct_passthrough:
+        return response
+    body = response.get_data()
+    token = g.get(current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token'))
+    if token:
+        token = token.encode('utf-8')
+        body = body.replace(token, CSRF_PLACEHOLDER)
+    headers = [(name, response.headers[name]) for name in CACHED_HEADERS if name in response.headers]
+    if CSRF_PLACEHOLDER in body:    # 本次响应的ETag含渲染者的令牌，不能发给其他读者，只缓存与会话无关的部分
+        headers = [(name, value) for name, value in headers if name != 'ETag']
+    cached = dict(body=body, status=response.status_code, mimetype=response.mimetype, headers=headers,
+                  etag=g.get('page_etag'))
+    if compressible(response):
+        cached['compressed'] = _compress_page(body)
+        _send_compressed(response, cached, token)
+    cache.set(key, cached, timeout=current_app.config['BLUELOG_PAGE_CACHE_TIMEOUT'])
+    return response
+
+
+def release_page_lock():
+    """在teardown_request中调用：释放渲染锁（包括渲染出错的情况）"""
+    if g.pop('page_cache_locked', False):
+        _render_locks.release(g.pop('page_cache_key'))
@@ -0,0 +1,87 @@
+import gzip
+import struct
+import zlib
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:     # 未安装brotli时只使用gzip
+    brotli = None
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'     # 无文件名、修改时间为0的gzip首部
+
+
+def available_encodings():
+    """按优先顺序返回支持的压缩编码"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate(encodings):
+    """按Accept-Encoding从encodings中选择压缩编码，客户端不接受时返回None"""
+    for encoding in encodings:
+        if request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def compress(data, encoding):
+    config = current_app.config
+    if encoding == 'br':
+        return brotli.compress(data, quality=config['BLUELOG_COMPRESSION_BROTLI_QUALITY'])
+    return gzip.compress(data, config['BLUELOG_COMPRESSION_GZIP_LEVEL'], mtime=0)
+
+
+def compressible(response):
+    """只压缩成功的、尚未编码的文本类响应；流式响应和小于阈值的响应不压缩"""
+    config = current_app.config
+    return (config['BLUELOG_COMPRESSION'] and response.status_code == 200 and not response.direct_passthrough
+            and not response.is_streamed and 'Content-Encoding' not in response.headers
+            and response.mimetype in config['BLUELOG_COMPRESSION_MIMETYPES']
+            and response.calculate_content_length() >= config['BLUELOG_COMPRESSION_MIN_SIZE'])
+
+
+def set_encoded_body(response, data, encoding):
+    """替换为压缩后的响应体。压缩后字节不同，强ETag改为弱ETag"""
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    """在after_request中调用：按Accept-Encoding压缩响应，缓存命中时已使用缓存的压缩版本"""
+    if not compressible(response):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate(available_encodings())
+    if encoding is not None:
+        set_encoded_body(response, compress(response.get_data(), encoding), encoding)
+    return response
+
+
+def deflate_segments(segments):
+    """把各片段分别压缩为原始deflate数据，命中时在片段之间插入每个请求不同的内容（CSRF令牌）后拼接成gzip。
+    各片段独立压缩且以同步刷新结束（字节对齐），只有最后一段带结束标记，拼接结果是合法的deflate流"""
+    level = current_app.config['BLUELOG_COMPRESSION_GZIP_LEVEL']
+    compressed = []
+    for i, segment in enumerate(segments):
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        flush = zlib.Z_FINISH if i == len(segments) - 1 else zlib.Z_SYNC_FLUSH
+        compressed.append(compressor.compress(segment) + compressor.flush(flush))
+    return compressed
+
+
+def join_gzip(segments, compressed, separator):
+    """用separator连接预压缩的片段，返回完整的gzip数据；separator只有几十字节，按存储块写入"""
+    compressor = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+    stored = compressor.compress(separator) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    crc, size = 0, 0
+    for i, segment in enumerate(segments):
+        if i:
+            crc = zlib.crc32(separator, crc)
+            size += len(separator)
+        crc = zlib.crc32(segment, crc)
+        size += len(segment)
+    return b''.join([GZIP_HEADER, stored.join(compressed), struct.pack('<II', crc & 0xffffffff, size & 0xffffffff)])
@@ -0,0 +1,69 @@
+import sqlite3
+
+from flask import current_app, g, has_app_context, request
+from flask_login import current_user
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql import Select
+
+REPLICA_BIND = 'replica'        # 只读副本在SQLALCHEMY_BINDS中的键
+_listening = False
+
+
+class RoutingSession(SignallingSession):
+    """请求标记了只读时，把查询路由到只读副本；写入（flush、UPDATE、DELETE、原始SQL）始终使用主库"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_app_context() and g.get('use_replica') and not self._flushing and isinstance(clause, Select):
+            return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """使用RoutingSession的SQLAlchemy扩展"""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def _configure_sqlite(dbapi_connection, connection_record):
+    """SQLite连接：开启WAL（读写互不阻塞）并设置忙等待时间，避免评论写入时读者立即报database is locked"""
+    if not isinstance(dbapi_connection, sqlite3.Connection) or not has_app_context():
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA busy_timeout = %d' % (current_app.config['BLUELOG_SQLITE_BUSY_TIMEOUT'] * 1000))
+    if current_app.config['BLUELOG_SQLITE_WAL']:
+        cursor.execute('PRAGMA journal_mode = WAL')     # 内存数据库不支持WAL，保持memory模式
+        cursor.execute('PRAGMA synchronous = NORMAL')   # WAL模式下NORMAL即可保证一致性
+    cursor.close()
+
+
+def configure_database(app):
+    """按BLUELOG_DB_*设置连接池（SQLite不使用连接池参数），配置只读副本，在db.init_app之前调用"""
+    global _listening
+    options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    options.setdefault('pool_pre_ping', app.config['BLUELOG_DB_POOL_PRE_PING'])
+    if not app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        options.setdefault('pool_size', app.config['BLUELOG_DB_POOL_SIZE'])
+        options.setdefault('max_overflow', app.config['BLUELOG_DB_MAX_OVERFLOW'])
+        options.setdefault('pool_recycle', app.config['BLUELOG_DB_POOL_RECYCLE'])
+        options.setdefault('pool_timeout', app.config['BLUELOG_DB_POOL_TIMEOUT'])
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    if app.config['BLUELOG_DATABASE_REPLICA_URL']:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[REPLICA_BIND] = app.config['BLUELOG_DATABASE_REPLICA_URL']
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+    if not _listening:
+        event.listen(Engine, 'connect', _configure_sqlite)
+        _listening = True
+
+
+def use_replica():
+    """在蓝本的before_request中调用：匿名读者的GET请求从只读副本读取。
+    登录的管理员会写入数据，仍读主库，避免复制延迟导致看不到刚做的修改"""
+    if (REPLICA_BIND in (current_app.config.get('SQLALCHEMY_BINDS') or {})
+            and request.method in ('GET', 'HEAD') and not current_user.is_authenticated):
+        g.use_replica = True
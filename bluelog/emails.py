@@ -1,22 +1,137 @@
-from threading import Thread
+import time
+from datetime import datetime, timedelta
+from threading import Thread, Event, Lock
 
 from flask import url_for, current_app
-from flask_mail import Message
 
-from bluelog.extensions import mail
+from bluelog.extensions import db, get_mail
+from bluelog.models import OutboxMessage
 
+_worker = None              # 进程内唯一的发件线程
+_worker_lock = Lock()
+_worker_wakeup = Event()    # 入队后唤醒发件线程
 
-def _send_async_mail(app, message):
-    with app.app_context():
-        mail.send(message)
 
+def _claim_due_messages(batch_size):
+    """领取到期的待发送邮件：把next_attempt_at推迟为租约，条件更新成功才算领取，避免多个进程重复发送"""
+    now = datetime.utcnow()
+    lease = now + timedelta(seconds=current_app.config['BLUELOG_MAIL_LEASE'])
+    candidates = OutboxMessage.query.filter(
+        OutboxMessage.sent_at.is_(None),
+        OutboxMessage.next_attempt_at <= now,
+        OutboxMessage.attempts < current_app.config['BLUELOG_MAIL_MAX_ATTEMPTS']
+    ).order_by(OutboxMessage.next_attempt_at).limit(batch_size).all()
+    claimed = []
+    for message in candidates:
+        updated = OutboxMessage.query.filter_by(id=message.id, next_attempt_at=message.next_attempt_at).update(
+            {OutboxMessage.next_attempt_at: lease}, synchronize_session=False)
+        if updated:
+            claimed.append(message)
+    db.session.commit()
+    return claimed
 
-def send_mail(subject, to, html):
+
+def _schedule_retry(message, error):
+    """发送失败后按指数退避安排重试"""
+    message.attempts += 1
+    message.last_error = str(error)
+    delay = current_app.config['BLUELOG_MAIL_RETRY_BACKOFF'] * 2 ** (message.attempts - 1)
+    message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+
+
+def deliver_outbox(batch_size=None):
+    """批量发送到期的邮件，每批复用一个SMTP连接，返回成功发送的数量"""
+    batch_size = batch_size or current_app.config['BLUELOG_MAIL_BATCH_SIZE']
+    messages = _claim_due_messages(batch_size)
+    if not messages:
+        return 0
+    sent = 0
+    pending = list(messages)
+    try:
+        from flask_mail import Message
+        with get_mail().connect() as connection:
+            while pending:
+                message = pending[0]
+                subject = message.subject
+                if message.count > 1:
+                    subject = '%s (%d)' % (subject, message.count)
+                try:
+                    connection.send(Message(subject, recipients=[message.recipient], html=message.html))
+                except Exception as e:      # 单封失败不影响同批其他邮件
+                    _schedule_retry(message, e)
+                else:
+                    message.sent_at = datetime.utcnow()
+                    sent += 1
+                pending.pop(0)
+    except Exception as e:                  # 连接失败，本批未发送的邮件全部稍后重试
+        for message in pending:
+            _schedule_retry(message, e)
+        current_app.logger.warning('Mail delivery failed: %s' % e)
+    db.session.commit()
+    return sent
+
+
+def _run_worker(app):
+    """发件线程：被唤醒或轮询超时后发送所有到期邮件"""
+    while True:
+        _worker_wakeup.wait(app.config['BLUELOG_MAIL_POLL_INTERVAL'])
+        _worker_wakeup.clear()
+        with app.app_context():
+            try:
+                while deliver_outbox():
+                    pass
+            except Exception:
+                app.logger.exception('Mail worker error')
+            finally:
+                db.session.remove()
+
+
+def _wake_worker():
+    """按需启动进程内发件线程并唤醒；未启用时由flask mail-worker命令发送"""
+    global _worker
     app = current_app._get_current_object()
-    message = Message(subject, recipients=[to], html=html)
-    thr = Thread(target=_send_async_mail, args=[app, message])
-    thr.start()
-    return thr
+    if not app.config['BLUELOG_MAIL_BACKGROUND']:
+        return
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = Thread(target=_run_worker, args=[app], name='bluelog-mail-worker', daemon=True)
+            _worker.start()
+    _worker_wakeup.set()
+
+
+def run_mail_worker(once=False):
+    """flask mail-worker使用：循环发送发件箱中的邮件"""
+    while True:
+        while deliver_outbox():
+            pass
+        if once:
+            return
+        time.sleep(current_app.config['BLUELOG_MAIL_POLL_INTERVAL'])
+
+
+def send_mail(subject, to, html, coalesce_key=None):
+    """邮件入队；coalesce_key相同且在合并窗口内尚未发送的邮件合并为一封"""
+    if coalesce_key is not None:
+        window_start = datetime.utcnow() - timedelta(seconds=current_app.config['BLUELOG_MAIL_COALESCE_WINDOW'])
+        pending = OutboxMessage.query.filter(
+            OutboxMessage.coalesce_key == coalesce_key,
+            OutboxMessage.sent_at.is_(None),
+            OutboxMessage.attempts == 0,
+            OutboxMessage.timestamp >= window_start
+        ).first()
+        if pending is not None:
+            OutboxMessage.query.filter_by(id=pending.id).update(
+                {OutboxMessage.count: OutboxMessage.count + 1}, synchronize_session=False)   # 原子递增
+            db.session.commit()
+            return pending
+    message = OutboxMessage(subject=subject, recipient=to, html=html, coalesce_key=coalesce_key)
+    if coalesce_key is not None:        # 推迟到窗口结束再发送，以便合并后续通知
+        message.next_attempt_at = datetime.utcnow() + timedelta(
+            seconds=current_app.config['BLUELOG_MAIL_COALESCE_WINDOW'])
+    db.session.add(message)
+    db.session.commit()
+    _wake_worker()
+    return message
 
 
 def send_new_comment_email(post):
@@ -25,7 +140,8 @@ def send_new_comment_email(post):
               html='<p>New comment in post <i>%s</i>, click the link below to check:</p>'
                    '<p><a href="%s">%s</a></P>'
                    '<p><small style="color: #868e96">Do not reply this email.</small></p>'
-                   % (post.title, post_url, post_url))
+                   % (post.title, post_url, post_url),
+              coalesce_key='new-comment:%d' % post.id)
 
 
 def send_new_reply_email(comment):
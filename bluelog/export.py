@@ -0,0 +1,225 @@
+import gzip
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+from urllib.parse import urlsplit
+
+from flask import current_app, request, template_rendered, url_for
+from sqlalchemy import or_
+
+from bluelog.caching import get_site_context
+from bluelog.extensions import db
+from bluelog.models import Category, Comment, Post
+
+# 导出目录按主题分开，每个页面一个文件：/post/1 -> <主题>/post/1/index.html，
+# /post/1?after=<游标> -> <主题>/post/1/after=<游标>.html，另有同名.gz供gzip_static使用。nginx示例：
+#
+#   map $cookie_theme $bluelog_theme { default perfect_blue; black_swan black_swan; }
+#   location / {
+#       error_page 418 = @bluelog;
+#       if ($request_method !~ ^(GET|HEAD)$) { return 418; }     # 发表评论等写操作
+#       if ($cookie_session) { return 418; }                     # 管理员和有闪现消息的读者
+#       set $page index;
+#       if ($args) { set $page $args; }
+#       root /srv/bluelog-export;
+#       gzip_static on;
+#       try_files /$bluelog_theme$uri/$page.html @bluelog;       # 未导出的页面（搜索、回复等）由应用处理
+#   }
+#   location @bluelog {
+#       proxy_pass http://127.0.0.1:8000;
+#       proxy_set_header Host $host;
+#       proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+#       proxy_set_header X-Forwarded-Proto $scheme;
+#   }
+#
+# 应用位于一层nginx之后，启动时设置BLUELOG_PROXY_COUNT=1，请求频率限制（BLUELOG_RATE_LIMIT=true）和
+# 评论过滤才能从X-Forwarded-For取得读者IP；未设置时所有读者都显示为127.0.0.1，共用同一份限额
+
+STATE_FILE = '.bluelog-export.json'     # 上次导出的时间和站点版本，用于增量导出
+EXPORT_CONFIG = dict(BLUELOG_STATIC_EXPORT=True, BLUELOG_CACHE_PAGES=False, BLUELOG_COMPRESSION=False,
+                     BLUELOG_PROFILER_SAMPLE_RATE=0, BLUELOG_RATE_LIMIT=False)
+WINDOW = 4                              # 每个工作进程最多排队的页面数
+
+_app = None                             # 渲染页面的应用（工作进程中各自创建）
+
+
+def page_path(url):
+    """URL对应的导出文件（相对于主题目录），无法映射为文件名的URL返回None"""
+    parts = urlsplit(url)
+    name = parts.query or 'index'
+    if '/' in name or name.startswith('.'):
+        return None
+    return os.path.join(parts.path.strip('/'), name + '.html')
+
+
+def _pagination_links(pagination):
+    """在模板渲染信号中调用（请求上下文内）：返回页面中分页链接指向的URL"""
+    if pagination is None:
+        return []
+    if getattr(pagination, 'keyset', False):
+        return [url for url in (pagination.first_url(), pagination.last_url(), pagination.prev_url(),
+                                pagination.next_url()) if url]
+    return [url_for(request.endpoint, page=page, **request.view_args) for page in range(1, (pagination.pages or 1) + 1)]
+
+
+def _write(path, data):
+    """内容变化时写入文件，先写临时文件再替换，nginx不会读到写了一半的文件。
+    内容未变时不改写，保留修改时间（nginx据此生成ETag和Last-Modified）"""
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            if f.read() == data:
+                return False
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.replace(path + '.tmp', path)
+    return True
+
+
+def _init_worker(config_name, overrides):
+    global _app
+    from bluelog import create_app
+    _app = create_app(config_name)
+    _app.config.update(overrides)
+
+
+def _render(task):
+    """渲染一个页面并写入导出目录，返回（主题, 文件路径, 分页链接），页面不存在时文件路径为None"""
+    theme, url, output = task
+    links = []
+
+    def collect_links(sender, template, context, **extra):
+        links.extend(_pagination_links(context.get('pagination')))
+
+    with template_rendered.connected_to(collect_links, _app):
+        response = _app.test_client(use_cookies=False).get(url, headers={'Cookie': 'theme=' + theme})
+    name = page_path(url)
+    if response.status_code != 200 or name is None:
+        return theme, None, links
+    path = os.path.join(output, theme, name)
+    data = response.get_data()
+    if _write(path, data) or not os.path.isfile(path + '.gz'):
+        _write(path + '.gz', gzip.compress(data, 9, mtime=0))
+    return theme, path, links
+
+
+def _crawl(tasks, output, workers, config_name, progress):
+    """渲染起始页面及其分页链接指向的所有页面，返回写入的文件路径集合。
+    workers大于1时在进程池中渲染，每个工作进程创建自己的应用和数据库连接"""
+    seen = set(tasks)
+    pending = deque(tasks)
+    written = set()
+
+    def handle(result):
+        theme, path, links = result
+        if path is not None:
+            written.add(path)
+        for link in links:
+            if (theme, link) not in seen:
+                seen.add((theme, link))
+                pending.append((theme, link))
+        if progress is not None:
+            progress(1)
+
+    if workers <= 1:
+        global _app
+        _app = current_app._get_current_object()
+        saved = dict((key, _app.config.get(key)) for key in EXPORT_CONFIG)
+        _app.config.update(EXPORT_CONFIG)
+        try:
+            while pending:
+                handle(_render(pending.popleft() + (output,)))
+        finally:
+            _app.config.update(saved)
+        return written
+
+    overrides = dict(EXPORT_CONFIG, SQLALCHEMY_DATABASE_URI=current_app.config['SQLALCHEMY_DATABASE_URI'])
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(config_name, overrides)) as executor:
+        futures = set()
+        while pending or futures:
+            while pending and len(futures) < workers * WINDOW:
+                futures.add(executor.submit(_render, pending.popleft() + (output,)))
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                handle(future.result())
+    return written
+
+
+def _all_urls():
+    """全量导出的起始页面：首页、关于、所有标签页和博文页（分页由渲染时发现）"""
+    urls = [url_for('blog.index'), url_for('blog.about')]
+    urls.extend(url_for('blog.show_category', category_id=id) for id, in db.session.query(Category.id))
+    urls.extend(url_for('blog.show_post', post_id=id) for id, in db.session.query(Post.id))
+    return urls
+
+
+def _changed_urls(since):
+    """增量导出的起始页面：上次导出后修改过或有新评论的博文，以及列出它们的首页和标签页。
+    删除博文和修改设置、标签、链接会改变站点版本，此时全量导出"""
+    commented = db.session.query(Comment.post_id).filter(Comment.timestamp > since)
+    rows = db.session.query(Post.id, Post.category_id).filter(
+        or_(Post.updated_at > since, Post.id.in_(commented))).all()
+    if not rows:
+        return []
+    urls = [url_for('blog.index')]
+    urls.extend(url_for('blog.show_category', category_id=id) for id in sorted(set(row[1] for row in rows)))
+    urls.extend(url_for('blog.show_post', post_id=row[0]) for row in rows)
+    return urls
+
+
+def _remove_stale(output, themes, written, incremental):
+    """删除本次没有生成的页面文件（分页游标随内容变化）。增量导出只清理重新渲染过的目录"""
+    if incremental:
+        directories = set(os.path.dirname(path) for path in written)
+    else:
+        directories = set(root for theme in themes for root, dirs, files in os.walk(os.path.join(output, theme)))
+    removed = 0
+    for directory in directories:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            page = path[:-3] if name.endswith('.html.gz') else path
+            if page.endswith('.html') and page not in written:
+                os.remove(path)
+                removed += 1
+    return removed
+
+
+def _load_state(output):
+    try:
+        with open(os.path.join(output, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _save_state(output, state):
+    with open(os.path.join(output, STATE_FILE), 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def export_site(output, workers=1, full=False, config_name=None, progress=None):
+    """把公开页面（首页、博文、标签、关于及其分页）按每个主题导出为静态文件。
+    上次导出后站点版本、静态文件清单和主题都没有变化时只导出受影响的页面，模板修改后应使用full。
+    返回（是否增量, 渲染的页面数, 删除的文件数）。progress(1)在每个页面渲染后调用"""
+    started = datetime.utcnow()     # 在读取数据之前记录，导出期间的修改留给下次
+    themes = sorted(current_app.config['BLUELOG_THEMES'])
+    assets = json.dumps(current_app.extensions['bluelog_assets'], sort_keys=True)
+    state = dict(site_version=get_site_context()['site_version'], themes=themes,
+                 assets_version=hashlib.md5(assets.encode('utf-8')).hexdigest()[:10])
+    previous = _load_state(output)
+    incremental = not full and previous is not None and all(previous.get(key) == value
+                                                            for key, value in state.items())
+    with current_app.test_request_context():
+        if incremental:
+            urls = _changed_urls(datetime.strptime(previous['exported_at'], '%Y-%m-%dT%H:%M:%S.%f'))
+        else:
+            urls = _all_urls()
+    tasks = [(theme, url) for theme in themes for url in urls]
+    written = _crawl(tasks, output, workers, config_name or os.getenv('FLASK_CONFIG', 'development'), progress)
+    removed = _remove_stale(output, themes, written, incremental)
+    os.makedirs(output, exist_ok=True)
+    _save_state(output, dict(state, exported_at=started.strftime('%Y-%m-%dT%H:%M:%S.%f')))
+    return incremental, len(written), removed
@@ -1,29 +1,49 @@
+import os
+
+from flask import current_app
 from flask_bootstrap import Bootstrap
+from flask_caching import Cache
 from flask_ckeditor import CKEditor
 from flask_login import LoginManager
-from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_wtf import CSRFProtect
-from flask_debugtoolbar import DebugToolbarExtension
-from flask_migrate import Migrate
+
+from bluelog.database import RoutingSQLAlchemy
 
 bootstrap = Bootstrap()             # bootstrap实例
-db = SQLAlchemy()                   # 数据模型实例
+db = RoutingSQLAlchemy()            # 数据模型实例，匿名读者的查询可路由到只读副本
 login_manager = LoginManager()
 csrf = CSRFProtect()
 ckeditor = CKEditor()
-mail = Mail()
 moment = Moment()
-toolbar = DebugToolbarExtension()
-migrate = Migrate()
+cache = Cache()                     # 缓存实例
 
 @login_manager.user_loader
 def load_user(user_id):
-    """加载管理员"""
-    from bluelog.models import Admin
-    user = Admin.query.get(int(user_id))
-    return user
+    """加载管理员（可缓存）"""
+    from bluelog.caching import load_admin
+    return load_admin(int(user_id))
+
+def init_debug_toolbar(app):
+    """调试工具栏只在开发时导入和启用"""
+    from flask_debugtoolbar import DebugToolbarExtension
+    DebugToolbarExtension(app)
+
+
+def init_migrate(app):
+    """数据库迁移只用于flask db命令，Web工作进程不导入Flask-Migrate（及alembic）。
+    迁移脚本在项目根目录的migrations中，不依赖执行命令时的当前目录"""
+    from flask_migrate import Migrate
+    Migrate(app, db, directory=os.path.join(os.path.dirname(app.root_path), 'migrations'), render_as_batch=True)
+
+
+def get_mail():
+    """返回Flask-Mail的状态对象，第一次发送邮件时才导入Flask-Mail并读取邮件设置"""
+    state = current_app.extensions.get('mail')
+    if state is None:
+        from flask_mail import Mail
+        state = Mail().init_app(current_app._get_current_object())
+    return state
 
 login_manager.login_view = 'auth.login'
 login_manager.login_message_category = 'warning'
\ No newline at end of file
@@ -1,12 +1,36 @@
 import random
+from collections import deque
+from datetime import datetime, timedelta
+from multiprocessing import Pool
 
-from faker import Faker
-from sqlalchemy.exc import IntegrityError
+from flask import current_app
 # from bluelog import db
 from bluelog.extensions import db
 from bluelog.models import Admin, Category, Post, Comment, Link
 
-fake = Faker('zh_CN')
+
+class _LazyFaker(object):
+    """首次使用时才导入faker并创建实例（导入faker及其语言数据较慢）"""
+    _instance = None
+
+    def __getattr__(self, name):
+        if self._instance is None:
+            from faker import Faker
+            self._instance = Faker('zh_CN')
+        return getattr(self._instance, name)
+
+
+fake = _LazyFaker()
+
+ADMIN_NAME = '米玛· 基里戈'
+ADMIN_COMMENT_RATIO = 0.05      # 管理员评论的比例
+RECENT_PARENTS = 5              # 回复只针对同一博文最近的几条已审核评论，形成回复链
+
+
+def seed_fakes(seed):
+    """设置随机种子，相同种子生成相同的数据"""
+    random.seed(seed)
+    fake.seed_instance(seed)
 
 
 def fake_admin():
@@ -15,7 +39,7 @@ def fake_admin():
         username='admin',
         blog_title='管理员的博文',
         blog_sub_title="只是，我是虚拟的。",
-        name='米玛· 基里戈',
+        name=ADMIN_NAME,
         about='米玛· 基里戈的About...'
     )
     admin.set_password('helloflask')
@@ -24,89 +48,148 @@ def fake_admin():
 
 
 def fake_categories(count=10):
-    """生成虚拟博文标签10项"""
-    category = Category(name='默认标签')     # 创建默认标签
-    db.session.add(category)
-
-    for i in range(count):
-        category = Category(name=fake.word())   # 创建虚拟标签
-        db.session.add(category)
-        try:                                    # 防止出现重复标签名称
-            db.session.commit()
-        except IntegrityError:
-            db.session.rollback()
-
-
-def fake_posts(count=50):
-    """生成虚拟博文50篇"""
-    for i in range(count):
-        post = Post(
-            title=fake.sentence(),
-            body=fake.text(2000),
-            category=Category.query.get(random.randint(1, Category.query.count())),     # 随机标签
-            timestamp=fake.date_time_this_year()
-        )
-
-        db.session.add(post)
+    """生成虚拟博文标签10项，名称去重后一次批量插入"""
+    names = ['默认标签']       # 默认标签
+    for i in range(count * 10):                 # 词库有限，多试几次凑足不重复的名称
+        if len(names) > count:
+            break
+        name = fake.word()
+        if name not in names:
+            names.append(name)
+    db.session.execute(Category.__table__.insert(), [dict(name=name) for name in names])
     db.session.commit()
 
 
-def fake_comments(count=500):
-    """生成虚拟评论500篇"""
-    for i in range(count):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))
-        )
-        db.session.add(comment)
-
-    salt = int(count * 0.1)     # 添加特殊评论 各50条
-    for i in range(salt):
-        # 添加未审核评论50篇
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=False,                             # 未审核标记
-            post=Post.query.get(random.randint(1, Post.query.count()))      # 随机确定被评论博文
-        )
-        db.session.add(comment)
-
-        # 添加管理员发表的评论50篇
-        comment = Comment(
-            author='米玛· 基里戈',
-            email='mima@example.com',
-            site='example.com',
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            from_admin=True,                        # 来自管理员
-            reviewed=True,
-            post=Post.query.get(random.randint(1, Post.query.count()))      # 随机确定被评论博文
-        )
-        db.session.add(comment)
+def _generate_chunk(task):
+    """生成一批博文及其评论（纯数据，可在工作进程中运行）。
+    按（种子, 批号）播种，结果与工作进程数无关；评论id从0开始编号，由主进程加上偏移"""
+    seed, index, first_post_id, post_count, comment_count, category_ids, now, options = task
+    rng = random.Random('%s:%d' % (seed, index))
+    fake.seed_instance('%s:%d' % (seed, index))
+
+    weights = [rng.expovariate(1) for i in range(post_count)]      # 评论数在博文间的分布不均匀
+    per_post = [0] * post_count
+    for i in rng.choices(range(post_count), weights, k=comment_count):
+        per_post[i] += 1
+
+    posts, comments = [], []
+    for i in range(post_count):
+        timestamp = now - timedelta(seconds=rng.uniform(0, 365 * 24 * 3600))
+        body = fake.text(2000)
+        excerpt, word_count, reading_time = Post.summarize(
+            body, options['excerpt_length'], options['reading_speed'])
+        post_id = first_post_id + i
+        reviewed_count = 0
+        parents = []                            # 本博文的已审核评论，可被回复
+        comment_time = timestamp
+        for j in range(per_post[i]):
+            comment_time = min(comment_time + timedelta(seconds=rng.expovariate(1 / 21600.0)), now)
+            from_admin = rng.random() < ADMIN_COMMENT_RATIO
+            reviewed = from_admin or rng.random() < options['reviewed_ratio']
+            replied_id = None
+            if parents and rng.random() < options['reply_ratio']:
+                replied_id = rng.choice(parents[-RECENT_PARENTS:])
+            comment_id = len(comments)
+            if reviewed:
+                reviewed_count += 1
+                parents.append(comment_id)
+            comments.append(dict(
+                id=comment_id,
+                author=ADMIN_NAME if from_admin else fake.name(),
+                email='mima@example.com' if from_admin else fake.email(),
+                site='example.com' if from_admin else fake.url(),
+                body=fake.sentence(),
+                timestamp=comment_time,
+                from_admin=from_admin,
+                reviewed=reviewed,
+                replied_id=replied_id,
+                post_id=post_id
+            ))
+        posts.append(dict(
+            id=post_id,
+            title=fake.sentence()[:60],
+            body=body,
+            excerpt=excerpt,
+            word_count=word_count,
+            reading_time=reading_time,
+            timestamp=timestamp,
+            updated_at=max(timestamp, comment_time),
+            can_comment=True,
+            category_id=rng.choice(category_ids),   # 随机标签
+            comment_count=per_post[i],
+            reviewed_comment_count=reviewed_count
+        ))
+    return posts, comments
+
+
+def _run_tasks(tasks, workers):
+    """按顺序返回各批的生成结果；多进程时最多同时有workers*2批在途，内存占用与总量无关"""
+    if workers <= 1:
+        for task in tasks:
+            yield _generate_chunk(task)
+        return
+    pool = Pool(workers)
+    try:
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.apply_async(_generate_chunk, (task,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def fake_posts(count=50, comment_count=500, seed=None, workers=1, chunk_size=1000,
+               reviewed_ratio=0.9, reply_ratio=0.3, progress=None):
+    """生成虚拟博文50篇及评论500条。按chunk_size篇一批生成并批量插入、提交，
+    评论计数随数据一起生成；workers大于1时在多个进程中生成文本。progress(博文数, 评论数)在每批提交后调用"""
+    if chunk_size < 1 or workers < 1:
+        raise ValueError('chunk_size and workers must be at least 1')
+    if seed is None:
+        seed = random.randrange(1 << 32)
+    category_ids = [id for id, in db.session.query(Category.id).order_by(Category.id)]
+    first_post_id = (db.session.query(db.func.max(Post.id)).scalar() or 0) + 1
+    comment_offset = (db.session.query(db.func.max(Comment.id)).scalar() or 0) + 1
+    options = dict(excerpt_length=current_app.config['BLUELOG_EXCERPT_LENGTH'],
+                   reading_speed=current_app.config['BLUELOG_READING_SPEED'],
+                   reviewed_ratio=reviewed_ratio, reply_ratio=reply_ratio)
+    now = datetime.utcnow()
+
+    def tasks():
+        for index, start in enumerate(range(0, count, chunk_size)):
+            size = min(chunk_size, count - start)
+            comments = comment_count * (start + size) // count - comment_count * start // count
+            yield seed, index, first_post_id + start, size, comments, category_ids, now, options
+
+    for posts, comments in _run_tasks(tasks(), workers):
+        for comment in comments:
+            comment['id'] += comment_offset
+            if comment['replied_id'] is not None:
+                comment['replied_id'] += comment_offset
+        comment_offset += len(comments)
+        db.session.execute(Post.__table__.insert(), posts)
+        for i in range(0, len(comments), chunk_size):
+            db.session.execute(Comment.__table__.insert(), comments[i:i + chunk_size])
+        db.session.commit()
+        if progress is not None:
+            progress(len(posts), len(comments))
+    _sync_sequences(Post.__table__, Comment.__table__)
+    Admin.update_unread_comment_count()
     db.session.commit()
 
-    # 添加已审核的回复50篇
-    for i in range(salt):
-        comment = Comment(
-            author=fake.name(),
-            email=fake.email(),
-            site=fake.url(),
-            body=fake.sentence(),
-            timestamp=fake.date_time_this_year(),
-            reviewed=True,
-            replied=Comment.query.get(random.randint(1, Comment.query.count())),    # 随机确定被回复评论
-            post=Post.query.get(random.randint(1, Post.query.count()))              # 随机确定被回复博文
-        )
-        db.session.add(comment)
-    db.session.commit()
+
+def _sync_sequences(*tables):
+    """批量插入时显式指定了id，PostgreSQL的序列不会随之前进；调整到当前最大id，之后新建的记录不与已有id冲突"""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        db.session.execute(db.text(
+            "SELECT setval(pg_get_serial_sequence(:table, 'id'), COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) "
+            "FROM %s" % table.name), dict(table=table.name))
 
 
 def fake_links():
@@ -0,0 +1,143 @@
+import uuid
+from datetime import datetime
+
+from flask import current_app, request, stream_with_context, url_for
+from markupsafe import escape
+from werkzeug.http import is_resource_modified
+
+from bluelog.caching import FEED_VERSION_KEY, get_site_context
+from bluelog.extensions import db, cache
+from bluelog.models import Post
+
+FEED_KEY_PREFIX = 'bluelog:feed:'               # 生成结果的缓存键前缀
+CHUNK_SIZE = 64 * 1024                          # 流式响应每次发送的字节数
+YIELD_PER = 1000                                # 每次从数据库读取的行数
+
+
+def _version():
+    """返回（版本, 生成时间），不存在时生成新版本；生成时间精确到秒，用作Last-Modified"""
+    version = cache.get(FEED_VERSION_KEY)
+    if version is None:
+        version = (uuid.uuid4().hex[:12], datetime.utcnow().replace(microsecond=0))
+        cache.set(FEED_VERSION_KEY, version, timeout=0)
+    return version
+
+
+def invalidate_feeds():
+    """新建、编辑或删除博文后（提交之后）调用，订阅源和站点地图在下次请求时重新生成"""
+    cache.delete(FEED_VERSION_KEY)
+
+
+def _w3c(timestamp):
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _stream(key, chunks):
+    """把生成的文本合并成较大的块发送，发送完毕后写入缓存"""
+    sent, buffer, size = [], [], 0
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= CHUNK_SIZE:
+            data = ''.join(buffer).encode('utf-8')
+            sent.append(data)
+            yield data
+            buffer, size = [], 0
+    data = ''.join(buffer).encode('utf-8')
+    sent.append(data)
+    yield data
+    cache.set(key, b''.join(sent), timeout=current_app.config['BLUELOG_FEED_CACHE_TIMEOUT'])
+
+
+def xml_response(name, generate, *args):
+    """返回XML响应。条件请求匹配时直接返回304；缓存命中时返回缓存的内容；
+    否则调用generate(*args)逐行生成并流式发送，生成完毕后写入缓存"""
+    version, updated = _version()
+    if not is_resource_modified(request.environ, etag=version, last_modified=updated):
+        response = current_app.response_class(status=304)
+    else:
+        key = '%s%s:%s' % (FEED_KEY_PREFIX, version, name)
+        data = cache.get(key)
+        if data is None:
+            data = stream_with_context(_stream(key, generate(*args)))
+        response = current_app.response_class(data, mimetype='application/xml')
+    response.set_etag(version)
+    response.last_modified = updated
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['BLUELOG_FEED_MAX_AGE']
+    return response
+
+
+def generate_feed():
+    """Atom订阅源：最近的BLUELOG_FEED_POST_COUNT篇博文"""
+    context = get_site_context()
+    admin = context['admin'] or {}
+    index_url = url_for('blog.index', _external=True)
+    updated = db.session.query(db.func.max(Post.updated_at)).scalar() or datetime.utcnow()
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<feed xmlns="http://www.w3.org/2005/Atom">\n'
+    yield '<title>%s</title>\n<subtitle>%s</subtitle>\n' % (escape(admin.get('blog_title') or ''),
+                                                           escape(admin.get('blog_sub_title') or ''))
+    yield '<link href="%s" rel="self"/>\n<link href="%s"/>\n<id>%s</id>\n<updated>%s</updated>\n' % (
+        escape(url_for('blog.feed', _external=True)), escape(index_url), escape(index_url), _w3c(updated))
+    yield '<author><name>%s</name></author>\n' % escape(admin.get('name') or '')
+    categories = dict((category['id'], category['name']) for category in context['categories'])
+    query = Post.query.order_by(Post.timestamp.desc(), Post.id.desc()) \
+        .limit(current_app.config['BLUELOG_FEED_POST_COUNT'])
+    for post in query.yield_per(YIELD_PER):
+        url = escape(url_for('blog.show_post', post_id=post.id, _external=True))
+        yield ('<entry>\n<title>%s</title>\n<link href="%s"/>\n<id>%s</id>\n<published>%s</published>\n'
+               '<updated>%s</updated>\n<category term="%s"/>\n<summary>%s</summary>\n'
+               '<content type="html">%s</content>\n</entry>\n') % (
+            escape(post.title), url, url, _w3c(post.timestamp), _w3c(post.updated_at or post.timestamp),
+            escape(categories.get(post.category_id, '')), escape(post.excerpt or ''), escape(post.body or ''))
+    yield '</feed>\n'
+
+
+def _sitemap_bounds():
+    """各分片之前最后一篇博文的id（随版本缓存），分片按id范围读取，不使用OFFSET。
+    首页和所有博文的URL数超过BLUELOG_SITEMAP_MAX_URLS时分片，第一个分片以首页开头"""
+    key = '%s%s:sitemap-bounds' % (FEED_KEY_PREFIX, _version()[0])
+    bounds = cache.get(key)
+    if bounds is None:
+        max_urls = current_app.config['BLUELOG_SITEMAP_MAX_URLS']
+        bounds, limit = [0], max_urls - 1
+        while True:     # 每个分片只沿主键索引向后扫描一个分片的长度
+            last = db.session.query(Post.id).filter(Post.id > bounds[-1]).order_by(Post.id) \
+                .offset(limit - 1).limit(1).scalar()
+            if last is None or db.session.query(Post.id).filter(Post.id > last).first() is None:
+                break
+            bounds.append(last)
+            limit = max_urls
+        cache.set(key, bounds, timeout=current_app.config['BLUELOG_FEED_CACHE_TIMEOUT'])
+    return bounds
+
+
+def sitemap_pages():
+    """站点地图的分片数"""
+    return len(_sitemap_bounds())
+
+
+def generate_sitemap(page):
+    """第page个分片（从1开始）的URL列表：第一个分片以首页开头，之后按id顺序列出博文"""
+    limit = current_app.config['BLUELOG_SITEMAP_MAX_URLS']
+    yield '<?xml version="1.0" encoding="utf-8"?>\n<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    if page == 1:
+        updated = db.session.query(db.func.max(Post.updated_at)).scalar()
+        yield '<url><loc>%s</loc>%s<changefreq>daily</changefreq></url>\n' % (
+            escape(url_for('blog.index', _external=True)), '<lastmod>%s</lastmod>' % _w3c(updated) if updated else '')
+        limit -= 1
+    query = db.session.query(Post.id, Post.updated_at).filter(Post.id > _sitemap_bounds()[page - 1]) \
+        .order_by(Post.id).limit(limit)
+    for post_id, updated_at in query.yield_per(YIELD_PER):
+        yield '<url><loc>%s</loc>%s</url>\n' % (escape(url_for('blog.show_post', post_id=post_id, _external=True)),
+                                               '<lastmod>%s</lastmod>' % _w3c(updated_at) if updated_at else '')
+    yield '</urlset>\n'
+
+
+def generate_sitemap_index(pages):
+    """站点地图索引，列出各分片"""
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+    for page in range(1, pages + 1):
+        yield '<sitemap><loc>%s</loc></sitemap>\n' % escape(url_for('blog.sitemap_page', page=page, _external=True))
+    yield '</sitemapindex>\n'
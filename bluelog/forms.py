@@ -51,7 +51,7 @@ class CommentForm(FlaskForm):
     body = TextAreaField('评论', validators=[DataRequired()])
     submit = SubmitField('提交')
 
-class AdminCommentForm(FlaskForm):
+class AdminCommentForm(CommentForm):
     """管理员评论表单"""
     author = HiddenField()
     email = HiddenField()
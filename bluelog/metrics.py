@@ -0,0 +1,404 @@
+import random
+import re
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, g, request, has_request_context, has_app_context
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+UNMATCHED_ENDPOINT = '<unmatched>'      # 未匹配路由（如404）的请求统一归入此端点
+_STRING_RE = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+_listening = False                      # 引擎事件只监听一次（create_app可能被调用多次）
+PHASES = ('total', 'before_request', 'view', 'render', 'context_processor', 'db', 'after_request')   # 请求阶段
+
+
+def fingerprint(statement):
+    """规范化SQL语句：字面量和参数替换为?，IN列表合并，空白折叠，相同结构的语句得到相同指纹"""
+    statement = _STRING_RE.sub('?', statement)
+    statement = _NUMBER_RE.sub('?', statement)
+    statement = _IN_LIST_RE.sub('(?)', statement)
+    return _SPACE_RE.sub(' ', statement).strip()[:1000]
+
+
+class StatementStats(object):
+    """一个SQL指纹的累计数据"""
+    __slots__ = ('count', 'total_time', 'max_time', 'n_plus_one')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.n_plus_one = 0         # 在单个请求中重复执行达到阈值的次数
+
+
+class EndpointStats(object):
+    """一个端点的累计数据，语句指纹数有上限，超出时淘汰累计耗时最少的指纹"""
+
+    def __init__(self, max_statements):
+        self.requests = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.n_plus_one = 0         # 出现N+1查询的请求数
+        self.statements = {}        # 指纹 -> StatementStats
+        self.max_statements = max_statements
+
+    def _statement(self, key):
+        stats = self.statements.get(key)
+        if stats is None:
+            if len(self.statements) >= self.max_statements:
+                coldest = min(self.statements, key=lambda k: self.statements[k].total_time)
+                del self.statements[coldest]
+            stats = self.statements[key] = StatementStats()
+        return stats
+
+    def add(self, profile, n_plus_one_threshold):
+        self.requests += 1
+        self.queries += profile.queries
+        self.db_time += profile.db_time
+        repeated = False
+        for key, (count, total_time, max_time) in profile.statements.items():
+            stats = self._statement(key)
+            stats.count += count
+            stats.total_time += total_time
+            stats.max_time = max(stats.max_time, max_time)
+            if count >= n_plus_one_threshold:
+                stats.n_plus_one += 1
+                repeated = True
+        if repeated:
+            self.n_plus_one += 1
+
+    def top_statements(self, limit):
+        """按累计耗时排序的前limit个指纹"""
+        return sorted(self.statements.items(), key=lambda item: item[1].total_time, reverse=True)[:limit]
+
+
+class RequestProfile(object):
+    """单个被采样请求内的查询记录，请求结束时并入端点统计"""
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.statements = {}        # 指纹 -> [次数, 累计耗时, 最大耗时]
+
+    def record(self, statement, duration):
+        self.queries += 1
+        self.db_time += duration
+        key = fingerprint(statement)
+        entry = self.statements.get(key)
+        if entry is None:
+            self.statements[key] = [1, duration, duration]
+        else:
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] = max(entry[2], duration)
+
+
+class QueryProfiler(object):
+    """按端点聚合查询次数、数据库耗时和语句指纹，供/admin/metrics和Prometheus抓取"""
+
+    def __init__(self, app):
+        self.lock = threading.Lock()
+        self.endpoints = {}         # 端点 -> EndpointStats，端点数受路由数限制
+        self.started = datetime.utcnow()
+        self.sample_rate = app.config['BLUELOG_PROFILER_SAMPLE_RATE']
+        self.max_statements = app.config['BLUELOG_PROFILER_MAX_STATEMENTS']
+        self.n_plus_one_threshold = app.config['BLUELOG_N_PLUS_ONE_THRESHOLD']
+
+    def add(self, endpoint, profile):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats(self.max_statements)
+            stats.add(profile, self.n_plus_one_threshold)
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.started = datetime.utcnow()
+
+    def snapshot(self, limit=5):
+        """返回各端点统计的副本（按数据库总耗时排序），渲染时不持有锁"""
+        with self.lock:
+            rows = [dict(endpoint=endpoint, requests=stats.requests, queries=stats.queries,
+                         db_time=stats.db_time, n_plus_one=stats.n_plus_one,
+                         statements=[dict(fingerprint=key, count=s.count, total_time=s.total_time,
+                                          max_time=s.max_time, n_plus_one=s.n_plus_one)
+                                     for key, s in stats.top_statements(limit)])
+                    for endpoint, stats in self.endpoints.items()]
+        return sorted(rows, key=lambda row: row['db_time'], reverse=True)
+
+    def prometheus(self):
+        """Prometheus文本格式。语句指纹基数太大，不作为标签导出"""
+        metrics = [('bluelog_requests_profiled_total', 'counter', 'Sampled requests.', 'requests'),
+                   ('bluelog_db_queries_total', 'counter', 'SQL statements executed by sampled requests.', 'queries'),
+                   ('bluelog_db_seconds_total', 'counter', 'Time spent in SQL by sampled requests.', 'db_time'),
+                   ('bluelog_n_plus_one_requests_total', 'counter',
+                    'Sampled requests repeating one statement fingerprint.', 'n_plus_one')]
+        with self.lock:
+            values = dict((endpoint, vars(stats).copy()) for endpoint, stats in self.endpoints.items())
+        lines = []
+        for name, kind, help_text, field in metrics:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for endpoint in sorted(values):
+                lines.append('%s{endpoint="%s"} %s' % (name, _escape_label(endpoint), values[endpoint][field]))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def get_profiler():
+    return current_app.extensions['bluelog_profiler']
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('bluelog_query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('bluelog_query_start')
+    if not starts:
+        return
+    duration = time.perf_counter() - starts.pop()
+    if not has_request_context() or 'bluelog_profiler' not in current_app.extensions:
+        return
+    _add_timing('db', duration)
+    profile = g.get('query_profile')
+    if profile is not None:
+        profile.record(statement, duration)
+    if duration >= current_app.config['BLUELOG_SLOW_QUERY_THRESHOLD']:     # 慢查询不受采样影响，总是记录
+        current_app.logger.warning('Slow query: Duration: %fs\n Endpoint: %s\nQuery: %s\n '
+                                   % (duration, request.endpoint, statement))
+
+
+def init_profiler(app):
+    """创建查询统计并监听所有引擎的执行事件，取代SQLALCHEMY_RECORD_QUERIES（后者在内存中保留每条语句）"""
+    global _listening
+    app.extensions['bluelog_profiler'] = QueryProfiler(app)
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        _listening = True
+
+
+def start_request_profile():
+    """在before_request中调用：按采样率决定是否记录本请求的查询"""
+    profiler = get_profiler()
+    if profiler.sample_rate >= 1 or random.random() < profiler.sample_rate:
+        g.query_profile = RequestProfile()
+
+
+def finish_request_profile():
+    """在teardown_request中调用：将本请求的查询记录并入端点统计，重复的语句指纹记为N+1"""
+    profile = g.pop('query_profile', None)
+    if profile is None:
+        return
+    endpoint = request.endpoint or UNMATCHED_ENDPOINT
+    profiler = get_profiler()
+    profiler.add(endpoint, profile)
+    for key, (count, total_time, max_time) in profile.statements.items():
+        if count >= profiler.n_plus_one_threshold:
+            current_app.logger.info('Possible N+1 query in %s: %d times\nQuery: %s' % (endpoint, count, key))
+
+
+class Histogram(object):
+    """固定分桶的直方图，counts比分桶上界多一个溢出桶"""
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size):
+        self.counts = [0] * (size + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class TimingHistograms(object):
+    """按端点和请求阶段聚合耗时直方图，内存只与端点数和分桶数有关"""
+
+    def __init__(self, app):
+        self.lock = threading.Lock()
+        self.buckets = tuple(sorted(app.config['BLUELOG_TIMING_BUCKETS']))
+        self.endpoints = {}         # 端点 -> {阶段: Histogram}
+
+    def add(self, endpoint, timings):
+        with self.lock:
+            phases = self.endpoints.setdefault(endpoint, {})
+            for phase, duration in timings.items():
+                histogram = phases.get(phase)
+                if histogram is None:
+                    histogram = phases[phase] = Histogram(len(self.buckets))
+                histogram.counts[bisect_left(self.buckets, duration)] += 1
+                histogram.sum += duration
+                histogram.count += 1
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+
+    def _percentile(self, histogram, q):
+        """由分桶估计分位数，返回所在桶的上界，落在溢出桶时返回None"""
+        rank = q * histogram.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, histogram.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        """返回各端点各阶段的请求数、平均耗时和估计的P50/P95（按总耗时排序）"""
+        with self.lock:
+            rows = []
+            for endpoint, phases in self.endpoints.items():
+                rows.append(dict(endpoint=endpoint, total=phases['total'].sum if 'total' in phases else 0,
+                                 phases=[dict(phase=phase, count=phases[phase].count,
+                                              avg=phases[phase].sum / phases[phase].count,
+                                              p50=self._percentile(phases[phase], 0.5),
+                                              p95=self._percentile(phases[phase], 0.95))
+                                         for phase in PHASES if phase in phases]))
+        return sorted(rows, key=lambda row: row['total'], reverse=True)
+
+    def prometheus(self):
+        name = 'bluelog_request_phase_seconds'
+        lines = ['# HELP %s Time spent in each request phase.' % name, '# TYPE %s histogram' % name]
+        with self.lock:
+            for endpoint in sorted(self.endpoints):
+                for phase in PHASES:
+                    histogram = self.endpoints[endpoint].get(phase)
+                    if histogram is None:
+                        continue
+                    labels = 'endpoint="%s",phase="%s"' % (_escape_label(endpoint), phase)
+                    cumulative = 0
+                    for bound, count in zip(self.buckets + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, cumulative))
+                    lines.append('%s_sum{%s} %s' % (name, labels, histogram.sum))
+                    lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+def get_timings():
+    return current_app.extensions['bluelog_timings']
+
+
+def _add_timing(phase, duration):
+    timings = g.get('request_timings')
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + duration
+
+
+def _timed(phase, func):
+    """包装应用方法，将耗时累加到本请求的phase阶段"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _add_timing(phase, time.perf_counter() - start)
+    return wrapper
+
+
+class TimedTemplate(Template):
+    """统计render_template耗时的模板类，嵌套渲染只计最外层"""
+
+    def render(self, *args, **kwargs):
+        if not has_app_context() or g.get('rendering'):
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        g.rendering = True
+        start = time.perf_counter()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            g.rendering = False
+            _add_timing('render', time.perf_counter() - start)
+
+
+def _server_timing(timings):
+    return ', '.join('%s;dur=%.2f' % (phase, timings[phase] * 1000) for phase in PHASES if phase in timings)
+
+
+def init_timers(app):
+    """为请求的各阶段计时：before_request、视图、模板渲染、上下文处理器、after_request，
+    数据库耗时由引擎事件累加。视图包含其中的渲染和查询，渲染包含上下文处理器"""
+    app.extensions['bluelog_timings'] = TimingHistograms(app)
+    app.jinja_env.template_class = TimedTemplate
+    app.preprocess_request = _timed('before_request', app.preprocess_request)
+    app.dispatch_request = _timed('view', app.dispatch_request)
+    app.update_template_context = _timed('context_processor', app.update_template_context)
+    app.process_response = _timed('after_request', app.process_response)
+    full_dispatch_request = app.full_dispatch_request
+
+    @wraps(full_dispatch_request)
+    def timed_full_dispatch_request():
+        g.request_timings = {}
+        start = time.perf_counter()
+        response = full_dispatch_request()
+        timings = g.pop('request_timings')
+        timings['total'] = time.perf_counter() - start
+        get_timings().add(request.endpoint or UNMATCHED_ENDPOINT, timings)
+        if app.config['BLUELOG_SERVER_TIMING']:
+            response.headers['Server-Timing'] = _server_timing(timings)
+        return response
+
+    app.full_dispatch_request = timed_full_dispatch_request
+
+
+class StartupProfile(object):
+    """记录应用工厂各步骤（每个扩展、蓝本和注册函数）的耗时及期间新导入的模块数，
+    BLUELOG_STARTUP_PROFILE开启时create_app结束后输出到标准错误"""
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.steps = []             # （类别, 名称, 耗时, 新导入的模块数）
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def step(self, kind, name):
+        if not self.enabled:
+            yield
+            return
+        modules = len(sys.modules)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((kind, name, time.perf_counter() - start, len(sys.modules) - modules))
+
+    def format(self):
+        lines = ['%-10s %-24s %10s %8s' % ('step', 'name', 'ms', 'imports')]
+        for kind, name, duration, modules in self.steps:
+            lines.append('%-10s %-24s %10.1f %8d' % (kind, name, duration * 1000, modules))
+        lines.append('%-35s %10.1f' % ('create_app', (time.perf_counter() - self.started) * 1000))
+        return '\n'.join(lines)
+
+
+def summarize_import_times(output, top=15):
+    """汇总python -X importtime的输出：按顶层软件包（bluelog按模块）累加各模块自身的导入耗时，
+    返回耗时最多的top项[(名称, 毫秒)]和其余行"""
+    totals, others = {}, []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            others.append(line)
+            continue
+        try:
+            self_us, cumulative, name = line[len('import time:'):].split('|')
+            self_us = int(self_us)
+        except ValueError:      # 表头
+            continue
+        name = name.strip()
+        key = name if name.startswith('bluelog') else name.split('.')[0]
+        totals[key] = totals.get(key, 0) + self_us
+    ranked = sorted(totals.items(), key=lambda item: -item[1])[:top]
+    return [(name, us / 1000.0) for name, us in ranked], others
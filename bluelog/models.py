@@ -1,8 +1,16 @@
+import math
+import re
 from datetime import datetime
+from flask import current_app
 from flask_login import UserMixin
+from markupsafe import Markup
+from sqlalchemy.orm import aliased, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import generate_password_hash, check_password_hash
 from bluelog.extensions import db
 
+WORD_RE = re.compile(r'[㐀-鿿豈-﫿]|[^\s㐀-鿿豈-﫿]+')     # 单个中日韩文字或其他连续非空白字符
+
 class Admin(db.Model, UserMixin):
     """管理员类数据模型"""
     id = db.Column(db.Integer, primary_key=True)
@@ -12,6 +20,7 @@ class Admin(db.Model, UserMixin):
     blog_sub_title = db.Column(db.String(100))      # 博客副标题
     name = db.Column(db.String(30))                 # 用户姓名
     about = db.Column(db.Text)                      # 关于信息
+    unread_comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)     # 未审核评论数（冗余计数）
 
     def set_password(self, password):
         """密码处理后返回哈希值赋值给密码散列值字段"""
@@ -21,6 +30,18 @@ class Admin(db.Model, UserMixin):
         """将接收到的密码用密码散列值校验"""
         return check_password_hash(self.password_hash, password)
 
+    @staticmethod
+    def count_unread_comments(delta):
+        """未审核评论数增减delta，新增或核准评论时调用（一条UPDATE，并发请求不会丢失计数）"""
+        Admin.query.update({Admin.unread_comment_count: Admin.unread_comment_count + delta},
+                           synchronize_session=False)
+
+    @staticmethod
+    def update_unread_comment_count():
+        """重新统计未审核评论数，删除评论（含级联删除的回复）或批量生成评论后调用"""
+        unread = db.session.query(db.func.count(Comment.id)).filter(Comment.reviewed == False).as_scalar()
+        Admin.query.update({Admin.unread_comment_count: unread}, synchronize_session=False)
+
 class Category(db.Model):
     """博文标签数据模型"""
     id = db.Column(db.Integer, primary_key=True)
@@ -41,12 +62,52 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(60))                # 标题
     body = db.Column(db.Text)                       # 博文正文
+    excerpt = db.Column(db.Text)                    # 纯文本摘要，保存时生成，列表页不必读取正文
+    word_count = db.Column(db.Integer, default=0)   # 字数（中日韩文字按字计，其他按词计）
+    reading_time = db.Column(db.Integer, default=1)  # 阅读时间（分钟）
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)     # 博文时间戳
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)  # 最后修改时间（含评论计数变化）
     can_comment = db.Column(db.Boolean, default=True)                           # 可否评论，默认可
     category_id = db.Column(db.Integer, db.ForeignKey('category.id'))           # 标签id
     category = db.relationship('Category', back_populates='posts')              # 对博文标签的反向引用关系
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)            # 评论总数（冗余计数）
+    reviewed_comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)   # 已审核评论数（冗余计数）
     comments = db.relationship('Comment', back_populates='post', cascade='all, delete-orphan')      # 对评论的反向引用关系
 
+    @staticmethod
+    def summarize(body, length, reading_speed):
+        """由正文计算（摘要, 字数, 阅读时间），不依赖应用上下文，生成虚拟数据的工作进程也可调用"""
+        text = Markup(body or '').striptags()
+        if len(text) <= length:
+            excerpt = text
+        else:       # 与模板过滤器truncate一致：尽量在空格处截断
+            excerpt = text[:length - 3].rsplit(' ', 1)[0] + '...'
+        word_count = len(WORD_RE.findall(text))
+        return excerpt, word_count, max(1, int(math.ceil(word_count / reading_speed)))
+
+    def update_excerpt(self):
+        """根据正文生成摘要、字数和阅读时间，新建或编辑博文时调用"""
+        self.excerpt, self.word_count, self.reading_time = Post.summarize(
+            self.body, current_app.config['BLUELOG_EXCERPT_LENGTH'], current_app.config['BLUELOG_READING_SPEED'])
+
+    def update_comment_count(self):
+        """重新统计评论计数，评论新增、审核或删除（含级联删除的回复）后调用"""
+        comments = Comment.query.with_parent(self)
+        self.comment_count = comments.count()
+        self.reviewed_comment_count = comments.filter_by(reviewed=True).count()
+
+    @staticmethod
+    def update_all_comment_counts(post_ids=None):
+        """用一条UPDATE批量重算评论计数，post_ids为空时重算所有博文（生成虚拟数据或修复计数）"""
+        total = db.session.query(db.func.count(Comment.id)).filter(Comment.post_id == Post.id).as_scalar()
+        reviewed = db.session.query(db.func.count(Comment.id)).filter(
+            Comment.post_id == Post.id, Comment.reviewed == True).as_scalar()
+        query = Post.query
+        if post_ids is not None:
+            query = query.filter(Post.id.in_(post_ids))
+        query.update({Post.comment_count: total, Post.reviewed_comment_count: reviewed},
+                     synchronize_session=False)
+
 class Comment(db.Model):
     """评论类（附加回复）数据模型"""
     id = db.Column(db.Integer, primary_key=True)
@@ -63,8 +124,79 @@ class Comment(db.Model):
     replies = db.relationship('Comment', back_populates='replied', cascade='all, delete-orphan')    # 对评论的回复集
     replied = db.relationship('Comment', back_populates='replies', remote_side=[id])    # 定义id为远程端，replied_id为本地端
 
+    __table_args__ = (db.Index('ix_comment_reviewed_timestamp', 'reviewed', 'timestamp'),)   # 未审核过滤和未读计数
+
+    @staticmethod
+    def select_tree(*criteria):
+        """用递归CTE一次查出满足条件的评论及其所有回复，返回[(id, post_id)]，回复排在被回复评论之前"""
+        tree = db.session.query(Comment.id, Comment.post_id, db.literal(0).label('depth')).filter(*criteria) \
+            .cte(name='comment_tree', recursive=True)
+        replies = db.session.query(Comment.id, Comment.post_id, (tree.c.depth + 1).label('depth')) \
+            .filter(Comment.replied_id == tree.c.id)
+        tree = tree.union(replies)
+        depths = {}
+        for id, post_id, depth in db.session.query(tree.c.id, tree.c.post_id, tree.c.depth):
+            depths[id, post_id] = max(depth, depths.get((id, post_id), 0))     # 评论和它的回复都满足条件时取较深的一层
+        return sorted(depths, key=depths.get, reverse=True)
+
+    @staticmethod
+    def bulk_delete(*criteria):
+        """批量删除满足条件的评论及其回复（与replies的级联删除一致），返回（被删除的id, 受影响的博文id）。
+        按深度从回复到被回复评论的顺序删除，逐条检查外键的数据库（PostgreSQL等）不会因replied_id报错"""
+        rows = Comment.select_tree(*criteria)
+        ids = [id for id, post_id in rows]
+        for i in range(0, len(ids), 500):      # 分段以免超出数据库的参数个数限制
+            Comment.query.filter(Comment.id.in_(ids[i:i + 500])).delete(synchronize_session=False)
+        return ids, set(post_id for id, post_id in rows)
+
+    @staticmethod
+    def thread_roots(post):
+        """博文的讨论串起点：已审核且不是回复本博文已审核评论的评论（被回复评论一并载入，用于显示引用）"""
+        parent = aliased(Comment)
+        in_thread = db.session.query(parent.id).filter(
+            parent.id == Comment.replied_id, parent.post_id == post.id, parent.reviewed == True).exists()
+        return Comment.query.with_parent(post).filter(Comment.reviewed == True, ~in_thread) \
+            .options(joinedload(Comment.replied))
+
+    @staticmethod
+    def load_threads(post, roots):
+        """用一条递归CTE查询载入各讨论串起点下的所有已审核回复，组装到每条评论的thread属性（按时间排序）。
+        同时填充回复的replied关系，模板访问时不再逐条延迟加载"""
+        comments = {root.id: root for root in roots}
+        for root in roots:
+            root.thread = []
+        if not comments:
+            return roots
+        criteria = (Comment.post_id == post.id, Comment.reviewed == True)
+        tree = db.session.query(Comment.id).filter(Comment.replied_id.in_(list(comments)), *criteria) \
+            .cte(name='comment_thread', recursive=True)
+        tree = tree.union_all(db.session.query(Comment.id).filter(Comment.replied_id == tree.c.id, *criteria))
+        replies = Comment.query.join(tree, Comment.id == tree.c.id).order_by(Comment.timestamp, Comment.id).all()
+        for reply in replies:
+            reply.thread = []
+            comments[reply.id] = reply
+        for reply in replies:
+            parent = comments[reply.replied_id]
+            set_committed_value(reply, 'replied', parent)
+            parent.thread.append(reply)
+        return roots
+
 class Link(db.Model):
     """外部链接类数据模型"""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(30))
-    url = db.Column(db.String(255))
\ No newline at end of file
+    url = db.Column(db.String(255))
+
+class OutboxMessage(db.Model):
+    """待发送邮件数据模型（发件箱），请求中只入队，由后台线程或flask mail-worker批量发送"""
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(100))             # 主题
+    recipient = db.Column(db.String(254))           # 收件人
+    html = db.Column(db.Text)                       # 邮件正文
+    coalesce_key = db.Column(db.String(64), index=True)     # 合并键，时间窗口内同键的通知合并为一封
+    count = db.Column(db.Integer, default=1)                # 合并的通知数
+    attempts = db.Column(db.Integer, default=0)             # 已尝试发送次数
+    last_error = db.Column(db.Text)                         # 最近一次发送错误
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)                     # 入队时间
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # 下次尝试时间（也用作领取租约）
+    sent_at = db.Column(db.DateTime, index=True)            # 发送成功时间，未发送为空
@@ -0,0 +1,109 @@
+from datetime import datetime
+
+from flask import current_app, request, url_for
+from sqlalchemy import and_, or_
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'    # 游标中时间戳的格式
+LAST_CURSOR = 'last'                # 表示最后一页的游标
+
+
+def encode_cursor(timestamp, item_id):
+    """将（时间戳, id）编码为URL游标"""
+    return '%s-%d' % (timestamp.strftime(CURSOR_FORMAT), item_id)
+
+
+def decode_cursor(cursor):
+    """解析URL游标，格式错误时返回None"""
+    try:
+        timestamp, item_id = cursor.split('-')
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+class KeysetPagination(object):
+    """游标分页对象，按（时间戳, id）定位，不使用OFFSET和COUNT(*)"""
+    keyset = True
+    page = None         # 游标分页没有页码和总数
+    pages = None
+    total = None
+
+    def __init__(self, items, per_page, has_prev, has_next, timestamp_key, id_key):
+        self.items = items
+        self.per_page = per_page
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self._timestamp_key = timestamp_key
+        self._id_key = id_key
+
+    def _cursor(self, item):
+        return encode_cursor(getattr(item, self._timestamp_key), getattr(item, self._id_key))
+
+    def _url(self, **cursor):
+        """保留当前端点、视图参数和其他查询参数，替换游标生成URL"""
+        args = request.args.to_dict()
+        for key in ('page', 'after', 'before'):
+            args.pop(key, None)
+        args.update(request.view_args or {})
+        args.update(cursor)
+        return url_for(request.endpoint, **args)
+
+    def next_url(self):
+        """下一页URL"""
+        if not self.has_next or not self.items:
+            return None
+        return self._url(after=self._cursor(self.items[-1]))
+
+    def prev_url(self):
+        """上一页URL"""
+        if not self.has_prev or not self.items:
+            return None
+        return self._url(before=self._cursor(self.items[0]))
+
+    def first_url(self):
+        """第一页URL"""
+        return self._url()
+
+    def last_url(self):
+        """最后一页URL"""
+        return self._url(before=LAST_CURSOR)
+
+
+def keyset_paginate(query, timestamp_column, id_column, per_page, descending=True):
+    """按查询参数after/before中的游标取一页记录，多取一条用于判断是否还有下一页"""
+    before = request.args.get('before')
+    backward = before is not None                   # 向前翻页时反向查询再倒序
+    cursor = decode_cursor(before if backward else request.args.get('after'))
+
+    query_descending = descending != backward
+    if cursor is not None:
+        timestamp, item_id = cursor
+        if query_descending:
+            query = query.filter(or_(timestamp_column < timestamp,
+                                     and_(timestamp_column == timestamp, id_column < item_id)))
+        else:
+            query = query.filter(or_(timestamp_column > timestamp,
+                                     and_(timestamp_column == timestamp, id_column > item_id)))
+    if query_descending:
+        query = query.order_by(timestamp_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(timestamp_column.asc(), id_column.asc())
+
+    items = query.limit(per_page + 1).all()
+    has_more = len(items) > per_page
+    items = items[:per_page]
+    if backward:
+        items.reverse()
+        has_prev, has_next = has_more, cursor is not None   # 无效或'last'游标表示从末尾开始
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    return KeysetPagination(items, per_page, has_prev, has_next, timestamp_column.key, id_column.key)
+
+
+def paginate(query, timestamp_column, id_column, per_page, descending=True):
+    """根据BLUELOG_KEYSET_PAGINATION选择游标分页或页码分页"""
+    if current_app.config['BLUELOG_KEYSET_PAGINATION']:
+        return keyset_paginate(query, timestamp_column, id_column, per_page, descending)
+    page = request.args.get('page', 1, type=int)
+    order = timestamp_column.desc() if descending else timestamp_column.asc()
+    return query.order_by(order).paginate(page, per_page)
@@ -0,0 +1,105 @@
+import math
+import threading
+import time
+
+from flask import abort, current_app, request
+from flask_login import current_user
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from bluelog.extensions import cache
+from bluelog.utils import LRUDict
+
+RATE_KEY_PREFIX = 'bluelog:rate:'       # 共享计数的缓存键前缀
+
+
+def _estimate(previous, current, elapsed, window):
+    """滑动窗口计数：当前窗口的请求数加上一窗口的请求数按剩余比例折算"""
+    return current + previous * (window - elapsed) / float(window)
+
+
+def _retry_after(previous, current, elapsed, limit, window):
+    """估计的请求数连同重试的这一次降到限额以内还需要的秒数（被拒绝的请求同样计数）"""
+    if current + 1 <= limit:    # 本窗口结束前上一窗口的折算部分可降到足够小
+        seconds = window * (previous - limit + current + 1) / float(previous) - elapsed
+    else:   # 须等到下一窗口，那时当前窗口的请求数成为折算部分
+        seconds = (window - elapsed) + window * (current - limit + 1) / float(current)
+    return max(1, int(math.ceil(seconds)))
+
+
+class MemoryBackend(object):
+    """进程内计数，每个（端点, IP）只保存两个窗口的计数，客户端数超过上限时淘汰最久未访问的"""
+
+    def __init__(self, app):
+        self.counters = LRUDict(app.config['BLUELOG_RATE_LIMIT_MAX_CLIENTS'])
+        self.lock = threading.Lock()
+
+    def hit(self, key, index, window):
+        """记录一次请求，返回（上一窗口的请求数, 当前窗口的请求数）"""
+        with self.lock:
+            counter = self.counters.get(key)
+            if counter is None or counter[0] < index - 1:
+                previous, current = 0, 0
+            elif counter[0] == index - 1:
+                previous, current = counter[2], 0
+            else:
+                previous, current = counter[1], counter[2]
+            current += 1
+            self.counters.set(key, (index, previous, current))
+        return previous, current
+
+
+class CacheBackend(object):
+    """使用Flask-Caching计数。CACHE_TYPE为RedisCache等共享后端时多个工作进程共用限额，
+    SimpleCache时只在本进程内有效（可在测试中代替共享后端）"""
+
+    def __init__(self, app):
+        pass
+
+    def hit(self, key, index, window):
+        current_key = '%s%s:%d' % (RATE_KEY_PREFIX, key, index)
+        cache.add(current_key, 0, timeout=window * 2)     # 设置过期时间，计数键不会无限累积
+        current = cache.cache.inc(current_key) or 1
+        previous = cache.get('%s%s:%d' % (RATE_KEY_PREFIX, key, index - 1)) or 0
+        return previous, current
+
+
+BACKENDS = {'memory': MemoryBackend, 'cache': CacheBackend}
+
+
+def _limit_for(endpoint):
+    """端点的限额（请求数, 窗口秒数），先查端点名再查蓝本名，未配置时返回None"""
+    limits = current_app.config['BLUELOG_RATE_LIMITS']
+    if endpoint in limits:
+        return limits[endpoint]
+    if '.' in endpoint:
+        return limits.get(endpoint.rsplit('.', 1)[0])
+    return None
+
+
+def init_rate_limiter(app):
+    """创建计数后端；部署在反向代理之后时按BLUELOG_PROXY_COUNT从X-Forwarded-For取客户端IP。
+    未设置代理层数时无法区分代理之后的读者，启用限制时记录警告"""
+    app.extensions['bluelog_rate_limit'] = BACKENDS[app.config['BLUELOG_RATE_LIMIT_BACKEND']](app)
+    if app.config['BLUELOG_RATE_LIMIT'] and not app.config['BLUELOG_PROXY_COUNT'] and not app.testing:
+        app.logger.warning('BLUELOG_RATE_LIMIT is enabled with BLUELOG_PROXY_COUNT=0: behind a reverse proxy '
+                           'every reader shares the proxy address and its limit. Set BLUELOG_PROXY_COUNT to '
+                           'the number of proxies in front of the application.')
+    if app.config['BLUELOG_PROXY_COUNT']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['BLUELOG_PROXY_COUNT'],
+                                x_proto=app.config['BLUELOG_PROXY_COUNT'])
+
+
+def check_rate_limit():
+    """在before_request中调用：按IP和端点计数，超出限额时返回429（带Retry-After），管理员不受限制"""
+    if not current_app.config['BLUELOG_RATE_LIMIT'] or request.endpoint is None:
+        return
+    limit = _limit_for(request.endpoint)
+    if limit is None or current_user.is_authenticated:
+        return
+    count, window = limit
+    now = time.time()
+    index, elapsed = divmod(now, window)
+    key = '%s:%s' % (request.endpoint, request.remote_addr)
+    previous, current = current_app.extensions['bluelog_rate_limit'].hit(key, int(index), window)
+    if _estimate(previous, current, elapsed, window) > count:
+        abort(429, retry_after=_retry_after(previous, current, elapsed, count, window))
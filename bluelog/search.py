@@ -0,0 +1,472 @@
+import heapq
+import math
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict, Counter
+
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from bluelog.extensions import db, cache
+from bluelog.models import Post, Comment
+
+TOKEN_RE = re.compile(r'[0-9a-z]+|[㐀-鿿豈-﫿]+')    # 拉丁词或连续的中日韩文字
+SEARCH_EPOCH_KEY = 'bluelog:search-epoch'           # 内存索引修改记录的标识，缓存被清空后更换，各进程随之重建
+SEARCH_VERSION_KEY = 'bluelog:search-version'       # 内存索引的共享版本号，每次提交加一
+SEARCH_CHANGE_PREFIX = 'bluelog:search-change:'     # 各版本的修改记录：[(kind, ref_id)]，其他进程据此增量更新
+CHANGE_LOG_TIMEOUT = 24 * 3600                      # 修改记录的保存时间（秒）
+MAX_DELTAS = 200                                    # 落后超过此版本数时改为在后台重建
+MISSING_GRACE = 5                                   # 修改记录缺失（写入中或已被淘汰）超过此秒数时在后台重建
+MARK_START, MARK_END = '\x01', '\x02'               # 摘要中高亮标记的占位符，转义后替换为<mark>
+
+
+def tokenize(value):
+    """分词：拉丁文字按词，中日韩文字按相邻二字切分（单字保留单字）"""
+    tokens = []
+    for word in TOKEN_RE.findall((value or '').lower()):
+        if word[0] < '㐀':
+            tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def plain_text(html):
+    """去除HTML标签，得到用于索引和摘要的纯文本"""
+    return Markup(html or '').striptags()
+
+
+def make_snippet(content, query, width=None):
+    """截取包含第一个关键字的片段并高亮所有关键字"""
+    width = width or current_app.config['BLUELOG_SEARCH_SNIPPET_WIDTH']
+    words = sorted(set(TOKEN_RE.findall(query.lower())), key=len, reverse=True)
+    lowered = content.lower()
+    positions = [lowered.find(word) for word in words if word in lowered]
+    start = max(min(positions) - width // 4, 0) if positions else 0
+    fragment = content[start:start + width]
+    if words:
+        pattern = re.compile('|'.join(re.escape(word) for word in words), re.IGNORECASE)
+        fragment = pattern.sub(lambda m: MARK_START + m.group(0) + MARK_END, fragment)
+    fragment = str(escape(fragment)).replace(MARK_START, '<mark>').replace(MARK_END, '</mark>')
+    prefix = '…' if start > 0 else ''
+    suffix = '…' if start + width < len(content) else ''
+    return Markup(prefix + fragment + suffix)
+
+
+def _post_document(post):
+    return dict(kind='post', ref_id=post.id, post_id=post.id, title=post.title or '',
+                content=plain_text(post.body))
+
+
+def _comment_document(comment):
+    return dict(kind='comment', ref_id=comment.id, post_id=comment.post_id, title=comment.author or '',
+                content=comment.body or '')
+
+
+def _all_documents():
+    """逐批读取全部博文和已审核评论，不一次性载入内存"""
+    for post in Post.query.order_by(Post.id).yield_per(500):
+        yield _post_document(post)
+    for comment in Comment.query.filter_by(reviewed=True).order_by(Comment.id).yield_per(500):
+        yield _comment_document(comment)
+
+
+class SQLIndex(object):
+    """保存在数据库中的全文索引，所有工作进程共享。search_index表以rowid区分博文和评论"""
+
+    @staticmethod
+    def _rowid(kind, ref_id):
+        """博文和评论映射到不同的rowid，按rowid增删无需扫描索引表"""
+        return ref_id * 2 + (kind == 'comment')
+
+    INSERT = None
+
+    def _row(self, document):
+        return dict(document, rowid=self._rowid(document['kind'], document['ref_id']),
+                    title_terms=' '.join(tokenize(document['title'])),
+                    body_terms=' '.join(tokenize(document['content'])))
+
+    def add(self, document):
+        row = self._row(document)
+        db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'), dict(rowid=row['rowid']))
+        db.session.execute(self.INSERT, row)
+
+    def remove(self, kind, ref_ids):
+        for ref_id in ref_ids:
+            db.session.execute(text('DELETE FROM search_index WHERE rowid = :rowid'),
+                               dict(rowid=self._rowid(kind, ref_id)))
+
+    def commit(self):
+        db.session.commit()
+
+    def rebuild(self):
+        """清空后分批插入（executemany），大量数据时比逐条add快得多"""
+        db.session.execute(text('DELETE FROM search_index'))
+        rows = []
+        for document in _all_documents():
+            rows.append(self._row(document))
+            if len(rows) >= 500:
+                db.session.execute(self.INSERT, rows)
+                rows = []
+        if rows:
+            db.session.execute(self.INSERT, rows)
+        db.session.commit()
+
+    @staticmethod
+    def _fetch(statement, params):
+        rows = db.session.execute(statement, params)
+        return [dict(row._mapping) if hasattr(row, '_mapping') else dict(row) for row in rows]
+
+
+class FTS5Index(SQLIndex):
+    """SQLite FTS5全文索引"""
+    name = 'fts5'
+    dialect = 'sqlite'
+
+    @staticmethod
+    def exists():
+        return db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'")).first() is not None
+
+    @staticmethod
+    def available():
+        """SQLite编译了FTS5时可用，索引表不存在时创建"""
+        try:
+            FTS5Index.create()
+        except OperationalError:
+            db.session.rollback()
+            return False
+        return True
+
+    @staticmethod
+    def create():
+        # title、content保存原文用于显示和摘要，*_terms保存分词结果用于检索
+        db.session.execute(text(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5('
+            'kind UNINDEXED, ref_id UNINDEXED, post_id UNINDEXED, title UNINDEXED, content UNINDEXED, '
+            'title_terms, body_terms)'))
+        db.session.commit()
+
+    INSERT = text('INSERT INTO search_index (rowid, kind, ref_id, post_id, title, content, title_terms, body_terms) '
+                  'VALUES (:rowid, :kind, :ref_id, :post_id, :title, :content, :title_terms, :body_terms)')
+
+    def search(self, terms, limit):
+        # 标题命中的权重高于正文；LIMIT保证只对前limit条排序
+        match = ' '.join('"%s"' % term for term in terms)
+        return self._fetch(text(
+            'SELECT kind, ref_id, post_id, title, content FROM search_index '
+            'WHERE search_index MATCH :match ORDER BY bm25(search_index, 0, 0, 0, 0, 0, 5.0, 1.0) LIMIT :limit'),
+            dict(match=match, limit=limit))
+
+
+class PostgresIndex(SQLIndex):
+    """PostgreSQL全文检索：tsvector列加GIN索引。使用simple配置对tokenize的分词结果建立索引，
+    中文与其他后端一样按二字切分，标题的权重（A）高于正文（B）"""
+    name = 'postgres'
+    dialect = 'postgresql'
+
+    @staticmethod
+    def exists():
+        return db.session.execute(text("SELECT to_regclass('search_index')")).scalar() is not None
+
+    @staticmethod
+    def available():
+        """索引表不存在时创建"""
+        PostgresIndex.create()
+        return True
+
+    @staticmethod
+    def create():
+        db.session.execute(text(
+            'CREATE TABLE IF NOT EXISTS search_index (rowid BIGINT PRIMARY KEY, kind VARCHAR(10) NOT NULL, '
+            'ref_id INTEGER NOT NULL, post_id INTEGER, title TEXT, content TEXT, terms TSVECTOR NOT NULL)'))
+        db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_search_index_terms ON search_index USING GIN (terms)'))
+        db.session.commit()
+
+    INSERT = text("INSERT INTO search_index (rowid, kind, ref_id, post_id, title, content, terms) "
+                  "VALUES (:rowid, :kind, :ref_id, :post_id, :title, :content, "
+                  "setweight(to_tsvector('simple', :title_terms), 'A') || "
+                  "setweight(to_tsvector('simple', :body_terms), 'B'))")
+
+    def search(self, terms, limit):
+        # 分词结果只含字母、数字和中日韩文字，加引号作为词素，用&要求全部命中
+        query = ' & '.join("'%s'" % term for term in terms)
+        return self._fetch(text(
+            "SELECT kind, ref_id, post_id, title, content FROM search_index, to_tsquery('simple', :query) query "
+            "WHERE terms @@ query ORDER BY ts_rank(terms, query) DESC, rowid LIMIT :limit"),
+            dict(query=query, limit=limit))
+
+
+class MemoryIndex(object):
+    """纯Python倒排索引，用于没有全文检索的数据库。每个进程各自维护：提交时把修改的文档键写入缓存中的修改记录，
+    其他进程检索前只重新载入这些文档；落后太多或记录缺失时在后台线程中重建，期间继续使用旧索引。
+    多个工作进程须使用共享缓存（CACHE_TYPE），否则无法得知其他进程的修改"""
+    name = 'python'
+    TITLE_WEIGHT = 5
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.epoch = None
+        self.version = None
+        self.pending = set()                # 本进程尚未发布的修改：（kind, ref_id）
+        self.missing_since = None
+        self.rebuilding = False
+        self._reset()
+
+    def _reset(self):
+        self.postings = defaultdict(dict)   # 词 -> {文档键: 加权词频}
+        self.documents = {}                 # 文档键 -> 文档
+        self.lengths = {}                   # 文档键 -> 词数
+        self.terms = {}                     # 文档键 -> 文档包含的词，删除时只需访问这些倒排表
+
+    def _add(self, document):
+        key = (document['kind'], document['ref_id'])
+        self._discard(key)
+        frequencies = Counter(tokenize(document['content']))
+        for term in tokenize(document['title']):
+            frequencies[term] += self.TITLE_WEIGHT
+        for term, frequency in frequencies.items():
+            self.postings[term][key] = frequency
+        self.documents[key] = document
+        self.lengths[key] = sum(frequencies.values())
+        self.terms[key] = list(frequencies)
+
+    def _discard(self, key):
+        if self.documents.pop(key, None) is None:
+            return
+        del self.lengths[key]
+        for term in self.terms.pop(key):
+            postings = self.postings[term]
+            del postings[key]
+            if not postings:
+                del self.postings[term]
+
+    def add(self, document):
+        with self.lock:
+            self._add(document)
+            self.pending.add((document['kind'], document['ref_id']))
+
+    def remove(self, kind, ref_ids):
+        with self.lock:
+            for ref_id in ref_ids:
+                self._discard((kind, ref_id))
+                self.pending.add((kind, ref_id))
+
+    @staticmethod
+    def _shared_epoch():
+        cache.add(SEARCH_EPOCH_KEY, uuid.uuid4().hex, timeout=0)
+        return cache.get(SEARCH_EPOCH_KEY)
+
+    def commit(self):
+        """发布本进程的修改：版本号加一，修改的文档键写入该版本的修改记录"""
+        with self.lock:
+            changes, self.pending = sorted(self.pending), set()
+            if not changes:
+                return
+            epoch = self._shared_epoch()
+            cache.add(SEARCH_VERSION_KEY, 0, timeout=0)
+            version = cache.cache.inc(SEARCH_VERSION_KEY)
+            cache.set('%s%s:%d' % (SEARCH_CHANGE_PREFIX, epoch, version), changes, timeout=CHANGE_LOG_TIMEOUT)
+            if epoch == self.epoch and version == self.version + 1:      # 期间没有其他进程的修改
+                self.version = version
+
+    @staticmethod
+    def _load(keys):
+        """从数据库重新载入文档，返回{文档键: 文档}，已删除（或评论未通过审核）的文档不在其中"""
+        documents = {}
+        post_ids = [ref_id for kind, ref_id in keys if kind == 'post']
+        comment_ids = [ref_id for kind, ref_id in keys if kind == 'comment']
+        for i in range(0, len(post_ids), 500):
+            for post in Post.query.filter(Post.id.in_(post_ids[i:i + 500])):
+                documents['post', post.id] = _post_document(post)
+        for i in range(0, len(comment_ids), 500):
+            for comment in Comment.query.filter(Comment.id.in_(comment_ids[i:i + 500]), Comment.reviewed == True):
+                documents['comment', comment.id] = _comment_document(comment)
+        return documents
+
+    def _catch_up(self, latest):
+        """按修改记录应用self.version之后的修改，返回是否已是最新；记录缺失时应用到缺失之前"""
+        numbers = list(range(self.version + 1, latest + 1))
+        entries = cache.get_many(*['%s%s:%d' % (SEARCH_CHANGE_PREFIX, self.epoch, number) for number in numbers])
+        keys = set()
+        for number, entry in zip(numbers, entries):
+            if entry is None:
+                break
+            keys.update(tuple(key) for key in entry)
+            self.version = number
+        documents = self._load(keys)
+        for key in keys:
+            if key in documents:
+                self._add(documents[key])
+            else:
+                self._discard(key)
+        return self.version == latest
+
+    def _build(self):
+        """在新的数据结构中完整建立索引，返回（epoch, version, 索引）"""
+        epoch = self._shared_epoch()
+        version = cache.get(SEARCH_VERSION_KEY) or 0     # 先取版本再读数据库，期间的修改随后按记录补上
+        index = MemoryIndex()
+        for document in _all_documents():
+            index._add(document)
+        return epoch, version, index
+
+    def _swap(self, built):
+        epoch, version, index = built
+        with self.lock:
+            self.postings, self.documents, self.lengths, self.terms = \
+                index.postings, index.documents, index.lengths, index.terms
+            self.epoch, self.version, self.missing_since = epoch, version, None
+
+    def rebuild(self):
+        """完整重建（flask reindex）：同时更换修改记录的标识，其他进程随之在后台重建"""
+        cache.delete(SEARCH_EPOCH_KEY)
+        self._swap(self._build())
+
+    def _rebuild_in_background(self):
+        if self.rebuilding:
+            return
+        self.rebuilding = True
+        app = current_app._get_current_object()
+
+        def run():
+            try:
+                with app.app_context():
+                    self._swap(self._build())
+            finally:
+                self.rebuilding = False
+
+        threading.Thread(target=run, name='bluelog-search-rebuild', daemon=True).start()
+
+    def ensure_fresh(self):
+        """检索前调用。首次检索时建立索引；之后按修改记录增量更新，无法增量更新时在后台重建"""
+        if self.epoch is None:
+            with self.lock:
+                if self.epoch is None:
+                    self._swap(self._build())
+            return
+        epoch, latest = cache.get_many(SEARCH_EPOCH_KEY, SEARCH_VERSION_KEY)
+        if epoch == self.epoch and latest == self.version:
+            return
+        with self.lock:
+            if epoch != self.epoch or latest is None or not 0 <= latest - self.version <= MAX_DELTAS:
+                self._rebuild_in_background()
+            elif self._catch_up(latest):
+                self.missing_since = None
+            elif self.missing_since is None:
+                self.missing_since = time.monotonic()
+            elif time.monotonic() - self.missing_since > MISSING_GRACE:
+                self._rebuild_in_background()
+
+    def search(self, terms, limit):
+        self.ensure_fresh()
+        with self.lock:
+            postings = [self.postings.get(term, {}) for term in set(terms)]
+            if not postings or not all(postings):
+                return []
+            postings.sort(key=len)              # 从最稀有的词开始求交集，候选集最小
+            candidates = set(postings[0])
+            for posting in postings[1:]:
+                candidates.intersection_update(posting)
+                if not candidates:
+                    return []
+            total = len(self.documents)
+            idfs = [math.log(1 + total / len(posting)) for posting in postings]
+
+            def score(key):
+                norm = 1 + math.log(1 + self.lengths[key])
+                return sum(idf * posting[key] for idf, posting in zip(idfs, postings)) / norm
+
+            keys = heapq.nlargest(limit, candidates, key=score)
+            return [self.documents[key] for key in keys]
+
+
+def get_index():
+    """按BLUELOG_SEARCH_BACKEND选择索引后端：auto时使用数据库的全文检索（SQLite的FTS5或PostgreSQL），
+    数据库不支持（或设为python时）用内存索引"""
+    index = current_app.extensions.get('bluelog_search')
+    if index is None:
+        if current_app.config['BLUELOG_SEARCH_BACKEND'] == 'auto':
+            for backend in (FTS5Index, PostgresIndex):
+                if db.engine.dialect.name != backend.dialect:
+                    continue
+                created = not backend.exists()
+                if backend.available():
+                    index = backend()
+                    if created:         # 新建的索引表为空，先导入已有数据
+                        index.rebuild()
+        if index is None:
+            index = MemoryIndex()
+        current_app.extensions['bluelog_search'] = index
+    return index
+
+
+def comment_tree_ids(comment):
+    """评论及其所有回复的id（删除评论会级联删除回复），须在删除前调用"""
+    ids = [comment.id]
+    for reply in comment.replies:
+        ids.extend(comment_tree_ids(reply))
+    return ids
+
+
+def index_post(post):
+    """新建或编辑博文后更新索引"""
+    index = get_index()
+    index.add(_post_document(post))
+    index.commit()
+
+
+def unindex_post(post_id, comment_ids):
+    """删除博文后从索引中移除博文及其评论，comment_ids须在删除前取得"""
+    index = get_index()
+    index.remove('post', [post_id])
+    index.remove('comment', comment_ids)
+    index.commit()
+
+
+def index_comment(comment):
+    """评论通过审核（或管理员直接发表）后加入索引"""
+    index = get_index()
+    index.add(_comment_document(comment))
+    index.commit()
+
+
+def index_comments(comment_ids):
+    """批量核准评论后分批加入索引，只提交一次"""
+    index = get_index()
+    for i in range(0, len(comment_ids), 500):
+        for comment in Comment.query.filter(Comment.id.in_(comment_ids[i:i + 500])):
+            index.add(_comment_document(comment))
+    index.commit()
+
+
+def unindex_comments(comment_ids):
+    """删除评论后从索引中移除，comment_ids须在删除前由comment_tree_ids或Comment.select_tree取得"""
+    index = get_index()
+    index.remove('comment', comment_ids)
+    index.commit()
+
+
+def rebuild_index():
+    """重建全部索引，返回使用的后端名称"""
+    index = get_index()
+    index.rebuild()
+    index.commit()
+    return index.name
+
+
+def search(query, limit=None):
+    """检索博文和已审核评论，返回按相关度排序的结果（附带高亮摘要）"""
+    limit = min(limit or current_app.config['BLUELOG_SEARCH_MAX_RESULTS'],
+                current_app.config['BLUELOG_SEARCH_MAX_RESULTS'])
+    terms = tokenize(query)[:current_app.config['BLUELOG_SEARCH_MAX_TERMS']]   # 限制关键字数以控制查询耗时
+    if not terms:
+        return []
+    results = get_index().search(terms, limit)
+    return [dict(result, snippet=make_snippet(result['content'], query)) for result in results]
@@ -16,32 +16,132 @@ class  BaseConfig(object):
     # DEBUG_TB_INTERCEPT_REDIRETS = False                         # 调试，默认False
     DEBUG_TB_INTERCEPT_REDIRECTS = False
     SQLALCHEMY_TRACK_MODIFICATIONS = False                      # 数据库
-    SQLALCHEMY_RECORD_QUERIES = True                            # 数据库
+    SQLALCHEMY_RECORD_QUERIES = False                           # 不在内存中记录每条查询，查询统计见bluelog/metrics.py
+    BLUELOG_DB_POOL_SIZE = int(os.getenv('DATABASE_POOL_SIZE', 10))            # 连接池大小（SQLite不适用，下同）
+    BLUELOG_DB_MAX_OVERFLOW = int(os.getenv('DATABASE_MAX_OVERFLOW', 20))      # 连接池满时可额外创建的连接数
+    BLUELOG_DB_POOL_RECYCLE = int(os.getenv('DATABASE_POOL_RECYCLE', 1800))    # 连接最长使用时间（秒），早于服务器断开空闲连接
+    BLUELOG_DB_POOL_TIMEOUT = int(os.getenv('DATABASE_POOL_TIMEOUT', 30))      # 等待可用连接的最长时间（秒）
+    BLUELOG_DB_POOL_PRE_PING = True                             # 取出连接时先检查是否可用
+    BLUELOG_SQLITE_WAL = True                                   # SQLite使用WAL日志模式，读写互不阻塞
+    BLUELOG_SQLITE_BUSY_TIMEOUT = 5                             # SQLite数据库被锁定时等待的最长时间（秒）
+    BLUELOG_DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')           # 只读副本，设置后匿名读者的GET请求从副本读取
 
     MAIL_SERVER = os.getenv('MAIL_SERVER')                      # 邮件服务器
-    MAIL_PORT = 465                                             # 端口
-    MAIL_USE_SSL = True                                         # SSL加密
+    MAIL_PORT = int(os.getenv('MAIL_PORT', 465))                # 端口
+    MAIL_USE_SSL = os.getenv('MAIL_USE_SSL', 'true').lower() == 'true'     # SSL加密
     MAIL_USERNAME = os.getenv('MAIL_USERNAME')                  # 邮箱用户名
     MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')                  # 邮箱用户密码
     MAIL_DEFAULT_SENDER = ('Bluelog Admin', MAIL_USERNAME)      # 邮箱默认发送者
+    BLUELOG_MAIL_BACKGROUND = True                              # 是否在进程内启动发件线程，False时运行flask mail-worker
+    BLUELOG_MAIL_BATCH_SIZE = 50                                # 每批发送数（复用一个SMTP连接）
+    BLUELOG_MAIL_POLL_INTERVAL = 10                             # 发件箱轮询间隔（秒）
+    BLUELOG_MAIL_COALESCE_WINDOW = 60                           # 同一博文新评论通知的合并窗口（秒）
+    BLUELOG_MAIL_MAX_ATTEMPTS = 5                               # 最多尝试发送次数
+    BLUELOG_MAIL_RETRY_BACKOFF = 30                             # 重试退避基数（秒），每次失败后加倍
+    BLUELOG_MAIL_LEASE = 300                                    # 领取邮件后的租约时间（秒），超时未完成可被重新领取
 
     BLUELOG_EMAIL = os.getenv('BLUELOG_EMAIL')                  # 博客邮箱
     BLUELOG_POST_PER_PAGE = 10                                  # 每页博文
     BLUELOG_MANAGE_POST_PER_PAGE = 15                           # 每页博文（管理）
     BLUELOG_COMMENT_PER_PAGE = 15                               # 每页评论
     BLUELOG_THEMES = {'perfect_blue': 'perfect blue', 'black_swan': 'black Swan'}       # 博客主题
-    BLUELOG_SLOW_QUERY_THRESHOLD = 1                            # 查询阈值？
+    BLUELOG_ASSETS_DIST = 'dist'                                # flask assets build的输出目录（位于static下）
+    BLUELOG_ASSETS_USE_MANIFEST = True                          # 模板使用构建出的带指纹文件（未构建时使用原始文件）
+    BLUELOG_CKEDITOR_LANGUAGES = ('zh-cn', 'en')                # 发布的CKEditor语言包
+    BLUELOG_STATIC_EXPORT = False                               # flask export渲染页面时为True，评论表单改为指向动态页面的链接
+    BLUELOG_EXCERPT_LENGTH = 255                                # 博文摘要长度（字符）
+    BLUELOG_READING_SPEED = 300                                 # 阅读速度（字/分钟），用于估算阅读时间
+    BLUELOG_KEYSET_PAGINATION = True                            # 游标分页；False则使用页码分页（OFFSET）
+    BLUELOG_SLOW_QUERY_THRESHOLD = 1                            # 慢查询阈值（秒），超过时记录日志
+    BLUELOG_PROFILER_SAMPLE_RATE = float(os.getenv('BLUELOG_PROFILER_SAMPLE_RATE', 0.1))   # 查询统计的请求采样率（0~1）
+    BLUELOG_PROFILER_MAX_STATEMENTS = 50                        # 每个端点保留的SQL指纹数上限
+    BLUELOG_N_PLUS_ONE_THRESHOLD = 5                            # 同一指纹在一个请求中执行达到此次数视为N+1查询
+    BLUELOG_METRICS_TOKEN = os.getenv('BLUELOG_METRICS_TOKEN')  # Prometheus抓取令牌（Bearer），未设置时需登录
+    BLUELOG_TIMING_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)     # 请求阶段耗时直方图的分桶上界（秒）
+    BLUELOG_SERVER_TIMING = os.getenv('BLUELOG_SERVER_TIMING', 'false').lower() == 'true'   # 是否添加Server-Timing响应首部
+    BLUELOG_STARTUP_PROFILE = os.getenv('BLUELOG_STARTUP_PROFILE', 'false').lower() == 'true'   # 是否输出create_app各步骤耗时（flask profile-startup）
+    BLUELOG_DEBUG_TOOLBAR = False                               # 是否启用调试工具栏（仅开发）
+    BLUELOG_ASGI_THREADS = int(os.getenv('BLUELOG_ASGI_THREADS', 10))      # ASGI入口执行视图的线程数（bluelog/asgi.py）
+    BLUELOG_BENCH_MIXES = {                                     # flask bench的请求组合：（场景, 权重），场景名即报告中的端点名
+        'read': (('blog.index', 40), ('blog.show_post', 45), ('blog.show_category', 15)),
+        'mixed': (('blog.index', 30), ('blog.show_post', 35), ('blog.show_category', 10),
+                  ('blog.show_post:comment', 10), ('admin.manage_post', 5), ('admin.manage_comment', 5),
+                  ('admin.manage_category', 5)),
+        'write': (('blog.show_post', 50), ('blog.show_post:comment', 50)),
+        'admin': (('admin.manage_post', 35), ('admin.manage_comment', 35), ('admin.manage_category', 15),
+                  ('blog.show_post:admin', 15)),
+    }
+    # 按IP限制请求频率和评论频率须能取得读者的真实IP：部署在nginx等反向代理之后时须同时设置BLUELOG_PROXY_COUNT，
+    # 否则所有读者共用代理的IP和同一份限额（nginx配置示例见export.py）
+    BLUELOG_RATE_LIMIT = os.getenv('BLUELOG_RATE_LIMIT', 'false').lower() == 'true'     # 是否按IP和端点限制请求频率（管理员不受限制）
+    BLUELOG_RATE_LIMITS = {'auth.login': (10, 60), 'blog.search': (30, 60), 'blog': (120, 60)}    # 端点或蓝本名 -> （请求数, 窗口秒数）
+    BLUELOG_RATE_LIMIT_BACKEND = os.getenv('BLUELOG_RATE_LIMIT_BACKEND', 'memory')    # 'memory'（进程内）或'cache'（经Flask-Caching共享）
+    BLUELOG_RATE_LIMIT_MAX_CLIENTS = 10000                      # 进程内计数最多记录的（端点, IP）数
+    BLUELOG_PROXY_COUNT = int(os.getenv('BLUELOG_PROXY_COUNT', 0))     # 应用前的反向代理层数，用于从X-Forwarded-For取客户端IP
+    BLUELOG_SPAM_FILTER = True                                  # 是否在写入数据库之前过滤读者的垃圾评论
+    BLUELOG_SPAM_CHECKS = ('rate_limit', 'duplicate', 'links', 'keywords', 'bayes')    # 检查及顺序（也可用导入路径）
+    BLUELOG_SPAM_THRESHOLD = 1                                  # 总分达到此值即拒绝
+    BLUELOG_SPAM_UNSURE_SCORE = 0.25                            # 廉价检查后总分低于此值直接通过，否则再运行贝叶斯模型
+    BLUELOG_SPAM_IP_RATE = (5, 60)                              # 每个IP（见BLUELOG_PROXY_COUNT）的令牌桶：可连续发表5条，之后每60秒1条
+    BLUELOG_SPAM_EMAIL_RATE = (3, 120)                          # 每个邮箱的令牌桶
+    BLUELOG_SPAM_DUPLICATE_WINDOW = 24 * 3600                   # 相同内容的评论在此时间（秒）内视为重复
+    BLUELOG_SPAM_DUPLICATE_MIN_LENGTH = 20                      # 短于此长度（字符）的评论（如“谢谢”）不检查重复
+    BLUELOG_SPAM_DUPLICATE_SCORE = 0.5                          # 其他读者提交过相同内容的分数
+    BLUELOG_SPAM_DUPLICATE_SENDER_SCORE = 0.75                  # 同一IP或邮箱重复提交相同内容的分数
+    BLUELOG_SPAM_MAX_TRACKED = 10000                            # 令牌桶和内容散列各自最多记录的条目数
+    BLUELOG_SPAM_MAX_LINKS = 3                                  # 评论中的链接数上限
+    BLUELOG_SPAM_KEYWORDS = ('viagra', 'casino', 'porn', 'loan', '代开发票', '博彩', '赌场', '贷款', '刷单')
+    BLUELOG_SPAM_BAYES_THRESHOLD = 0.9                          # 贝叶斯模型判定为垃圾评论的概率阈值
+    BLUELOG_SPAM_BAYES_MIN_EXAMPLES = 20                        # 两类样本都达到此数量后才使用贝叶斯模型
+    BLUELOG_SPAM_MODEL_PATH = os.path.join(basedir, 'spam-model.json')     # 贝叶斯模型文件，None时只保存在内存中
+    BLUELOG_SEARCH_BACKEND = 'auto'                             # 搜索索引：'auto'（数据库的全文检索：SQLite的FTS5或PostgreSQL）或'python'（内存索引）
+    BLUELOG_SEARCH_MAX_RESULTS = 30                             # 搜索结果上限
+    BLUELOG_SEARCH_MAX_TERMS = 10                               # 参与检索的关键字上限
+    BLUELOG_SEARCH_SNIPPET_WIDTH = 120                          # 摘要长度（字符）
+
+    # SimpleCache只在单个进程内有效：多个工作进程（gunicorn -w N）各有一份缓存，一个进程中的失效
+    # （清除站点上下文、整页版本、搜索索引版本、订阅源版本）不会到达其他进程，读者会看到过期页面。
+    # 多进程部署必须使用Redis、Memcached等共享缓存，生产设置默认使用RedisCache
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'SimpleCache')         # 缓存后端，默认为进程内缓存，只适合开发和单进程部署
+    CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', 'redis://localhost:6379/0')     # 共享缓存地址
+    CACHE_DEFAULT_TIMEOUT = 300                                 # 缓存默认过期时间（秒）
+    BLUELOG_CACHE_SITE_CONTEXT = True                           # 是否缓存站点级模板上下文
+    BLUELOG_SITE_CONTEXT_TIMEOUT = 600                          # 站点级模板上下文缓存过期时间（秒）
+    BLUELOG_CACHE_ADMIN = True                                  # 是否缓存管理员身份（含未审核评论数），登录后的请求不必查询管理员
+    BLUELOG_ADMIN_CACHE_TIMEOUT = 600                           # 管理员身份缓存过期时间（秒）
+    BLUELOG_FEED_POST_COUNT = 20                                # 订阅源中的博文数
+    BLUELOG_FEED_CACHE_TIMEOUT = 24 * 3600                      # 订阅源和站点地图缓存过期时间（秒），博文变化时重新生成
+    BLUELOG_FEED_MAX_AGE = 600                                  # 订阅源和站点地图的浏览器缓存时间（秒）
+    BLUELOG_SITEMAP_MAX_URLS = 50000                            # 每个站点地图文件的URL上限，超过时使用站点地图索引
+    BLUELOG_CACHE_PAGES = True                                  # 是否为匿名读者缓存整页响应
+    BLUELOG_PAGE_CACHE_TIMEOUT = 300                            # 整页缓存过期时间（秒）
+    BLUELOG_PAGE_CACHE_LOCK_TIMEOUT = 10                        # 同一页面并发未命中时等待渲染的最长时间（秒）
+    BLUELOG_COMPRESSION = os.getenv('BLUELOG_COMPRESSION', 'false').lower() == 'true'     # 是否由应用压缩响应（前端代理已压缩时不必开启）
+    BLUELOG_COMPRESSION_MIN_SIZE = 500                          # 小于此大小（字节）的响应不压缩
+    BLUELOG_COMPRESSION_GZIP_LEVEL = 6                          # gzip压缩级别（1~9）
+    BLUELOG_COMPRESSION_BROTLI_QUALITY = 5                      # brotli压缩质量（0~11），需安装brotli
+    BLUELOG_COMPRESSION_MIMETYPES = ('text/html', 'text/css', 'text/plain', 'text/xml', 'application/json',
+                                     'application/javascript', 'application/xml', 'application/rss+xml')
+    BLUELOG_TEMPLATE_CACHE_DIR = os.getenv('BLUELOG_TEMPLATE_CACHE_DIR', os.path.join(basedir, 'template-cache'))   # 模板字节码缓存目录，flask templates compile预先写入
+    BLUELOG_CACHE_FRAGMENTS = True                              # 是否缓存博文列表、侧边栏等模板片段
+    BLUELOG_FRAGMENT_CACHE_TIMEOUT = 3600                       # 模板片段缓存过期时间（秒），输入变化时使用新键
 
 
 class DevelopmentConfig(BaseConfig):
     """开发设置类"""
-    SQLALCHEMY_DATABASE_URI = prefix + os.path.join(basedir, 'data-dev.db')     # 开发数据库路径
+    SQLALCHEMY_DATABASE_URI = os.getenv('DEV_DATABASE_URL', prefix + os.path.join(basedir, 'data-dev.db'))    # 开发数据库路径
+    BLUELOG_PROFILER_SAMPLE_RATE = 1                            # 开发时统计每个请求
+    BLUELOG_ASSETS_USE_MANIFEST = False                         # 开发时直接使用原始文件，修改后无需重新构建
+    BLUELOG_DEBUG_TOOLBAR = True                                # 开发时启用调试工具栏
 
 
 class TestingConfig(BaseConfig):
     """测试设置类"""
     TESTING = True
     WTF_CSRF_ENABLED = False
+    BLUELOG_MAIL_BACKGROUND = False                             # 测试中显式调用deliver_outbox发送
+    BLUELOG_SPAM_MODEL_PATH = None                              # 测试不写入模型文件
+    BLUELOG_TEMPLATE_CACHE_DIR = None                           # 测试不写入模板字节码
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'      # 测试数据库（内存）
 
 
@@ -49,6 +149,8 @@ class ProductionConfig(BaseConfig):
     """生产设置类"""
     # SQLALCHEMY_DATABASE_URI = os.path('DATABASE_URL', prefix + os.path.join(basedir, 'data.db'))    # 生产数据库路径
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL', prefix + os.path.join(basedir, 'data.db'))
+    TEMPLATES_AUTO_RELOAD = False                               # 不检查模板源码是否修改，更新模板后重启工作进程
+    CACHE_TYPE = os.getenv('CACHE_TYPE', 'RedisCache')          # 多个工作进程共享缓存，单进程部署可设为SimpleCache
 
 
 config = {
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import math
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+from flask import current_app, request
+from werkzeug.utils import import_string
+
+from bluelog.models import WORD_RE
+from bluelog.utils import LRUDict
+
+Submission = namedtuple('Submission', 'ip author email site body')     # 待检查的评论（尚未写入数据库）
+Verdict = namedtuple('Verdict', 'spam score reasons')                   # 检查结果：是否垃圾评论、总分、命中的检查
+
+DECISIVE = float('inf')         # 单项即可判定为垃圾评论的分数
+RATE_LIMITED = 'rate_limit'     # 频率超限的原因名，视图据此提示读者稍后再试
+URL_RE = re.compile(r'(?:https?://|www\.)\S+', re.I)
+
+CHECKS = {}     # 检查名 -> 检查类，BLUELOG_SPAM_CHECKS中也可以使用导入路径
+
+
+def register_check(name):
+    """注册检查类的装饰器"""
+    def decorator(cls):
+        CHECKS[name] = cls
+        return cls
+    return decorator
+
+
+class Check(object):
+    """检查基类。check返回（分数, 原因）或None；cheap为False的检查较慢，只在廉价检查无法判定时运行"""
+    cheap = True
+
+    def __init__(self, app):
+        self.config = app.config
+
+    def check(self, submission):
+        raise NotImplementedError
+
+    def record(self, submission):
+        """每条提交检查完毕后调用（无论是否拒绝）"""
+
+    def learn(self, bodies, spam):
+        """管理员核准（spam为False）或删除未审核评论（spam为True）后调用"""
+
+
+@register_check('rate_limit')
+class RateLimitCheck(Check):
+    """按IP和邮箱的令牌桶：桶容量即允许连续发表的评论数，之后按固定间隔补充"""
+
+    def __init__(self, app):
+        super(RateLimitCheck, self).__init__(app)
+        self.rates = dict(ip=app.config['BLUELOG_SPAM_IP_RATE'], email=app.config['BLUELOG_SPAM_EMAIL_RATE'])
+        self.buckets = LRUDict(app.config['BLUELOG_SPAM_MAX_TRACKED'])
+        self.lock = threading.Lock()
+
+    def _take(self, key, capacity, interval):
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) / interval)
+        allowed = tokens >= 1
+        self.buckets.set(key, (tokens - 1 if allowed else tokens, now))
+        return allowed
+
+    def check(self, submission):
+        with self.lock:
+            for kind, value in (('ip', submission.ip), ('email', submission.email.lower())):
+                capacity, interval = self.rates[kind]
+                if value and not self._take((kind, value), capacity, interval):
+                    return DECISIVE, RATE_LIMITED
+
+
+@register_check('duplicate')
+class DuplicateCheck(Check):
+    """最近提交过相同内容（忽略大小写和空白）的评论。只是加分项：同一IP或邮箱重复提交的分数较高，
+    其他读者提交过的分数较低，与其他检查合计达到阈值才拒绝；过短的评论不检查"""
+    max_senders = 10        # 每条内容最多记录的提交者数
+
+    def __init__(self, app):
+        super(DuplicateCheck, self).__init__(app)
+        self.window = app.config['BLUELOG_SPAM_DUPLICATE_WINDOW']
+        self.min_length = app.config['BLUELOG_SPAM_DUPLICATE_MIN_LENGTH']
+        self.seen = LRUDict(app.config['BLUELOG_SPAM_MAX_TRACKED'])     # 内容散列 -> （最后提交时间, 提交者）
+        self.lock = threading.Lock()
+
+    def _digest(self, body):
+        text = ' '.join(body.lower().split())
+        if len(text) < self.min_length:
+            return None
+        return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _senders(submission):
+        return set(sender for sender in (('ip', submission.ip), ('email', submission.email.lower())) if sender[1])
+
+    def check(self, submission):
+        digest = self._digest(submission.body)
+        if digest is None:
+            return None
+        with self.lock:
+            seen = self.seen.get(digest)
+        if seen is None or time.monotonic() - seen[0] >= self.window:
+            return None
+        if self._senders(submission) & seen[1]:
+            return self.config['BLUELOG_SPAM_DUPLICATE_SENDER_SCORE'], 'duplicate'
+        return self.config['BLUELOG_SPAM_DUPLICATE_SCORE'], 'duplicate'
+
+    def record(self, submission):
+        digest = self._digest(submission.body)
+        if digest is None:
+            return
+        now = time.monotonic()
+        with self.lock:
+            seen = self.seen.get(digest)
+            senders = seen[1] if seen is not None and now - seen[0] < self.window else frozenset()
+            if len(senders) < self.max_senders:
+                senders = senders | self._senders(submission)
+            self.seen.set(digest, (now, senders))
+
+
+@register_check('links')
+class LinkCheck(Check):
+    """链接过多或正文主要由链接组成"""
+
+    def check(self, submission):
+        urls = URL_RE.findall(submission.body)
+        if not urls:
+            return None
+        if len(urls) > self.config['BLUELOG_SPAM_MAX_LINKS']:
+            return DECISIVE, 'links'
+        score = 0.25 * len(urls)
+        if sum(len(url) for url in urls) > len(submission.body.strip()) / 2:
+            score += 0.5
+        return score, 'links'
+
+
+@register_check('keywords')
+class KeywordCheck(Check):
+    """正文、姓名或网址中出现垃圾评论常用的关键字"""
+
+    def check(self, submission):
+        text = ' '.join((submission.author, submission.site or '', submission.body)).lower()
+        hits = sum(1 for keyword in self.config['BLUELOG_SPAM_KEYWORDS'] if keyword.lower() in text)
+        if hits:
+            return 0.5 * hits, 'keywords'
+
+
+class NaiveBayes(object):
+    """多项式朴素贝叶斯分类器，只保存词频，可序列化为JSON"""
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.documents = data.get('documents', {'spam': 0, 'ham': 0})
+        self.words = data.get('words', {'spam': {}, 'ham': {}})
+        self.totals = dict((label, sum(counts.values())) for label, counts in self.words.items())
+
+    @staticmethod
+    def tokenize(text):
+        return [word.lower() for word in WORD_RE.findall(text)]
+
+    def train(self, text, spam):
+        label = 'spam' if spam else 'ham'
+        self.documents[label] += 1
+        counts = self.words[label]
+        for word in self.tokenize(text):
+            counts[word] = counts.get(word, 0) + 1
+            self.totals[label] += 1
+
+    def probability(self, text, min_documents):
+        """返回是垃圾评论的概率，任一类别的样本少于min_documents时返回None"""
+        if min(self.documents.values()) < min_documents:
+            return None
+        vocabulary = len(set(self.words['spam']) | set(self.words['ham']))
+        total = float(sum(self.documents.values()))
+        scores = {}
+        for label in ('spam', 'ham'):
+            counts, denominator = self.words[label], self.totals[label] + vocabulary
+            scores[label] = math.log(self.documents[label] / total) + sum(
+                math.log((counts.get(word, 0) + 1.0) / denominator) for word in self.tokenize(text))
+        return 1 / (1 + math.exp(max(min(scores['ham'] - scores['spam'], 700), -700)))
+
+    def to_dict(self):
+        return dict(documents=self.documents, words=self.words)
+
+
+@register_check('bayes')
+class BayesCheck(Check):
+    """用管理员核准和删除的评论训练的朴素贝叶斯模型。模型保存在BLUELOG_SPAM_MODEL_PATH，
+    文件被其他进程更新后重新载入；路径为None时只保存在内存中"""
+    cheap = False
+
+    def __init__(self, app):
+        super(BayesCheck, self).__init__(app)
+        self.path = app.config['BLUELOG_SPAM_MODEL_PATH']
+        self.model = NaiveBayes()
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def _reload(self):
+        if self.path is None or not os.path.isfile(self.path):
+            return
+        mtime = os.path.getmtime(self.path)
+        if mtime != self.mtime:
+            with open(self.path) as f:
+                self.model = NaiveBayes(json.load(f))
+            self.mtime = mtime
+
+    def check(self, submission):
+        with self.lock:
+            self._reload()
+            probability = self.model.probability(submission.body, self.config['BLUELOG_SPAM_BAYES_MIN_EXAMPLES'])
+        if probability is not None and probability >= self.config['BLUELOG_SPAM_BAYES_THRESHOLD']:
+            return DECISIVE, 'bayes'
+
+    def learn(self, bodies, spam):
+        with self.lock:
+            self._reload()
+            for body in bodies:
+                self.model.train(body, spam)
+            if self.path is not None:
+                with open(self.path + '.tmp', 'w') as f:
+                    json.dump(self.model.to_dict(), f)
+                os.replace(self.path + '.tmp', self.path)
+                self.mtime = os.path.getmtime(self.path)
+
+
+class SpamFilter(object):
+    """按BLUELOG_SPAM_CHECKS的顺序运行检查：总分达到BLUELOG_SPAM_THRESHOLD即判定为垃圾评论并停止；
+    廉价检查之后总分仍低于BLUELOG_SPAM_UNSURE_SCORE的评论直接通过，不运行较慢的检查"""
+
+    def __init__(self, app):
+        self.checks = []
+        for name in app.config['BLUELOG_SPAM_CHECKS']:
+            cls = CHECKS[name] if name in CHECKS else import_string(name)
+            self.checks.append(cls(app))
+
+    def _run(self, checks, submission, score, reasons, threshold):
+        for check in checks:
+            if score >= threshold:
+                break
+            result = check.check(submission)
+            if result is not None:
+                score += result[0]
+                reasons.append(result[1])
+        return score
+
+    def evaluate(self, submission):
+        config = current_app.config
+        threshold, reasons = config['BLUELOG_SPAM_THRESHOLD'], []
+        score = self._run([check for check in self.checks if check.cheap], submission, 0, reasons, threshold)
+        if config['BLUELOG_SPAM_UNSURE_SCORE'] <= score < threshold:
+            score = self._run([check for check in self.checks if not check.cheap], submission, score, reasons,
+                              threshold)
+        if RATE_LIMITED not in reasons:     # 读者稍后重新提交同一评论时不应算作重复
+            for check in self.checks:
+                check.record(submission)
+        return Verdict(score >= threshold, score, reasons)
+
+    def learn(self, bodies, spam):
+        bodies = [body for body in bodies if body]
+        if bodies:
+            for check in self.checks:
+                check.learn(bodies, spam)
+
+
+def init_spam_filter(app):
+    app.extensions['bluelog_spam'] = SpamFilter(app)
+
+
+def check_comment(author, email, site, body):
+    """在写入数据库之前检查读者的评论，未启用时返回None"""
+    if not current_app.config['BLUELOG_SPAM_FILTER']:
+        return None
+    submission = Submission(request.remote_addr, author or '', email or '', site or '', body or '')
+    verdict = current_app.extensions['bluelog_spam'].evaluate(submission)
+    if verdict.spam:
+        current_app.logger.info('Rejected a comment from %s (%s).', submission.ip, ', '.join(verdict.reasons))
+    return verdict
+
+
+def learn_comments(bodies, spam):
+    """管理员核准评论（spam为False）或删除未审核评论（spam为True）后调用，训练贝叶斯模型"""
+    if current_app.config['BLUELOG_SPAM_FILTER']:
+        current_app.extensions['bluelog_spam'].learn(bodies, spam)
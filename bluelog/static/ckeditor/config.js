@@ -35,4 +35,8 @@ CKEDITOR.editorConfig = function( config ) {
 
 	// Simplify the dialog windows.
 	config.removeDialogTabs = 'image:advanced;link:advanced';
+
+	// Only the languages in BLUELOG_CKEDITOR_LANGUAGES are published by `flask assets build`.
+	config.language = 'zh-cn';
+	config.defaultLanguage = 'en';
 };
@@ -0,0 +1,50 @@
+import hashlib
+import os
+
+from flask import current_app
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+from markupsafe import Markup
+
+from bluelog.extensions import cache
+
+FRAGMENT_KEY_PREFIX = 'bluelog:fragment:'       # 片段缓存键前缀，键中含输入的散列值，输入变化即换用新键
+
+
+def init_templates(app):
+    """设置模板字节码缓存：编译结果写入BLUELOG_TEMPLATE_CACHE_DIR，其他工作进程和重启后的进程直接载入，
+    不再解析模板源码（源码修改后按校验和自动失效）；注册模板函数cached_fragment"""
+    directory = app.config['BLUELOG_TEMPLATE_CACHE_DIR']
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+    app.add_template_global(cached_fragment)
+
+
+def compile_templates(app):
+    """编译应用和扩展（Bootstrap-Flask等）的所有模板，写入字节码缓存。返回（编译的模板数, 出错的模板列表）"""
+    env = app.jinja_env
+    compiled, errors = 0, []
+    for name in env.list_templates(filter_func=lambda name: name.endswith(('.html', '.xml', '.txt'))):
+        try:
+            env.get_template(name)
+        except TemplateSyntaxError as e:
+            errors.append((name, e))
+        else:
+            compiled += 1
+    return compiled, errors
+
+
+def cached_fragment(name, *keys, **kwargs):
+    """在模板中用{% call cached_fragment('名称', 输入...) %}...{% endcall %}缓存一段渲染结果。
+    keys须包含决定该段内容的全部输入（如站点版本、博文id和修改时间），输入不变时直接返回缓存的HTML"""
+    caller = kwargs.pop('caller')
+    config = current_app.config
+    if not config['BLUELOG_CACHE_FRAGMENTS']:
+        return caller()
+    digest = hashlib.md5(repr(keys).encode('utf-8')).hexdigest()
+    key = '%s%s:%s' % (FRAGMENT_KEY_PREFIX, name, digest)
+    html = cache.get(key)
+    if html is None:
+        html = str(caller())
+        cache.set(key, html, timeout=config['BLUELOG_FRAGMENT_CACHE_TIMEOUT'])
+    return Markup(html)
@@ -1,5 +1,13 @@
+import hashlib
+from collections import OrderedDict
+from functools import wraps
 from urllib.parse import urlparse, urljoin
-from flask import request, redirect, url_for
+
+from flask import request, redirect, url_for, session, current_app, make_response, g
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+from bluelog.caching import get_site_context, csrf_etag
 
 
 def is_safe_url(target):
@@ -17,3 +25,63 @@ def redirect_back(default='blog.index', **kwargs):
         if is_safe_url(target):
             return redirect(target)     # 目标URL通过安全验证则重定向
     return redirect(url_for(default, **kwargs))     # 未找到或未通过安全验证，转默认URL
+
+
+def _set_validators(response, etag):
+    """设置ETag，并要求浏览器每次使用缓存前重新验证。页面随主题Cookie（和会话中的CSRF令牌）而异，
+    设置Vary: Cookie，共享缓存不会把一种主题的页面发给切换了主题的读者"""
+    response.set_etag(etag, weak=True)      # 页面中的CSRF令牌因会话而异，使用弱ETag
+    response.vary.add('Cookie')
+    response.cache_control.no_cache = True
+    return response
+
+
+def conditional(validator, csrf=False):
+    """条件请求装饰器。validator接收视图参数，返回（最后修改时间, 其他ETag组成部分），
+    请求的If-None-Match匹配时在渲染模板前直接返回304。
+    只发送ETag，不发送Last-Modified：ETag还包含站点版本和主题，这些变化（以及删除较早的博文）
+    不改变最后修改时间，只带If-Modified-Since的请求总是得到完整的页面。
+    页面含表单时设置csrf=True：ETag加入会话的CSRF令牌（见caching.csrf_etag），
+    304不会让浏览器继续使用令牌已过期或属于其他会话的页面"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(**kwargs):
+            if request.method != 'GET' or current_user.is_authenticated or '_flashes' in session:
+                return f(**kwargs)      # 管理员页面和带闪现消息的页面总是完整渲染
+            last_modified, parts = validator(**kwargs)
+            if last_modified is None:
+                return f(**kwargs)
+            parts = [last_modified.isoformat(), request.cookies.get('theme', 'perfect_blue'),
+                     get_site_context()['site_version']] + list(parts)
+            etag = hashlib.md5('|'.join(str(part) for part in parts).encode('utf-8')).hexdigest()
+            if csrf:
+                g.page_etag = etag      # 整页缓存命中时按读者的令牌重新计算
+                etag = csrf_etag(etag)
+            if not is_resource_modified(request.environ, etag=etag):
+                return _set_validators(current_app.response_class(status=304), etag)
+            return _set_validators(make_response(f(**kwargs)), etag)
+        return decorated_function
+    return decorator
+
+
+class LRUDict(object):
+    """容量有限的词典，超出时淘汰最久未使用的键，内存占用与访问者数量无关（调用者负责加锁）"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def set(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.capacity:
+            self._items.popitem(last=False)
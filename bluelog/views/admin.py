@@ -1,9 +1,19 @@
-from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint
+import hmac
+
+from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, abort
 from flask_login import login_required, current_user
+from sqlalchemy.orm import joinedload, defer, load_only
 
+from bluelog.caching import invalidate_site_context, invalidate_admin, evict_pages, evict_post_pages
 from bluelog.extensions import db
+from bluelog.feeds import invalidate_feeds
 from bluelog.forms import SettingForm, PostForm, CategoryForm, LinkForm
-from bluelog.models import Post, Category, Comment, Link
+from bluelog.models import Admin, Post, Category, Comment, Link
+from bluelog.metrics import get_profiler, get_timings
+from bluelog.pagination import paginate
+from bluelog.spam import learn_comments
+from bluelog.search import index_post, unindex_post, index_comment, index_comments, unindex_comments, \
+    comment_tree_ids
 from bluelog.utils import redirect_back
 
 admin_bp = Blueprint('admin', __name__) # 蓝图对象admin_bp，'admin'蓝图名称，'__name__'蓝图所在模块名
@@ -15,11 +25,14 @@ def settings():
     """管理员设置"""
     form = SettingForm()
     if form.validate_on_submit():
-        current_user.name = form.name.data
-        current_user.blog_title = form.blog_title.data
-        current_user.blog_sub_title = form.blog_sub_title.data
-        current_user.about = form.about.data
+        admin = Admin.query.get(current_user.id)     # current_user来自缓存，不在数据库会话中
+        admin.name = form.name.data
+        admin.blog_title = form.blog_title.data
+        admin.blog_sub_title = form.blog_sub_title.data
+        admin.about = form.about.data
         db.session.commit()
+        invalidate_site_context()
+        invalidate_admin()
         flash('更新了设置', 'success')
         return redirect(url_for('blog.index'))
     form.name.data = current_user.name
@@ -33,11 +46,10 @@ def settings():
 @login_required
 def manage_post():
     """管理博文"""
-    page = request.args.get('page', 1, type=int)
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, per_page=current_app.config['BLUELOG_MANAGE_POST_PER_PAGE'])
+    pagination = paginate(Post.query.options(joinedload(Post.category), defer(Post.body)),
+                          Post.timestamp, Post.id, current_app.config['BLUELOG_MANAGE_POST_PER_PAGE'])
     posts = pagination.items
-    return render_template('admin/manage_post.html', page=page, pagination=pagination, posts=posts)
+    return render_template('admin/manage_post.html', pagination=pagination, posts=posts)
 
 
 @admin_bp.route('/post/new', methods=['GET', 'POST'])
@@ -50,8 +62,12 @@ def new_post():
         body = form.body.data
         category = Category.query.get(form.category.data)
         post = Post(title=title, body=body, category=category)
+        post.update_excerpt()
         db.session.add(post)
         db.session.commit()
+        invalidate_site_context()
+        invalidate_feeds()
+        index_post(post)
         flash('创建了一篇博文。', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     return render_template('admin/new_post.html', form=form)
@@ -64,10 +80,17 @@ def edit_post(post_id):
     form = PostForm()
     post = Post.query.get_or_404(post_id)
     if form.validate_on_submit():
+        old_category_id = post.category_id
         post.title = form.title.data
         post.body = form.body.data
+        post.update_excerpt()
         post.category = Category.query.get(form.category.data)
         db.session.commit()
+        if post.category_id != old_category_id:
+            invalidate_site_context()       # 标签下的博文数变化
+        evict_post_pages(post, old_category_id)
+        invalidate_feeds()
+        index_post(post)
         flash('更新了一篇博文。', 'success')
         return redirect(url_for('blog.show_post', post_id=post.id))
     form.title.data = post.title
@@ -81,8 +104,15 @@ def edit_post(post_id):
 def delete_post(post_id):
     """删除博文"""
     post = Post.query.get_or_404(post_id)
+    comment_ids = [comment.id for comment in post.comments]
     db.session.delete(post)
+    db.session.flush()
+    Admin.update_unread_comment_count()
     db.session.commit()
+    invalidate_site_context()
+    invalidate_admin()
+    invalidate_feeds()
+    unindex_post(post_id, comment_ids)
     flash('删除了一篇博文。', 'success')
     return redirect_back()
 
@@ -99,6 +129,7 @@ def set_comment(post_id):
         post.can_comment = True
         flash('这条评论可用。', 'success')
     db.session.commit()
+    evict_pages('post:%d' % post.id)
     return redirect_back()
 
 
@@ -107,7 +138,6 @@ def set_comment(post_id):
 def manage_comment():
     """管理评论"""
     filter_rule = request.args.get('filter', 'all')  # 'all', 'unreviewed', 'admin'
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']
     if filter_rule == 'unread':
         filtered_comments = Comment.query.filter_by(reviewed=False)
@@ -116,7 +146,7 @@ def manage_comment():
     else:
         filtered_comments = Comment.query
 
-    pagination = filtered_comments.order_by(Comment.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(filtered_comments, Comment.timestamp, Comment.id, per_page)
     comments = pagination.items
     return render_template('admin/manage_comment.html', comments=comments, pagination=pagination)
 
@@ -126,8 +156,17 @@ def manage_comment():
 def approve_comment(comment_id):
     """核准评论"""
     comment = Comment.query.get_or_404(comment_id)
+    approved = not comment.reviewed
+    if approved:
+        Admin.count_unread_comments(-1)
     comment.reviewed = True
+    comment.post.update_comment_count()
     db.session.commit()
+    invalidate_admin()
+    if approved and not comment.from_admin:
+        learn_comments([comment.body], spam=False)
+    evict_post_pages(comment.post)
+    index_comment(comment)
     flash('发布了一条评论。', 'success')
     return redirect_back()
 
@@ -137,12 +176,108 @@ def approve_comment(comment_id):
 def delete_comment(comment_id):
     """删除评论"""
     comment = Comment.query.get_or_404(comment_id)
+    post = comment.post
+    spam = [comment.body] if not comment.reviewed and not comment.from_admin else []    # 删除未审核评论视为垃圾评论
+    comment_ids = comment_tree_ids(comment)
     db.session.delete(comment)
+    post.update_comment_count()
+    Admin.update_unread_comment_count()
     db.session.commit()
+    invalidate_admin()
+    evict_post_pages(post)
+    unindex_comments(comment_ids)
+    learn_comments(spam, spam=True)
     flash('删除了一条评论。', 'success')
     return redirect_back()
 
 
+def _refresh_posts(post_ids):
+    """批量修改评论后用一条UPDATE重算相关博文的评论计数和未审核评论数，返回博文（只含id和标签）以便提交后淘汰缓存页面"""
+    post_ids = list(post_ids)
+    if not post_ids:
+        return []
+    Post.update_all_comment_counts(post_ids)
+    Admin.update_unread_comment_count()
+    return Post.query.options(load_only(Post.id, Post.category_id)).filter(Post.id.in_(post_ids)).all()
+
+
+@admin_bp.route('/comment/bulk-approve', methods=['POST'])
+@login_required
+def bulk_approve_comments():
+    """批量核准选中的评论"""
+    ids = request.form.getlist('ids', type=int)
+    approved, post_ids, bodies = [], set(), []
+    for i in range(0, len(ids), 500):       # 分段以免超出数据库的参数个数限制
+        criteria = (Comment.id.in_(ids[i:i + 500]), Comment.reviewed == False)
+        rows = db.session.query(Comment.id, Comment.post_id, Comment.body, Comment.from_admin).filter(*criteria).all()
+        Comment.query.filter(*criteria).update({Comment.reviewed: True}, synchronize_session=False)
+        approved.extend(row.id for row in rows)
+        post_ids.update(row.post_id for row in rows)
+        bodies.extend(row.body for row in rows if not row.from_admin)
+    posts = _refresh_posts(post_ids)
+    db.session.commit()
+    invalidate_admin()
+    for post in posts:
+        evict_post_pages(post)
+    if approved:
+        index_comments(approved)
+        learn_comments(bodies, spam=False)
+    flash('发布了%d条评论。' % len(approved), 'success')
+    return redirect_back()
+
+
+@admin_bp.route('/comment/bulk-delete', methods=['POST'])
+@login_required
+def bulk_delete_comments():
+    """批量删除选中的评论（连同其回复）"""
+    ids = request.form.getlist('ids', type=int)
+    deleted, post_ids, spam = [], set(), []
+    for i in range(0, len(ids), 500):
+        spam.extend(body for body, in db.session.query(Comment.body).filter(
+            Comment.id.in_(ids[i:i + 500]), Comment.reviewed == False, Comment.from_admin == False))
+        tree_ids, tree_post_ids = Comment.bulk_delete(Comment.id.in_(ids[i:i + 500]))
+        deleted.extend(tree_ids)
+        post_ids.update(tree_post_ids)
+    posts = _refresh_posts(post_ids)
+    db.session.commit()
+    invalidate_admin()
+    for post in posts:
+        evict_post_pages(post)
+    if deleted:
+        unindex_comments(deleted)
+        learn_comments(spam, spam=True)
+    flash('删除了%d条评论。' % len(deleted), 'success')
+    return redirect_back()
+
+
+@admin_bp.route('/comment/delete-unreviewed', methods=['POST'])
+@login_required
+def delete_unreviewed_comments():
+    """删除来自同一邮箱或站点的所有未审核评论（连同其回复），用于清理垃圾评论"""
+    email = request.form.get('email')
+    site = request.form.get('site')
+    if email:
+        criterion = Comment.email == email
+    elif site:
+        criterion = Comment.site == site
+    else:
+        flash('需要指定邮箱或站点。', 'warning')
+        return redirect_back()
+    criteria = (criterion, Comment.reviewed == False, Comment.from_admin == False)
+    spam = [body for body, in db.session.query(Comment.body).filter(*criteria)]
+    deleted, post_ids = Comment.bulk_delete(*criteria)
+    posts = _refresh_posts(post_ids)
+    db.session.commit()
+    invalidate_admin()
+    for post in posts:
+        evict_post_pages(post)
+    if deleted:
+        unindex_comments(deleted)
+        learn_comments(spam, spam=True)
+    flash('删除了%d条未审核评论。' % len(deleted), 'success')
+    return redirect_back()
+
+
 @admin_bp.route('/category/manage')
 @login_required
 def manage_category():
@@ -160,6 +295,7 @@ def new_category():
         category = Category(name=name)
         db.session.add(category)
         db.session.commit()
+        invalidate_site_context()
         flash('创建了一个新标签。', 'success')
         return redirect(url_for('.manage_category'))
     return render_template('admin/new_category.html', form=form)
@@ -177,6 +313,7 @@ def edit_category(category_id):
     if form.validate_on_submit():
         category.name = form.name.data
         db.session.commit()
+        invalidate_site_context()
         flash('更新了一个博文标签。', 'success')
         return redirect(url_for('.manage_category'))
 
@@ -193,6 +330,7 @@ def delete_category(category_id):
         flash('不能删除默认标签！', 'warning')
         return redirect(url_for('blog.index'))
     category.delete()
+    invalidate_site_context()
     flash('删除了一个博文标签。', 'success')
     return redirect(url_for('.manage_category'))
 
@@ -215,6 +353,7 @@ def new_link():
         link = Link(name=name, url=url)
         db.session.add(link)
         db.session.commit()
+        invalidate_site_context()
         flash('创建了一条外部链接', 'success')
         return redirect(url_for('.manage_link'))
     return render_template('admin/new_link.html', form=form)
@@ -230,6 +369,7 @@ def edit_link(link_id):
         link.name = form.name.data
         link.url = form.url.data
         db.session.commit()
+        invalidate_site_context()
         flash('更新了一条外部链接。', 'success')
         return redirect(url_for('.manage_link'))
     form.name.data = link.name
@@ -244,5 +384,36 @@ def delete_link(link_id):
     link = Link.query.get_or_404(link_id)
     db.session.delete(link)
     db.session.commit()
+    invalidate_site_context()
     flash('删除了一条外部链接。', 'success')
     return redirect(url_for('.manage_link'))
+
+
+@admin_bp.route('/metrics')
+@login_required
+def metrics():
+    """按端点查看查询统计和请求阶段耗时"""
+    profiler = get_profiler()
+    return render_template('admin/metrics.html', endpoints=profiler.snapshot(), profiler=profiler,
+                           timings=get_timings().snapshot())
+
+
+@admin_bp.route('/metrics/reset', methods=['POST'])
+@login_required
+def reset_metrics():
+    """清空查询统计和耗时直方图"""
+    get_profiler().reset()
+    get_timings().reset()
+    flash('清空了查询统计。', 'success')
+    return redirect(url_for('.metrics'))
+
+
+@admin_bp.route('/metrics/prometheus')
+def prometheus_metrics():
+    """Prometheus文本格式的查询统计和耗时直方图，凭BLUELOG_METRICS_TOKEN或管理员登录访问"""
+    token = current_app.config['BLUELOG_METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not current_user.is_authenticated and not (
+            token and hmac.compare_digest(authorization.encode('utf-8'), ('Bearer %s' % token).encode('utf-8'))):
+        abort(403)
+    return current_app.response_class(get_profiler().prometheus() + get_timings().prometheus(), mimetype='text/plain; version=0.0.4')
@@ -1,21 +1,51 @@
 from flask import render_template, flash, redirect, url_for, request, current_app, Blueprint, abort, make_response
 from flask_login import current_user
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload, defer
 
+from bluelog.caching import evict_post_pages, invalidate_admin
+from bluelog.database import use_replica
 from bluelog.emails import send_new_comment_email, send_new_reply_email
 from bluelog.extensions import db
+from bluelog.feeds import xml_response, generate_feed, generate_sitemap, generate_sitemap_index, sitemap_pages
 from bluelog.forms import CommentForm, AdminCommentForm
-from bluelog.models import Post, Category, Comment
-from bluelog.utils import redirect_back
+from bluelog.models import Admin, Post, Category, Comment
+from bluelog.pagination import paginate
+from bluelog.search import search as search_index, index_comment
+from bluelog.spam import RATE_LIMITED, check_comment
+from bluelog.utils import redirect_back, conditional
 
 blog_bp = Blueprint('blog', __name__)
 
 
+@blog_bp.before_request
+def route_reads():
+    """配置了只读副本时，匿名读者的GET请求从副本读取"""
+    use_replica()
+
+
+def index_validator():
+    """首页验证器：最近修改的博文时间（删除博文会改变站点上下文中的博文数）"""
+    return db.session.query(func.max(Post.updated_at)).scalar(), []
+
+
+def category_validator(category_id):
+    """博文标签页验证器：该标签下最近修改的博文时间"""
+    return db.session.query(func.max(Post.updated_at)).filter(Post.category_id == category_id).scalar(), []
+
+
+def post_validator(post_id):
+    """博文页验证器：博文最后修改时间，评论新增、审核和删除会更新评论计数从而更新该时间"""
+    return db.session.query(Post.updated_at).filter(Post.id == post_id).scalar(), []
+
+
 @blog_bp.route('/')
+@conditional(index_validator)
 def index():
     """博文初始页面"""
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.order_by(Post.timestamp.desc()).paginate(page, per_page=per_page)
+    pagination = paginate(Post.query.options(joinedload(Post.category), defer(Post.body)),
+                          Post.timestamp, Post.id, per_page)
     posts = pagination.items
     return render_template('blog/index.html', pagination=pagination, posts=posts)
 
@@ -27,26 +57,21 @@ def about():
 
 
 @blog_bp.route('/category/<int:category_id>')
+@conditional(category_validator)
 def show_category(category_id):
     """显示博文标签"""
     category = Category.query.get_or_404(category_id)
-    page = request.args.get('page', 1, type=int)
     per_page = current_app.config['BLUELOG_POST_PER_PAGE']
-    pagination = Post.query.with_parent(category).order_by(Post.timestamp.desc()).paginate(page, per_page)
+    query = Post.query.with_parent(category).options(joinedload(Post.category), defer(Post.body))
+    pagination = paginate(query, Post.timestamp, Post.id, per_page)
     posts = pagination.items
     return render_template('blog/category.html', category=category, pagination=pagination, posts=posts)
 
 
 @blog_bp.route('/post/<int:post_id>', methods=['GET', 'POST'])
+@conditional(post_validator, csrf=True)     # 页面含评论表单
 def show_post(post_id):
     """显示博文"""
-    post = Post.query.get_or_404(post_id)
-    page = request.args.get('page', 1, type=int)
-    per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']
-    pagination = Comment.query.with_parent(post).filter_by(reviewed=True).order_by(Comment.timestamp.asc()).paginate(
-        page, per_page)
-    comments = pagination.items
-
     if current_user.is_authenticated:
         form = AdminCommentForm()
         form.author.data = current_user.name
@@ -64,6 +89,15 @@ def show_post(post_id):
         email = form.email.data
         site = form.site.data
         body = form.body.data
+        if not from_admin:      # 在查询数据库之前过滤垃圾评论，拒绝的评论不写入数据库也不发送邮件
+            verdict = check_comment(author, email, site, body)
+            if verdict is not None and verdict.spam:
+                if RATE_LIMITED in verdict.reasons:
+                    flash('评论太频繁，请稍后再试。', 'warning')
+                else:
+                    flash('谢谢，你的评论将在审核后发布。', 'info')     # 不提示发送者评论已被拒绝
+                return redirect(url_for('.show_post', post_id=post_id))
+        post = Post.query.get_or_404(post_id)
         comment = Comment(
             author=author, email=email, site=site, body=body,
             from_admin=from_admin, post=post, reviewed=reviewed)
@@ -71,18 +105,43 @@ def show_post(post_id):
         if replied_id:
             replied_comment = Comment.query.get_or_404(replied_id)
             comment.replied = replied_comment
-            send_new_reply_email(replied_comment)
         db.session.add(comment)
+        post.update_comment_count()
+        if not reviewed:
+            Admin.count_unread_comments(1)
         db.session.commit()
+        if reviewed:
+            evict_post_pages(post)      # 管理员的评论直接发布
+            index_comment(comment)
+        else:
+            invalidate_admin()          # 未审核评论数随管理员缓存
+        if replied_id:
+            send_new_reply_email(replied_comment)   # 邮件只入队，提交评论后再发送通知
         if current_user.is_authenticated:  # send message based on authentication status
             flash('发布评论。', 'success')
         else:
             flash('谢谢，你的评论将在审核后发布。', 'info')
             send_new_comment_email(post)  # send notification email to admin
         return redirect(url_for('.show_post', post_id=post_id))
+
+    post = Post.query.get_or_404(post_id)
+    per_page = current_app.config['BLUELOG_COMMENT_PER_PAGE']
+    pagination = paginate(Comment.thread_roots(post), Comment.timestamp, Comment.id, per_page, descending=False)
+    comments = Comment.load_threads(post, pagination.items)    # 按讨论串分页，回复随起点一次载入
     return render_template('blog/post.html', post=post, pagination=pagination, form=form, comments=comments)
 
 
+@blog_bp.route('/search')
+def search():
+    """搜索博文和评论"""
+    q = request.args.get('q', '').strip()
+    if not q:
+        flash('请输入搜索关键字。', 'warning')
+        return redirect_back()
+    results = search_index(q)
+    return render_template('blog/search.html', q=q, results=results)
+
+
 @blog_bp.route('/reply/comment/<int:comment_id>')
 def reply_comment(comment_id):
     """回复评论"""
@@ -94,6 +153,29 @@ def reply_comment(comment_id):
         url_for('.show_post', post_id=comment.post_id, reply=comment_id, author=comment.author) + '#comment-form')
 
 
+@blog_bp.route('/feed.xml')
+def feed():
+    """Atom订阅源"""
+    return xml_response('feed', generate_feed)
+
+
+@blog_bp.route('/sitemap.xml')
+def sitemap():
+    """站点地图，URL过多时为站点地图索引"""
+    pages = sitemap_pages()
+    if pages > 1:
+        return xml_response('sitemap', generate_sitemap_index, pages)
+    return xml_response('sitemap', generate_sitemap, 1)
+
+
+@blog_bp.route('/sitemap-<int:page>.xml')
+def sitemap_page(page):
+    """站点地图分片"""
+    if not 1 <= page <= sitemap_pages():
+        abort(404)
+    return xml_response('sitemap-%d' % page, generate_sitemap, page)
+
+
 @blog_bp.route('/change-theme/<theme_name>')
 def change_theme(theme_name):
     """改变主题"""
@@ -0,0 +1,32 @@
+"""admin unread comment count
+
+Revision ID: 120ab40c30e6
+Revises: 20729ed59079
+Create Date: 2026-10-18 05:26:08.570777
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '120ab40c30e6'
+down_revision = '20729ed59079'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('admin', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('unread_comment_count', sa.Integer(), server_default='0', nullable=False))
+
+    # 按现有未审核评论回填（与Admin.update_unread_comment_count相同）
+    admin = sa.table('admin', sa.column('unread_comment_count'))
+    comment = sa.table('comment', sa.column('id'), sa.column('reviewed', sa.Boolean))
+    unread = sa.select([sa.func.count(comment.c.id)]).where(comment.c.reviewed == sa.false()).scalar_subquery()
+    op.execute(admin.update().values(unread_comment_count=unread))
+
+
+def downgrade():
+    with op.batch_alter_table('admin', schema=None) as batch_op:
+        batch_op.drop_column('unread_comment_count')
@@ -0,0 +1,25 @@
+"""comment reviewed timestamp index
+
+Revision ID: 20729ed59079
+Revises: f0ca6c6bfdd8
+Create Date: 2026-10-18 05:26:07.070189
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '20729ed59079'
+down_revision = 'f0ca6c6bfdd8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.create_index('ix_comment_reviewed_timestamp', ['reviewed', 'timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('comment', schema=None) as batch_op:
+        batch_op.drop_index('ix_comment_reviewed_timestamp')
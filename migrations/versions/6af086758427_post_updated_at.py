@@ -0,0 +1,32 @@
+"""post updated_at
+
+Revision ID: 6af086758427
+Revises: 7245fd8354fa
+Create Date: 2026-10-18 05:26:03.102544
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6af086758427'
+down_revision = '7245fd8354fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('updated_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_post_updated_at'), ['updated_at'], unique=False)
+
+    # 回填：已有博文的修改时间取发表时间
+    post = sa.table('post', sa.column('timestamp'), sa.column('updated_at'))
+    op.execute(post.update().values(updated_at=post.c.timestamp))
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_post_updated_at'))
+        batch_op.drop_column('updated_at')
@@ -0,0 +1,36 @@
+"""post comment counters
+
+Revision ID: 7245fd8354fa
+Revises: 5e31132c23d6
+Create Date: 2026-10-18 05:26:02.150158
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7245fd8354fa'
+down_revision = '5e31132c23d6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.add_column(sa.Column('reviewed_comment_count', sa.Integer(), server_default='0', nullable=False))
+
+    # 按现有评论回填计数（与Post.update_all_comment_counts相同）
+    post = sa.table('post', sa.column('id'), sa.column('comment_count'), sa.column('reviewed_comment_count'))
+    comment = sa.table('comment', sa.column('id'), sa.column('post_id'), sa.column('reviewed', sa.Boolean))
+    total = sa.select([sa.func.count(comment.c.id)]).where(comment.c.post_id == post.c.id).scalar_subquery()
+    reviewed = sa.select([sa.func.count(comment.c.id)]).where(
+        sa.and_(comment.c.post_id == post.c.id, comment.c.reviewed == sa.true())).scalar_subquery()
+    op.execute(post.update().values(comment_count=total, reviewed_comment_count=reviewed))
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('reviewed_comment_count')
+        batch_op.drop_column('comment_count')
@@ -0,0 +1,64 @@
+"""post excerpt
+
+Revision ID: f0ca6c6bfdd8
+Revises: 53bdb8b3d5cb
+Create Date: 2026-10-18 05:26:05.546767
+
+"""
+import math
+import re
+
+from alembic import op
+import sqlalchemy as sa
+from flask import current_app
+from markupsafe import Markup
+
+
+# revision identifiers, used by Alembic.
+revision = 'f0ca6c6bfdd8'
+down_revision = '53bdb8b3d5cb'
+branch_labels = None
+depends_on = None
+
+WORD_RE = re.compile(r'[㐀-鿿豈-﫿]|[^\s㐀-鿿豈-﫿]+')     # 单个中日韩文字或其他连续非空白字符
+
+
+def summarize(body, length, reading_speed):
+    """按本版本的Post.update_excerpt计算（摘要, 字数, 阅读时间），迁移不引用以后会变化的模型代码"""
+    text = Markup(body or '').striptags()
+    if len(text) <= length:
+        excerpt = text
+    else:
+        excerpt = text[:length - 3].rsplit(' ', 1)[0] + '...'
+    word_count = len(WORD_RE.findall(text))
+    return excerpt, word_count, max(1, int(math.ceil(word_count / reading_speed)))
+
+
+def upgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('excerpt', sa.Text(), nullable=True))
+        batch_op.add_column(sa.Column('word_count', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('reading_time', sa.Integer(), nullable=True))
+
+    # 回填：摘要、字数和阅读时间由正文计算，按id分批读取，不一次载入所有正文
+    post = sa.table('post', sa.column('id', sa.Integer), sa.column('body', sa.Text),
+                    sa.column('excerpt'), sa.column('word_count'), sa.column('reading_time'))
+    length, speed = current_app.config['BLUELOG_EXCERPT_LENGTH'], current_app.config['BLUELOG_READING_SPEED']
+    connection, last_id = op.get_bind(), 0
+    while True:
+        rows = connection.execute(sa.select([post.c.id, post.c.body]).where(post.c.id > last_id)
+                                  .order_by(post.c.id).limit(500)).fetchall()
+        if not rows:
+            break
+        for id, body in rows:
+            excerpt, word_count, reading_time = summarize(body, length, speed)
+            connection.execute(post.update().where(post.c.id == id).values(
+                excerpt=excerpt, word_count=word_count, reading_time=reading_time))
+        last_id = rows[-1][0]
+
+
+def downgrade():
+    with op.batch_alter_table('post', schema=None) as batch_op:
+        batch_op.drop_column('reading_time')
+        batch_op.drop_column('word_count')
+        batch_op.drop_column('excerpt')
@@ -0,0 +1,94 @@
+import socketserver
+import threading
+import unittest
+
+from bluelog import create_app
+from bluelog.extensions import db
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """最简单的SMTP会话：接受任何发件人，拒绝SMTPStub.rejected中的收件人，收到的邮件存入SMTPStub.messages"""
+
+    def reply(self, line):
+        self.wfile.write(line.encode('ascii') + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost SMTP stub')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8').strip()
+            verb = command.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                address = command.split(':', 1)[1].strip().strip('<>')
+                if address in server.rejected:
+                    self.reply('550 Mailbox unavailable')
+                else:
+                    recipients.append(address)
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for line in iter(self.rfile.readline, b''):
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append((recipients, b''.join(data).decode('utf-8')))
+                self.reply('250 OK')
+            elif verb in ('RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    """在localhost随机端口上运行的SMTP桩服务器，测试发件箱时代替真实的邮件服务器"""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('localhost', 0), SMTPHandler)
+        self.port = self.server_address[1]
+        self.lock = threading.Lock()
+        self.messages = []          # [(收件人列表, 邮件原文)]
+        self.rejected = set()       # 拒收的地址
+        self.connections = 0        # 建立的连接数
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class BaseTestCase(unittest.TestCase):
+    """测试基类：使用测试设置和内存数据库，每个测试在新的应用和请求上下文中运行"""
+
+    overrides = None        # 子类在创建应用前覆盖的设置
+
+    def setUp(self):
+        self.app = create_app('testing', self.overrides)
+        self.context = self.app.test_request_context()
+        self.context.push()
+        self.client = self.app.test_client()
+        self.runner = self.app.test_cli_runner()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
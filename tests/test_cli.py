@@ -0,0 +1,30 @@
+from alembic.script import ScriptDirectory
+from flask import current_app
+
+from bluelog.extensions import db
+from bluelog.models import Post
+
+from tests.base import BaseTestCase
+
+
+class CLITestCase(BaseTestCase):
+    """命令行：建表命令标记迁移版本（应用不是由flask命令创建时同样可用）"""
+
+    def head_revision(self):
+        return ScriptDirectory.from_config(current_app.extensions['migrate'].migrate.get_config()).get_current_head()
+
+    def current_revision(self):
+        return db.session.execute(db.text('SELECT version_num FROM alembic_version')).scalar()
+
+    def test_initdb_stamps_head(self):
+        db.drop_all()
+        result = self.runner.invoke(args=['initdb'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Initialized database', result.output)
+        self.assertEqual(self.current_revision(), self.head_revision())
+
+    def test_forge_stamps_head(self):
+        result = self.runner.invoke(args=['forge', '--category', '2', '--post', '5', '--comment', '10'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertEqual(Post.query.count(), 5)
+        self.assertEqual(self.current_revision(), self.head_revision())
@@ -0,0 +1,113 @@
+from datetime import datetime, timedelta
+
+from bluelog.emails import send_mail, deliver_outbox, _claim_due_messages
+from bluelog.extensions import db
+from bluelog.models import OutboxMessage
+
+from tests.base import BaseTestCase, SMTPStub
+
+
+class OutboxTestCase(BaseTestCase):
+    """发件箱：入队、领取租约、失败重试和通知合并，邮件发送到本机的SMTP桩服务器"""
+
+    def setUp(self):
+        self.smtp = SMTPStub()
+        self.addCleanup(self.smtp.stop)
+        self.overrides = dict(MAIL_SERVER='localhost', MAIL_PORT=self.smtp.port, MAIL_USE_SSL=False,
+                              MAIL_USE_TLS=False, MAIL_USERNAME=None, MAIL_PASSWORD=None,
+                              MAIL_DEFAULT_SENDER='bluelog@example.com', MAIL_SUPPRESS_SEND=False)
+        super(OutboxTestCase, self).setUp()
+
+    def make_due(self, message):
+        """把邮件的下次尝试时间改为已到期"""
+        message.next_attempt_at = datetime.utcnow() - timedelta(seconds=1)
+        db.session.commit()
+
+    def test_send_mail_enqueues(self):
+        message = send_mail('Hello', 'reader@example.com', '<p>Hi</p>')
+        self.assertEqual(OutboxMessage.query.count(), 1)
+        self.assertIsNone(message.sent_at)
+        self.assertEqual(message.attempts, 0)
+        self.assertEqual(self.smtp.messages, [])     # 只入队，不在请求中发送
+
+    def test_deliver_batch_uses_one_connection(self):
+        for i in range(3):
+            send_mail('Hello %d' % i, 'reader%d@example.com' % i, '<p>Hi</p>')
+        self.assertEqual(deliver_outbox(), 3)
+        self.assertEqual(self.smtp.connections, 1)
+        self.assertEqual(sorted(recipients[0] for recipients, data in self.smtp.messages),
+                         ['reader0@example.com', 'reader1@example.com', 'reader2@example.com'])
+        self.assertEqual(OutboxMessage.query.filter(OutboxMessage.sent_at.is_(None)).count(), 0)
+        self.assertEqual(deliver_outbox(), 0)        # 已发送的邮件不再领取
+
+    def test_claim_sets_lease(self):
+        message = send_mail('Hello', 'reader@example.com', '<p>Hi</p>')
+        claimed = _claim_due_messages(10)
+        self.assertEqual([m.id for m in claimed], [message.id])
+        db.session.expire_all()
+        lease = self.app.config['BLUELOG_MAIL_LEASE']
+        self.assertGreater(message.next_attempt_at, datetime.utcnow() + timedelta(seconds=lease - 5))
+        self.assertEqual(_claim_due_messages(10), [])    # 租约期内不会被再次领取
+        self.make_due(message)                           # 租约过期（领取的进程退出）后可重新领取
+        self.assertEqual([m.id for m in _claim_due_messages(10)], [message.id])
+
+    def test_retry_with_backoff(self):
+        self.smtp.rejected.add('bounce@example.com')
+        message = send_mail('Hello', 'bounce@example.com', '<p>Hi</p>')
+        ok = send_mail('Hello', 'reader@example.com', '<p>Hi</p>')
+        self.assertEqual(deliver_outbox(), 1)        # 单封失败不影响同批的其他邮件
+        db.session.expire_all()
+        self.assertIsNotNone(ok.sent_at)
+        self.assertIsNone(message.sent_at)
+        self.assertEqual(message.attempts, 1)
+        self.assertIn('550', message.last_error)
+        backoff = self.app.config['BLUELOG_MAIL_RETRY_BACKOFF']
+        delay = (message.next_attempt_at - datetime.utcnow()).total_seconds()
+        self.assertTrue(backoff - 5 < delay <= backoff)
+        self.assertEqual(deliver_outbox(), 0)        # 退避期内不重试
+
+        self.make_due(message)
+        deliver_outbox()
+        db.session.expire_all()
+        self.assertEqual(message.attempts, 2)
+        delay = (message.next_attempt_at - datetime.utcnow()).total_seconds()
+        self.assertTrue(backoff * 2 - 5 < delay <= backoff * 2)     # 每次失败后加倍
+
+        message.attempts = self.app.config['BLUELOG_MAIL_MAX_ATTEMPTS']
+        self.make_due(message)
+        self.assertEqual(_claim_due_messages(10), [])    # 达到最多尝试次数后不再发送
+
+    def test_connection_failure_retries_whole_batch(self):
+        for i in range(2):
+            send_mail('Hello %d' % i, 'reader%d@example.com' % i, '<p>Hi</p>')
+        self.smtp.stop()
+        self.assertEqual(deliver_outbox(), 0)
+        messages = OutboxMessage.query.all()
+        self.assertEqual([m.attempts for m in messages], [1, 1])
+        self.assertTrue(all(m.sent_at is None and m.last_error for m in messages))
+
+    def test_coalesce_notifications(self):
+        first = send_mail('New comment', 'admin@example.com', '<p>1</p>', coalesce_key='new-comment:1')
+        second = send_mail('New comment', 'admin@example.com', '<p>2</p>', coalesce_key='new-comment:1')
+        other = send_mail('New comment', 'admin@example.com', '<p>3</p>', coalesce_key='new-comment:2')
+        self.assertEqual(second.id, first.id)
+        self.assertNotEqual(other.id, first.id)
+        db.session.expire_all()
+        self.assertEqual(first.count, 2)
+        self.assertEqual(deliver_outbox(), 0)        # 合并窗口结束前不发送
+
+        self.make_due(first)
+        self.assertEqual(deliver_outbox(), 1)
+        recipients, data = self.smtp.messages[0]
+        self.assertIn('Subject: New comment (2)', data)
+
+        third = send_mail('New comment', 'admin@example.com', '<p>4</p>', coalesce_key='new-comment:1')
+        self.assertNotEqual(third.id, first.id)      # 已发送的邮件不再合并
+
+    def test_coalesce_window_expired(self):
+        first = send_mail('New comment', 'admin@example.com', '<p>1</p>', coalesce_key='new-comment:1')
+        window = self.app.config['BLUELOG_MAIL_COALESCE_WINDOW']
+        first.timestamp = datetime.utcnow() - timedelta(seconds=window + 1)
+        db.session.commit()
+        second = send_mail('New comment', 'admin@example.com', '<p>2</p>', coalesce_key='new-comment:1')
+        self.assertNotEqual(second.id, first.id)
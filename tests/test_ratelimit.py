@@ -0,0 +1,75 @@
+from unittest import mock
+
+from tests.base import BaseTestCase
+
+WINDOW = 60
+START = WINDOW * 100        # 窗口开始的时刻，已过去的时间为0
+
+
+class RateLimitTests(object):
+    """两种计数后端共用的测试：BLUELOG_RATE_LIMITS中的限额、429与Retry-After、窗口滑动和重置"""
+    backend = None
+
+    def setUp(self):
+        self.overrides = dict(BLUELOG_RATE_LIMIT=True, BLUELOG_RATE_LIMIT_BACKEND=self.backend,
+                              BLUELOG_RATE_LIMITS={'auth.login': (2, WINDOW), 'blog': (3, WINDOW)},
+                              CACHE_TYPE='SimpleCache', BLUELOG_CACHE_PAGES=False)
+        super(RateLimitTests, self).setUp()
+        self.now = START
+        patcher = mock.patch('bluelog.ratelimit.time.time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get(self, url, ip='10.0.0.1'):
+        return self.client.get(url, environ_base={'REMOTE_ADDR': ip})
+
+    def test_limit_and_retry_after(self):
+        for i in range(2):
+            self.assertNotEqual(self.get('/auth/login').status_code, 429)
+        response = self.get('/auth/login')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Too Many Requests', response.get_data(as_text=True))
+        # 本窗口已有3次请求（被拒绝的也计数），须等到下一窗口且3次折算到1次以下：60 + 60 * 2/3
+        self.assertEqual(response.headers['Retry-After'], '100')
+        self.now = START + 100
+        self.assertNotEqual(self.get('/auth/login').status_code, 429)     # 按Retry-After重试时不再被拒绝
+
+    def test_endpoint_and_blueprint_limits(self):
+        for i in range(3):
+            self.get('/auth/login')
+        self.assertEqual(self.get('/auth/login').status_code, 429)
+        for i in range(3):          # 其他端点使用蓝本的限额，计数互不影响
+            self.assertNotEqual(self.get('/about').status_code, 429)
+        self.assertEqual(self.get('/about').status_code, 429)
+        self.assertNotEqual(self.get('/').status_code, 429)     # 同一蓝本的每个端点分别计数
+        self.assertNotEqual(self.get('/auth/login', ip='10.0.0.2').status_code, 429)   # 每个IP分别计数
+
+    def test_sliding_window(self):
+        for i in range(6):
+            self.get('/about')
+        self.now = START + WINDOW + 30      # 下一窗口的一半，上一窗口的6次折算为3次
+        response = self.get('/about')
+        self.assertEqual(response.status_code, 429)
+        # 连同重试的一次，2 + 6 * (60 - t) / 60不超过3须到t = 50
+        self.assertEqual(response.headers['Retry-After'], '20')
+        self.now = START + WINDOW + 50
+        self.assertNotEqual(self.get('/about').status_code, 429)
+
+    def test_window_resets(self):
+        for i in range(3):
+            self.get('/auth/login')
+        self.assertEqual(self.get('/auth/login').status_code, 429)
+        self.now = START + WINDOW * 2       # 两个窗口之后不再计入之前的请求
+        for i in range(2):
+            self.assertNotEqual(self.get('/auth/login').status_code, 429)
+        self.assertEqual(self.get('/auth/login').status_code, 429)
+
+
+class MemoryRateLimitTestCase(RateLimitTests, BaseTestCase):
+    """进程内计数"""
+    backend = 'memory'
+
+
+class CacheRateLimitTestCase(RateLimitTests, BaseTestCase):
+    """经Flask-Caching计数，SimpleCache代替共享的缓存后端"""
+    backend = 'cache'